@@ -10,6 +10,13 @@ import joblib
 from datetime import datetime, timedelta, time
 from functools import wraps
 from typing import Optional, Dict, List, Tuple
+import multiprocessing
+
+# Процессы обучения и пул поиска гиперпараметров стартуют через spawn и заново импортируют
+# этот файл (как __mp_main__). Побочные эффекты старта бота — .env, белый список, фильтры
+# времени, баннер в логе — им не нужны: окружение они наследуют от родителя.
+# parent_process() во время этого импорта ещё не задан, поэтому главное — имя модуля.
+IS_SPAWNED_CHILD = __name__ == "__mp_main__" or multiprocessing.parent_process() is not None
 
 # Настройка event loop для Windows
 if sys.platform.startswith("win"):
@@ -61,7 +68,7 @@ from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_sc
 from sklearn.cluster import DBSCAN
 
 # ===================== 🧠 OPENAI API =====================
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 # ===================== 🌐 GLOBAL VARIABLES =====================
 app = None
@@ -140,7 +147,7 @@ def load_time_filters():
         print(f"⚠️ Не удалось загрузить time_filters.json: {e}")
         return {}
 
-TIME_FILTERS = load_time_filters()
+TIME_FILTERS = load_time_filters() if not IS_SPAWNED_CHILD else {}
 TIME_FILTERS_LAST_UPDATE = datetime.now()
 
 def auto_reload_filters():
@@ -198,55 +205,23 @@ def load_latest_ml_info():
         logging.error(f"Ошибка чтения ml_info.json: {e}", exc_info=True)
         return {}
 
-# Загрузка модели, скейлера и информации
-try:
-    ml_model = joblib.load("ml_model.pkl")
-    ml_scaler = joblib.load("ml_scaler.pkl")  # обязательная строка для нормализации входных данных
-    model_info = load_latest_ml_info()
-
-    if model_info:
-        logging.info(f"✅ ML модель загружена ({model_info.get('trained_at', 'N/A')})")
-    else:
-        logging.warning("⚠️ ML модель загружена, но информация о ней отсутствует или повреждена")
-
-except Exception as e:
-    logging.warning(f"Не удалось загрузить ML модель: {e}")
-    ml_model, ml_scaler, model_info = None, None, {}
-
-# ================== ML MODEL INITIALIZATION ==================
-def initialize_ml_model():
-    """Инициализация ML модели с обработкой ошибок"""
-    global ml_model, ml_scaler, model_info
-    try:
-        if os.path.exists("ml_model.pkl") and os.path.exists("ml_scaler.pkl"):
-            ml_model = joblib.load("ml_model.pkl")
-            ml_scaler = joblib.load("ml_scaler.pkl")
-            if os.path.exists("ml_info.json"):
-                with open("ml_info.json", "r", encoding="utf-8") as f:
-                    model_info = json.load(f)
-            logging.info("✅ ML модель загружена успешно")
-        else:
-            logging.warning("⚠ ML модель не найдена, будет создана при первом обучении")
-            ml_model, ml_scaler, model_info = None, None, {}
-    except Exception as e:
-        logging.error(f"❌ Ошибка загрузки ML модели: {e}")
-        ml_model, ml_scaler, model_info = None, None, {}
-
-# Вызов инициализации
-initialize_ml_model()
+# Модель, скейлер и model_info загружаются из реестра версий при старте (refresh_active_model в main)
 
 # ===================== CONFIG =====================
 from dotenv import load_dotenv
-load_dotenv()
+if not IS_SPAWNED_CHILD:
+    load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # свой endpoint (прокси, локальная заглушка)
 
 if not TELEGRAM_TOKEN or not OPENAI_API_KEY:
     print("⚠ Ошибка: Проверьте .env файл и убедитесь что указаны TELEGRAM_TOKEN и OPENAI_API_KEY")
     sys.exit(1)
 
-print("✅ Конфигурация загружена успешно")
+if not IS_SPAWNED_CHILD:
+    print("✅ Конфигурация загружена успешно")
 
 # MT5
 MT5_LOGIN = int(os.getenv("MT5_LOGIN", "0"))
@@ -372,13 +347,12 @@ def get_whitelist_stats():
         'users': total - admins
     }
 
-# Загружаем белый список при старте
-WHITELIST = load_whitelist()
+# Загружаем белый список при старте (дочерним процессам он не нужен)
+WHITELIST = load_whitelist() if not IS_SPAWNED_CHILD else {}
 
 
 # ===================== SETTINGS =====================
 USE_GPT = True
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
 
 ML_ENABLED = True
 ML_PROBABILITY_THRESHOLD = 0.65
@@ -412,8 +386,8 @@ LOSS_AMOUNT = 10
 
 
 # ===================== ENHANCED LOGGING =====================
-def setup_logging():
-    """Настройка расширенного логирования"""
+def setup_logging(banner: bool = True):
+    """Настройка расширенного логирования (banner=False — для дочерних процессов)"""
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
     
@@ -437,12 +411,13 @@ def setup_logging():
     logger.addHandler(console_handler)
     
     # Логирование запуска
-    logging.info("=" * 50)
-    logging.info("🚀 BOT ASPIRE TRADE STARTED")
-    logging.info("=" * 50)
+    if banner:
+        logging.info("=" * 50)
+        logging.info("🚀 BOT ASPIRE TRADE STARTED")
+        logging.info("=" * 50)
 
 # Инициализация логирования
-setup_logging()
+setup_logging(banner=not IS_SPAWNED_CHILD)
 
 # ===================== UNIFIED USER MANAGEMENT =====================
 def get_user_data(user_id: int = None) -> Dict:
@@ -550,7 +525,8 @@ def save_users_data():
                         'source': str(trade.get('source', '')),
                         'confidence': int(trade.get('confidence', 0)),
                         'completed_at': str(trade.get('completed_at', '')) if trade.get('completed_at') else None,
-                        'stake_used': float(trade.get('stake_used', STAKE_AMOUNT))
+                        'stake_used': float(trade.get('stake_used', STAKE_AMOUNT)),
+                        'signal_id': str(trade['signal_id']) if trade.get('signal_id') else None
                     }
 
                     # 🧠 Сохраняем 42 ML-фичи полностью, включая вложенные структуры
@@ -675,7 +651,8 @@ def save_users_data():
                     'source': str(trade.get('source', '')),
                     'confidence': int(trade.get('confidence', 0)),
                     'completed_at': str(trade.get('completed_at', '')) if trade.get('completed_at') else None,
-                    'stake_used': float(trade.get('stake_used', STAKE_AMOUNT))
+                    'stake_used': float(trade.get('stake_used', STAKE_AMOUNT)),
+                    'signal_id': str(trade['signal_id']) if trade.get('signal_id') else None
                 }
 
                 ml_features = trade.get('ml_features')
@@ -863,7 +840,98 @@ def create_default_single_data():
         'trade_history': [],
         'current_trade': None
     }
+# ===================== 🗃 КЭШ РЕЗУЛЬТАТОВ ПО БАРУ (LRU) =====================
+import threading
+from collections import OrderedDict
+
+def _bar_stamp(df: pd.DataFrame) -> tuple:
+    """Отпечаток окна: время и цена последнего бара + длина окна"""
+    return (df.index[-1], float(df['close'].iat[-1]), float(df['tick_volume'].iat[-1]), len(df))
+
+class BarResultCache:
+    """
+    Ограниченный LRU-кэш результатов анализа.
+    Ключ: (функция, символ, таймфрейм, аргументы, отпечаток последнего бара).
+    Формирующийся бар входит в отпечаток через close/tick_volume,
+    поэтому новый тик даёт промах, а повтор между пользователями — попадание.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, self._data[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0
+            }
+
+BAR_CACHE = BarResultCache(maxsize=2048)
+
+def bar_cache_key(name: str, df: pd.DataFrame, extra: tuple = ()) -> Optional[tuple]:
+    """Ключ кэша; None — если у окна нет символа (кадр собран не через get_mt5_data)"""
+    if df is None or len(df) == 0:
+        return None
+    symbol = df.attrs.get('symbol')
+    if symbol is None:
+        return None
+    return (name, symbol, df.attrs.get('timeframe'), extra, _bar_stamp(df))
+
+def bar_cached(func):
+    """
+    Декоратор для функций вида f(df, ...): повторный вызов на том же баре
+    возвращает сохранённый результат. Результаты считаются только для чтения.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(df, *args, **kwargs):
+        try:
+            key = bar_cache_key(name, df, (args, tuple(sorted(kwargs.items()))))
+        except Exception:
+            key = None
+        if key is None:
+            return func(df, *args, **kwargs)
+
+        hit, value = BAR_CACHE.get(key)
+        if hit:
+            return value
+        value = func(df, *args, **kwargs)
+        BAR_CACHE.put(key, value)
+        return value
+
+    return wrapper
+
 # ===================== SMART MONEY ANALYSIS =====================
+@bar_cached
 def find_market_structure(df, lookback=25):
     """Улучшенное определение структуры рынка с фильтрацией шума"""
     try:
@@ -927,6 +995,7 @@ def find_market_structure(df, lookback=25):
         logging.error(f"Ошибка find_market_structure: {e}")
         return []
 
+@bar_cached
 def find_horizontal_levels(df, threshold_pips=0.0005):
     """Улучшенный поиск горизонтальных уровней с кластеризацией"""
     try:
@@ -1044,6 +1113,7 @@ def validate_zone_quality(zone, df):
         logging.error(f"❌ Ошибка validate_zone_quality: {e}")
         return False
 
+@bar_cached
 def find_supply_demand_zones(df, strength=2, lookback=25):
     """Улучшенный поиск зон спроса/предложения"""
     try:
@@ -1176,6 +1246,7 @@ def find_supply_demand_zones(df, strength=2, lookback=25):
         logging.error(f"Ошибка find_supply_demand_zones: {e}")
         return []
     
+@bar_cached
 def calculate_order_blocks_advanced(df):
     """Улучшенный поиск ордер-блоков с системой подтверждения"""
     order_blocks = []
@@ -1259,6 +1330,7 @@ def calculate_order_blocks_advanced(df):
         logging.error(f"Ошибка calculate_order_blocks_advanced: {e}")
         return []
 
+@bar_cached
 def calculate_fibonacci_levels(df):
     """Расчёт уровней Фибоначчи по последнему импульсу"""
     try:
@@ -1279,16 +1351,23 @@ def calculate_fibonacci_levels(df):
         logging.error(f"Ошибка в calculate_fibonacci_levels: {e}")
         return []
 
-def enhanced_trend_analysis(df):
+@bar_cached
+def enhanced_trend_analysis(df, pair: Optional[str] = None):
     """Улучшенный анализ тренда с определением импульсных движений"""
     try:
         # =============== СТАНДАРТНЫЕ ИНДИКАТОРЫ ===============
-        ema_20 = ta.EMA(df['close'], 20).iloc[-1]
-        ema_50 = ta.EMA(df['close'], 50).iloc[-1]
-        ema_100 = ta.EMA(df['close'], 100).iloc[-1]
-        
-        adx = ta.ADX(df['high'], df['low'], df['close'], 14).iloc[-1]
-        rsi = ta.RSI(df['close'], 14).iloc[-1]
+        stream = get_streaming_indicators(pair, df) if pair else None
+        if stream is not None and None not in (stream['ema_100'], stream['adx'], stream['rsi_14']):
+            ema_20, ema_50, ema_100 = stream['ema_20'], stream['ema_50'], stream['ema_100']
+            adx = stream['adx']
+            rsi = stream['rsi_14']
+        else:
+            ema_20 = ta.EMA(df['close'], 20).iloc[-1]
+            ema_50 = ta.EMA(df['close'], 50).iloc[-1]
+            ema_100 = ta.EMA(df['close'], 100).iloc[-1]
+
+            adx = ta.ADX(df['high'], df['low'], df['close'], 14).iloc[-1]
+            rsi = ta.RSI(df['close'], 14).iloc[-1]
         current_price = df['close'].iloc[-1]
         
         # =============== НОВЫЕ МЕТРИКИ ИМПУЛЬСА ===============
@@ -1361,6 +1440,7 @@ def enhanced_trend_analysis(df):
             'is_strong_impulse': False
         }
 
+@bar_cached
 def liquidity_analysis(df):
     """Анализ уровней ликвидности"""
     try:
@@ -1389,42 +1469,78 @@ def liquidity_analysis(df):
         logging.error(f"Ошибка liquidity_analysis: {e}")
         return {}
 
+def detect_candle_patterns(df):
+    """
+    🕯 Векторный детектор свечных паттернов по всей истории.
+    Возвращает словарь булевых массивов длины len(df):
+    bearish_pin, bullish_pin, bullish_engulfing, bearish_engulfing,
+    inside_bar, three_white_soldiers. Лайв читает последний элемент,
+    бэктест и обучение получают всю историю за один проход.
+    """
+    n = len(df)
+    names = ('bearish_pin', 'bullish_pin', 'bullish_engulfing', 'bearish_engulfing',
+             'inside_bar', 'three_white_soldiers')
+    patterns = {name: np.zeros(n, dtype=bool) for name in names}
+    if n < 2:
+        return patterns
+
+    o = df['open'].to_numpy(dtype=np.float64)
+    h = df['high'].to_numpy(dtype=np.float64)
+    l = df['low'].to_numpy(dtype=np.float64)
+    c = df['close'].to_numpy(dtype=np.float64)
+
+    body = np.abs(c - o)
+    rng = h - l
+    upper_wick = h - np.maximum(o, c)
+    lower_wick = np.minimum(o, c) - l
+    bullish = c > o
+    bearish = c < o
+
+    # Pin Bar
+    small_body = body < rng * 0.3
+    patterns['bearish_pin'] = small_body & (upper_wick > body * 2) & (lower_wick < body)
+    patterns['bullish_pin'] = small_body & (lower_wick > body * 2) & (upper_wick < body)
+
+    # Engulfing / Inside Bar (сравнение с предыдущей свечой)
+    po, ph, pl, pc = o[:-1], h[:-1], l[:-1], c[:-1]
+    co, ch, cl, cc = o[1:], h[1:], l[1:], c[1:]
+    patterns['bullish_engulfing'][1:] = bullish[1:] & bearish[:-1] & (co < pc) & (cc > po)
+    patterns['bearish_engulfing'][1:] = bearish[1:] & bullish[:-1] & (co > pc) & (cc < po)
+    patterns['inside_bar'][1:] = (ch < ph) & (cl > pl)
+
+    # Три белых солдата: три бычьи свечи подряд с растущими закрытиями
+    if n >= 3:
+        patterns['three_white_soldiers'][2:] = (
+            bullish[2:] & bullish[1:-1] & bullish[:-2] &
+            (c[2:] > c[1:-1]) & (c[1:-1] > c[:-2])
+        )
+    return patterns
+
+@bar_cached
 def price_action_patterns(df):
-    """Определение Price Action паттернов"""
+    """Определение Price Action паттернов (последняя свеча векторного детектора)"""
     patterns = []
     
     try:
         if len(df) < 3:
             return patterns
             
-        current = df.iloc[-1]
-        prev = df.iloc[-2]
-        prev2 = df.iloc[-3]
-        
-        current_body = abs(current['close'] - current['open'])
-        current_range = current['high'] - current['low']
-        prev_body = abs(prev['close'] - prev['open'])
+        detected = detect_candle_patterns(df.iloc[-3:])
         
         # Pin Bar
-        if current_body < current_range * 0.3:
-            upper_wick = current['high'] - max(current['open'], current['close'])
-            lower_wick = min(current['open'], current['close']) - current['low']
-            
-            if upper_wick > current_body * 2 and lower_wick < current_body:
-                patterns.append({'type': 'BEARISH_PIN', 'strength': 'MEDIUM'})
-            elif lower_wick > current_body * 2 and upper_wick < current_body:
-                patterns.append({'type': 'BULLISH_PIN', 'strength': 'MEDIUM'})
+        if detected['bearish_pin'][-1]:
+            patterns.append({'type': 'BEARISH_PIN', 'strength': 'MEDIUM'})
+        elif detected['bullish_pin'][-1]:
+            patterns.append({'type': 'BULLISH_PIN', 'strength': 'MEDIUM'})
         
         # Engulfing
-        if (current['close'] > current['open'] and prev['close'] < prev['open'] and
-            current['open'] < prev['close'] and current['close'] > prev['open']):
+        if detected['bullish_engulfing'][-1]:
             patterns.append({'type': 'BULLISH_ENGULFING', 'strength': 'STRONG'})
-        elif (current['close'] < current['open'] and prev['close'] > prev['open'] and
-              current['open'] > prev['close'] and current['close'] < prev['open']):
+        elif detected['bearish_engulfing'][-1]:
             patterns.append({'type': 'BEARISH_ENGULFING', 'strength': 'STRONG'})
         
         # Inside Bar
-        if (current['high'] < prev['high'] and current['low'] > prev['low']):
+        if detected['inside_bar'][-1]:
             patterns.append({'type': 'INSIDE_BAR', 'strength': 'WEAK'})
             
     except Exception as e:
@@ -1483,9 +1599,9 @@ def calculate_dynamic_expiry(df, confidence, signal_type=None):
         return 2  # дефолт 2 минуты при ошибке
 
 
-def get_candle_time_info():
-    """Получает информацию о времени до закрытия текущей свечи"""
-    now = datetime.now()
+def get_candle_time_info(now: Optional[datetime] = None):
+    """Получает информацию о времени до закрытия текущей свечи (now — для бэкфилла по истории)"""
+    now = now or datetime.now()
     seconds_passed = now.second
     seconds_remaining = 60 - seconds_passed
     
@@ -1538,75 +1654,92 @@ def closing_candle_strategy(df, candle_time, trend_analysis):
     return None, 0, None
 
 def check_level_breakouts(df, current_price, zones):
+    """Пробои зон: верх/низ всех зон сравниваются с окном последних свечей одним broadcast"""
     try:
-        breakouts = []
         lookback = 8
-        
-        for zone in zones:
-            zone_middle = (zone['top'] + zone['bottom']) / 2
-            
-            if zone['type'] == 'DEMAND':
-                recent_closes = df['close'].tail(lookback)
-                recent_lows = df['low'].tail(lookback)
-                
-                if any(close < zone['bottom'] for close in recent_closes) or \
-                   any(low < zone['bottom'] for low in recent_lows):
-                    breakouts.append({
-                        'type': 'BEARISH_BREAKOUT',
-                        'zone': zone,
-                        'strength': 'STRONG' if zone['source'] == 'HORIZONTAL' else 'MEDIUM'
-                    })
-            
-            elif zone['type'] == 'SUPPLY':
-                recent_closes = df['close'].tail(lookback)
-                recent_highs = df['high'].tail(lookback)
-                
-                if any(close > zone['top'] for close in recent_closes) or \
-                   any(high > zone['top'] for high in recent_highs):
-                    breakouts.append({
-                        'type': 'BULLISH_BREAKOUT', 
-                        'zone': zone,
-                        'strength': 'STRONG' if zone['source'] == 'HORIZONTAL' else 'MEDIUM'
-                    })
-        
+        zones = [z for z in zones if z.get('type') in ('DEMAND', 'SUPPLY')]
+        if not zones:
+            return []
+
+        is_demand = np.array([z['type'] == 'DEMAND' for z in zones])
+        tops = np.array([z['top'] for z in zones], dtype=np.float64)
+        bottoms = np.array([z['bottom'] for z in zones], dtype=np.float64)
+
+        # Окно: закрытия + тени последних свечей (zones × bars)
+        window_low = np.concatenate([df['close'].to_numpy(dtype=np.float64)[-lookback:],
+                                     df['low'].to_numpy(dtype=np.float64)[-lookback:]])
+        window_high = np.concatenate([df['close'].to_numpy(dtype=np.float64)[-lookback:],
+                                      df['high'].to_numpy(dtype=np.float64)[-lookback:]])
+        broke_down = (window_low[None, :] < bottoms[:, None]).any(axis=1)
+        broke_up = (window_high[None, :] > tops[:, None]).any(axis=1)
+
+        hits = np.where(is_demand, broke_down, broke_up)
+        breakouts = []
+        for idx in np.flatnonzero(hits):
+            zone = zones[idx]
+            breakouts.append({
+                'type': 'BEARISH_BREAKOUT' if is_demand[idx] else 'BULLISH_BREAKOUT',
+                'zone': zone,
+                'strength': 'STRONG' if zone['source'] == 'HORIZONTAL' else 'MEDIUM'
+            })
         return breakouts
         
     except Exception as e:
         logging.error(f"Ошибка проверки пробоев: {e}")
         return []
+
+def _exhaustion_components(df, rsi=None):
+    """Массивы критериев истощения по всей истории (RSI, Δ за 5 свечей, объём, ATR)"""
+    close = df['close'].to_numpy(dtype=np.float64)
+    volume = df['tick_volume'].to_numpy(dtype=np.float64)
+    n = len(close)
+
+    if rsi is None:
+        rsi = ta.RSI(close, timeperiod=14)
+    rsi = np.broadcast_to(np.asarray(rsi, dtype=np.float64), (n,))
+
+    close_5 = np.full(n, np.nan)
+    close_5[4:] = close[:-4]
+    price_change_5m = (close - close_5) / close_5 * 100
+
+    avg_volume = pd.Series(volume).rolling(20).mean().to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        volume_ratio = np.where(avg_volume > 0, volume / avg_volume, 1.0)
+
+    atr = ta.ATR(df['high'].to_numpy(dtype=np.float64), df['low'].to_numpy(dtype=np.float64), close, timeperiod=14)
+    normal_move = (atr / close) * 100 * 3  # 3x от нормальной волатильности
+
+    mask = (
+        ((rsi < 25) | (rsi > 75)) &
+        ((np.abs(price_change_5m) > 0.15) | (np.abs(price_change_5m) > normal_move)) &
+        (volume_ratio < 0.9)
+    )
+    mask[:19] = False  # нужно минимум 20 свечей
+    return {
+        'mask': mask,
+        'rsi': rsi,
+        'price_change_5m': price_change_5m,
+        'volume_ratio': volume_ratio
+    }
+
+def exhaustion_mask(df, rsi=None) -> np.ndarray:
+    """Векторная маска истощения движения для всего ряда (бэктест/обучение)"""
+    if df is None or len(df) == 0:
+        return np.zeros(0, dtype=bool)
+    return _exhaustion_components(df, rsi)['mask']
+
 def is_exhausted_move(df, trend_analysis):
     """Определяет истощение движения для фильтрации ложных сигналов"""
     try:
         if len(df) < 20:
             return False
             
-        current_price = df['close'].iloc[-1]
         rsi = trend_analysis.get('rsi_value', 50)
+        comp = _exhaustion_components(df, rsi)
         
-        # 1. Проверка RSI в экстремумах
-        if rsi < 25 or rsi > 75:
-            # 2. Проверка резкого движения (более чувствительная)
-            price_change_5m = (current_price - df['close'].iloc[-5]) / df['close'].iloc[-5] * 100
-            price_change_15m = (current_price - df['close'].iloc[-15]) / df['close'].iloc[-15] * 100
-            
-            # 3. Проверка объема (менее строгая)
-            current_volume = df['tick_volume'].iloc[-1]
-            avg_volume = df['tick_volume'].tail(20).mean()
-            volume_ratio = current_volume / avg_volume if avg_volume > 0 else 1
-            
-            # 4. Проверка относительно нормальной волатильности
-            atr = ta.ATR(df['high'], df['low'], df['close'], timeperiod=14).iloc[-1]
-            normal_move = (atr / current_price) * 100 * 3  # 3x от нормальной волатильности
-            
-            # 🔥 УЛУЧШЕННЫЕ КРИТЕРИИ ИСТОЩЕНИЯ:
-            is_strong_move = abs(price_change_5m) > 0.15  # Более чувствительный порог
-            is_extended_move = abs(price_change_5m) > normal_move  # Относительно ATR
-            is_volume_declining = volume_ratio < 0.9  # Менее строгий объем
-            
-            # Критерии истощения:
-            if (is_strong_move or is_extended_move) and is_volume_declining:
-                logging.info(f"⚠️ Обнаружено истощение движения: RSI={rsi:.1f}, Δ5m={price_change_5m:.2f}%, Объем={volume_ratio:.2f}")
-                return True
+        if comp['mask'][-1]:
+            logging.info(f"⚠️ Обнаружено истощение движения: RSI={rsi:.1f}, Δ5m={comp['price_change_5m'][-1]:.2f}%, Объем={comp['volume_ratio'][-1]:.2f}")
+            return True
                 
         return False
         
@@ -1780,6 +1913,590 @@ def enhanced_smart_money_analysis(df):
         logging.error(f"💥 Ошибка ENHANCED SMC анализа: {e}")
         return None, None, 0, "SMC_ERROR"
     
+# ===================== ⚡ STREAMING INDICATORS (O(1) НА БАР) =====================
+import threading
+from collections import deque
+
+def _ta_is_zero(x: float) -> bool:
+    """Тот же порог нуля, что и TA_IS_ZERO в TA-Lib"""
+    return -0.00000001 < x < 0.00000001
+
+class StreamingEMA:
+    """EMA как в TA-Lib: затравка SMA(period), далее prev + k*(x - prev)"""
+
+    def __init__(self, period: int):
+        self.period = period
+        self.k = 2.0 / (period + 1)
+        self.count = 0
+        self.acc = 0.0
+        self.value = None
+
+    def _step(self, x: float, commit: bool):
+        count, acc, value = self.count + 1, self.acc, self.value
+        if value is None:
+            acc += x
+            if count == self.period:
+                value = acc / self.period
+        else:
+            value = ((x - value) * self.k) + value
+        if commit:
+            self.count, self.acc, self.value = count, acc, value
+        return value
+
+    def update(self, x: float):
+        return self._step(float(x), True)
+
+    def peek(self, x: float):
+        return self._step(float(x), False)
+
+class StreamingRSI:
+    """RSI Уайлдера как в TA-Lib (классический режим)"""
+
+    def __init__(self, period: int = 14):
+        self.period = period
+        self.count = 0
+        self.prev_close = None
+        self.gain = 0.0
+        self.loss = 0.0
+        self.value = None
+
+    def _step(self, close: float, commit: bool):
+        count, gain, loss, value = self.count + 1, self.gain, self.loss, self.value
+        if self.prev_close is not None:
+            diff = close - self.prev_close
+            p = self.period
+            if count <= p + 1:
+                # накопление сумм за первые period изменений
+                if diff < 0:
+                    loss -= diff
+                else:
+                    gain += diff
+                if count == p + 1:
+                    gain /= p
+                    loss /= p
+            else:
+                gain *= (p - 1)
+                loss *= (p - 1)
+                if diff < 0:
+                    loss -= diff
+                else:
+                    gain += diff
+                gain /= p
+                loss /= p
+            if count >= p + 1:
+                total = gain + loss
+                value = 100.0 * (gain / total) if not _ta_is_zero(total) else 0.0
+        if commit:
+            self.count, self.gain, self.loss, self.value = count, gain, loss, value
+            self.prev_close = close
+        return value
+
+    def update(self, close: float):
+        return self._step(float(close), True)
+
+    def peek(self, close: float):
+        return self._step(float(close), False)
+
+def _true_range(high: float, low: float, prev_close: float) -> float:
+    greatest = high - low
+    val2 = abs(prev_close - high)
+    if val2 > greatest:
+        greatest = val2
+    val3 = abs(prev_close - low)
+    if val3 > greatest:
+        greatest = val3
+    return greatest
+
+class StreamingATR:
+    """ATR как в TA-Lib: SMA первых period TR, далее сглаживание Уайлдера"""
+
+    def __init__(self, period: int = 14):
+        self.period = period
+        self.count = 0
+        self.prev_close = None
+        self.acc = 0.0
+        self.value = None
+
+    def _step(self, high: float, low: float, close: float, commit: bool):
+        count, acc, value = self.count + 1, self.acc, self.value
+        if self.prev_close is not None:
+            tr = _true_range(high, low, self.prev_close)
+            p = self.period
+            if value is None:
+                acc += tr
+                if count == p + 1:
+                    value = acc / p
+            else:
+                value = (value * (p - 1) + tr) / p
+        if commit:
+            self.count, self.acc, self.value = count, acc, value
+            self.prev_close = close
+        return value
+
+    def update(self, high: float, low: float, close: float):
+        return self._step(float(high), float(low), float(close), True)
+
+    def peek(self, high: float, low: float, close: float):
+        return self._step(float(high), float(low), float(close), False)
+
+class StreamingADX:
+    """ADX как в TA-Lib: суммы +DM/-DM/TR за period-1 баров, DX за period баров, затем Уайлдер"""
+
+    def __init__(self, period: int = 14):
+        self.period = period
+        self.count = 0
+        self.prev_high = None
+        self.prev_low = None
+        self.prev_close = None
+        self.plus_dm = 0.0
+        self.minus_dm = 0.0
+        self.tr = 0.0
+        self.sum_dx = 0.0
+        self.value = None
+
+    def _step(self, high: float, low: float, close: float, commit: bool):
+        count = self.count + 1
+        plus_dm, minus_dm, tr_s = self.plus_dm, self.minus_dm, self.tr
+        sum_dx, value = self.sum_dx, self.value
+        p = self.period
+        if self.prev_high is not None:
+            diff_p = high - self.prev_high
+            diff_m = self.prev_low - low
+            tr = _true_range(high, low, self.prev_close)
+            if count <= p:
+                # первые period-1 изменений — простые суммы
+                if diff_m > 0 and diff_p < diff_m:
+                    minus_dm += diff_m
+                elif diff_p > 0 and diff_p > diff_m:
+                    plus_dm += diff_p
+                tr_s += tr
+            else:
+                minus_dm -= minus_dm / p
+                plus_dm -= plus_dm / p
+                if diff_m > 0 and diff_p < diff_m:
+                    minus_dm += diff_m
+                elif diff_p > 0 and diff_p > diff_m:
+                    plus_dm += diff_p
+                tr_s = tr_s - (tr_s / p) + tr
+                dx = None
+                if not _ta_is_zero(tr_s):
+                    minus_di = 100.0 * (minus_dm / tr_s)
+                    plus_di = 100.0 * (plus_dm / tr_s)
+                    di_sum = minus_di + plus_di
+                    if not _ta_is_zero(di_sum):
+                        dx = 100.0 * (abs(minus_di - plus_di) / di_sum)
+                if count <= 2 * p:
+                    if dx is not None:
+                        sum_dx += dx
+                    if count == 2 * p:
+                        value = sum_dx / p
+                elif dx is not None:
+                    value = ((value * (p - 1)) + dx) / p
+        if commit:
+            self.count, self.plus_dm, self.minus_dm, self.tr = count, plus_dm, minus_dm, tr_s
+            self.sum_dx, self.value = sum_dx, value
+            self.prev_high, self.prev_low, self.prev_close = high, low, close
+        return value
+
+    def update(self, high: float, low: float, close: float):
+        return self._step(float(high), float(low), float(close), True)
+
+    def peek(self, high: float, low: float, close: float):
+        return self._step(float(high), float(low), float(close), False)
+
+class StreamingOBV:
+    """OBV как в TA-Lib: старт с объёма первого бара"""
+
+    def __init__(self):
+        self.prev_close = None
+        self.value = None
+
+    def _step(self, close: float, volume: float, commit: bool):
+        if self.prev_close is None:
+            value = volume
+        elif close > self.prev_close:
+            value = self.value + volume
+        elif close < self.prev_close:
+            value = self.value - volume
+        else:
+            value = self.value
+        if commit:
+            self.prev_close, self.value = close, value
+        return value
+
+    def update(self, close: float, volume: float):
+        return self._step(float(close), float(volume), True)
+
+    def peek(self, close: float, volume: float):
+        return self._step(float(close), float(volume), False)
+
+# Через сколько закоммиченных баров состояние пересевается с текущего окна:
+# затравка TA-Lib привязана к началу окна, без пересева потоковые значения уплывают
+STREAM_RESEED_BARS = int(os.getenv("STREAM_RESEED_BARS", "240"))
+
+class PairIndicatorStream:
+    """
+    Набор потоковых индикаторов одной пары/таймфрейма.
+    Закрытые бары коммитятся в состояние, последний (формирующийся) бар MT5 — только peek.
+    Состояние пересевается с окна df (= TA-Lib на этом окне) каждые STREAM_RESEED_BARS баров,
+    а также при разрыве истории или переписанном брокером закрытом баре.
+    """
+
+    ATR_RATIO_WINDOW = 50
+    OBV_TREND_LAG = 5
+    OBV_LINE_MAX = 4096
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reseeds = 0
+        self.reset()
+
+    def reset(self):
+        self.last_time = None
+        self.last_bar = None
+        self.bars = 0
+        self.seed_bars = 0
+        self.ema = {p: StreamingEMA(p) for p in (20, 50, 100)}
+        self.rsi = {p: StreamingRSI(p) for p in (14, 21)}
+        self.atr = StreamingATR(14)
+        self.adx = StreamingADX(14)
+        self.obv = StreamingOBV()
+        self.atr_hist = deque(maxlen=self.ATR_RATIO_WINDOW - 1)
+        self.obv_hist = deque(maxlen=self.OBV_TREND_LAG)
+        # (время бара, OBV, объём) — чтобы привязать OBV к началу окна, как в TA-Lib
+        self.obv_line = deque(maxlen=self.OBV_LINE_MAX)
+
+    def _commit(self, t, o, h, l, c, v):
+        for ind in self.ema.values():
+            ind.update(c)
+        for ind in self.rsi.values():
+            ind.update(c)
+        atr = self.atr.update(h, l, c)
+        if atr is not None:
+            self.atr_hist.append(atr)
+        self.adx.update(h, l, c)
+        obv = self.obv.update(c, v)
+        self.obv_hist.append(obv)
+        self.obv_line.append((t, obv, v))
+        self.bars += 1
+
+    def sync(self, df: pd.DataFrame) -> dict:
+        """Догоняет состояние по df (закрытые бары) и возвращает значения на последнем баре"""
+        with self.lock:
+            times = df.index
+            closed = len(df) - 1
+            cols = ('open', 'high', 'low', 'close', 'tick_volume')
+            start = 0
+            if self.last_time is not None:
+                pos = times.searchsorted(self.last_time)
+                if pos < closed and times[pos] == self.last_time:
+                    if tuple(float(df[col].iat[pos]) for col in cols) != self.last_bar:
+                        # брокер переписал закрытый бар — пересеваем из окна
+                        self.reset()
+                    elif self.bars - self.seed_bars >= STREAM_RESEED_BARS:
+                        # плановый пересев: затравка снова совпадает с началом окна
+                        self.reset()
+                    else:
+                        start = pos + 1
+                else:
+                    # разрыв истории или откат (формирующийся бар уже был закоммичен) — пересеваем
+                    self.reset()
+                if start == 0:
+                    self.reseeds += 1
+            if start < closed:
+                o, h, l, c, v = (df[col].to_numpy(dtype=float) for col in cols)
+                for i in range(start, closed):
+                    self._commit(times[i], o[i], h[i], l[i], c[i], v[i])
+                if start == 0:
+                    self.seed_bars = self.bars
+                last = closed - 1
+                self.last_time = times[last]
+                self.last_bar = (o[last], h[last], l[last], c[last], v[last])
+            return self._snapshot(df.iloc[-1], times[0], closed)
+
+    def _window_obv(self, obv: float, window_start, closed: int) -> float:
+        """OBV в системе отсчёта TA-Lib: OBV[0] окна = его объём"""
+        # последний элемент линии — бар closed-1 окна, значит начало окна лежит на closed от хвоста
+        if 0 < closed <= len(self.obv_line):
+            t, start_obv, start_volume = self.obv_line[-closed]
+            if t == window_start:
+                return obv - start_obv + start_volume
+        return obv
+
+    def _snapshot(self, bar, window_start=None, closed: int = 0) -> dict:
+        h, l, c, v = float(bar['high']), float(bar['low']), float(bar['close']), float(bar['tick_volume'])
+        atr = self.atr.peek(h, l, c)
+        obv = self.obv.peek(c, v)
+        snap = {f'ema_{p}': ind.peek(c) for p, ind in self.ema.items()}
+        snap.update({f'rsi_{p}': ind.peek(c) for p, ind in self.rsi.items()})
+        snap['atr'] = atr
+        if atr is not None and len(self.atr_hist) == self.ATR_RATIO_WINDOW - 1:
+            snap['atr_ma_50'] = (sum(self.atr_hist) + atr) / self.ATR_RATIO_WINDOW
+        else:
+            snap['atr_ma_50'] = None
+        snap['adx'] = self.adx.peek(h, l, c)
+        snap['obv'] = self._window_obv(obv, window_start, closed) if window_start is not None else obv
+        snap['obv_trend'] = (obv - self.obv_hist[0]) if len(self.obv_hist) == self.OBV_TREND_LAG else None
+        return snap
+
+# (pair, timeframe) -> PairIndicatorStream
+INDICATOR_STREAMS: Dict[Tuple[str, str], PairIndicatorStream] = {}
+_INDICATOR_STREAMS_LOCK = threading.Lock()
+
+def get_streaming_indicators(pair: str, df: pd.DataFrame, timeframe: str = "M1") -> Optional[dict]:
+    """Возвращает потоковые индикаторы пары на последнем баре df (O(новых баров) вместо O(окна))"""
+    try:
+        if df is None or len(df) < 2:
+            return None
+        key = (pair, timeframe)
+        with _INDICATOR_STREAMS_LOCK:
+            stream = INDICATOR_STREAMS.get(key)
+            if stream is None:
+                stream = INDICATOR_STREAMS[key] = PairIndicatorStream()
+        return stream.sync(df)
+    except Exception as e:
+        logging.error(f"❌ Ошибка потоковых индикаторов {pair}/{timeframe}: {e}")
+        return None
+
+# ===================== 🧮 BATCHED UNIVERSE INDICATORS (PAIRS × BARS) =====================
+from scipy.signal import lfilter
+from numpy.lib.stride_tricks import sliding_window_view
+
+def stack_pair_frames(frames: Dict[str, pd.DataFrame], n_bars: Optional[int] = None) -> List[dict]:
+    """
+    Складывает OHLCV пар в матрицы (pairs × bars) по последним n_bars барам.
+    Каждая строка — отдельный ряд, поэтому достаточно выравнивания по хвосту. Пары с короткой
+    историей идут отдельной группой: окно остальных не обрезается до самой короткой пары,
+    и отпечатки окон (_bar_stamp) совпадают с кадрами, которые видит analyze_pair.
+    """
+    groups: Dict[int, List[str]] = {}
+    for pair, df in frames.items():
+        if df is None or len(df) == 0:
+            continue
+        n = len(df) if n_bars is None else min(len(df), n_bars)
+        groups.setdefault(n, []).append(pair)
+
+    stacks = []
+    for n, pairs in groups.items():
+        stack = {
+            'pairs': pairs,
+            'n_bars': n,
+            'stamps': {p: _bar_stamp(frames[p].iloc[-n:]) for p in pairs},
+        }
+        for col in ('open', 'high', 'low', 'close', 'tick_volume'):
+            stack[col] = np.vstack([frames[p][col].to_numpy(dtype=float)[-n:] for p in pairs])
+        stacks.append(stack)
+    return stacks
+
+def _wilder_filter(x: np.ndarray, seed: np.ndarray, period: int) -> np.ndarray:
+    """y[t] = y[t-1] + (x[t] - y[t-1]) / period по оси времени, начиная с seed"""
+    alpha = 1.0 / period
+    return lfilter([alpha], [1.0, alpha - 1.0], x, axis=1, zi=((1.0 - alpha) * seed)[:, None])[0]
+
+def batch_ema(x: np.ndarray, period: int) -> np.ndarray:
+    """EMA (как TA-Lib: затравка SMA) для матрицы pairs × bars"""
+    out = np.full(x.shape, np.nan)
+    if x.shape[1] < period:
+        return out
+    k = 2.0 / (period + 1)
+    seed = x[:, :period].mean(axis=1)
+    out[:, period - 1] = seed
+    if x.shape[1] > period:
+        out[:, period:] = lfilter([k], [1.0, k - 1.0], x[:, period:], axis=1, zi=((1.0 - k) * seed)[:, None])[0]
+    return out
+
+def batch_rsi(close: np.ndarray, period: int = 14) -> np.ndarray:
+    """RSI Уайлдера (как TA-Lib) для матрицы pairs × bars"""
+    out = np.full(close.shape, np.nan)
+    if close.shape[1] <= period:
+        return out
+    diff = np.diff(close, axis=1)
+    gain = np.where(diff > 0, diff, 0.0)
+    loss = np.where(diff < 0, -diff, 0.0)
+    avg_gain = np.empty(diff.shape[0:1] + (diff.shape[1] - period + 1,))
+    avg_loss = np.empty_like(avg_gain)
+    avg_gain[:, 0] = gain[:, :period].sum(axis=1) / period
+    avg_loss[:, 0] = loss[:, :period].sum(axis=1) / period
+    if diff.shape[1] > period:
+        avg_gain[:, 1:] = _wilder_filter(gain[:, period:], avg_gain[:, 0], period)
+        avg_loss[:, 1:] = _wilder_filter(loss[:, period:], avg_loss[:, 0], period)
+    total = avg_gain + avg_loss
+    safe = np.abs(total) >= 0.00000001
+    out[:, period:] = np.where(safe, 100.0 * avg_gain / np.where(safe, total, 1.0), 0.0)
+    return out
+
+def batch_true_range(high: np.ndarray, low: np.ndarray, close: np.ndarray) -> np.ndarray:
+    """TRANGE (первый бар — NaN, как в TA-Lib)"""
+    tr = np.full(close.shape, np.nan)
+    prev_close = close[:, :-1]
+    tr[:, 1:] = np.maximum.reduce([
+        high[:, 1:] - low[:, 1:],
+        np.abs(prev_close - high[:, 1:]),
+        np.abs(prev_close - low[:, 1:]),
+    ])
+    return tr
+
+def batch_atr(high: np.ndarray, low: np.ndarray, close: np.ndarray, period: int = 14) -> np.ndarray:
+    """ATR (как TA-Lib: SMA первых TR, затем Уайлдер) для матрицы pairs × bars"""
+    out = np.full(close.shape, np.nan)
+    if close.shape[1] <= period:
+        return out
+    tr = batch_true_range(high, low, close)
+    seed = tr[:, 1:period + 1].mean(axis=1)
+    out[:, period] = seed
+    if close.shape[1] > period + 1:
+        out[:, period + 1:] = _wilder_filter(tr[:, period + 1:], seed, period)
+    return out
+
+def batch_bbands(close: np.ndarray, period: int = 20, nbdev: float = 2.0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Полосы Боллинджера (SMA ± nbdev·σ, σ популяционная, как TA-Lib BBANDS)"""
+    upper = np.full(close.shape, np.nan)
+    middle = np.full(close.shape, np.nan)
+    lower = np.full(close.shape, np.nan)
+    if close.shape[1] < period:
+        return upper, middle, lower
+    windows = sliding_window_view(close, period, axis=1)
+    mean = windows.mean(axis=2)
+    var = (windows * windows).mean(axis=2) - mean * mean
+    std = np.sqrt(np.where(var > 0.00000001 ** 2, var, 0.0))
+    middle[:, period - 1:] = mean
+    upper[:, period - 1:] = mean + nbdev * std
+    lower[:, period - 1:] = mean - nbdev * std
+    return upper, middle, lower
+
+def batch_analyze_trend(stack: dict) -> Dict[str, str]:
+    """analyze_trend для всех пар одним проходом по матрице"""
+    pairs = stack['pairs']
+    if stack['n_bars'] < 50:
+        return {p: "NEUTRAL" for p in pairs}
+    close = stack['close']
+    ema_10 = batch_ema(close, 10)
+    ema_20 = batch_ema(close, 20)[:, -1]
+    ema_50 = batch_ema(close, 50)[:, -1]
+    price = close[:, -1]
+    e10, e10_prev = ema_10[:, -1], ema_10[:, -2]
+
+    bullish = np.where((price > e10) & (e10 > ema_20) & (ema_20 > ema_50), 2, 0)
+    bearish = np.where(~((price > e10) & (e10 > ema_20) & (ema_20 > ema_50)) &
+                       (price < e10) & (e10 < ema_20) & (ema_20 < ema_50), 2, 0)
+    slope_up = e10 > e10_prev
+    bullish = bullish + slope_up
+    bearish = bearish + ~slope_up
+
+    trends = np.where(bullish - bearish >= 2, "BULLISH", np.where(bearish - bullish >= 2, "BEARISH", "NEUTRAL"))
+    return dict(zip(pairs, trends.tolist()))
+
+def batch_indicator_snapshot(stack: dict) -> Dict[str, dict]:
+    """Индикаторные признаки (RSI/ATR/Bollinger) последнего бара для всех пар сразу"""
+    close, high, low = stack['close'], stack['high'], stack['low']
+    rsi_14 = batch_rsi(close, 14)[:, -1]
+    rsi_21 = batch_rsi(close, 21)[:, -1]
+    atr = batch_atr(high, low, close, 14)
+    atr_last = atr[:, -1]
+    atr_ma_50 = atr[:, -50:].mean(axis=1) if atr.shape[1] >= 50 else np.full(len(close), np.nan)
+    bb_u, _, bb_l = batch_bbands(close, 20)
+
+    snapshot = {}
+    for i, pair in enumerate(stack['pairs']):
+        rng = bb_u[i, -1] - bb_l[i, -1]
+        snapshot[pair] = {
+            'rsi_14': float(rsi_14[i]) if not np.isnan(rsi_14[i]) else 50.0,
+            'rsi_21': float(rsi_21[i]) if not np.isnan(rsi_21[i]) else 50.0,
+            'atr': float(atr_last[i]) if not np.isnan(atr_last[i]) else 0.0,
+            'atr_ratio': float(atr_last[i] / atr_ma_50[i]) if not np.isnan(atr_ma_50[i]) else 1.0,
+            'bb_position': float((close[i, -1] - bb_l[i, -1]) / max(1e-9, rng)) if not np.isnan(rng) else 0.5,
+        }
+    return snapshot
+
+# ---- Снимок вселенной пар на текущий цикл сканирования ----
+UNIVERSE_TIMEFRAMES = {
+    "M1": (400, mt5.TIMEFRAME_M1),
+    "M5": (200, mt5.TIMEFRAME_M5),
+    "M15": (100, mt5.TIMEFRAME_M15),
+    "M30": (80, mt5.TIMEFRAME_M30),
+}
+UNIVERSE_SNAPSHOT: Dict[str, dict] = {}
+# Сколько секунд кадры снимка считаются кадрами текущего цикла (цикл авто-трейдинга — 90 сек)
+UNIVERSE_FRAME_MAX_AGE_SEC = float(os.getenv("UNIVERSE_FRAME_MAX_AGE_SEC", "45"))
+
+def refresh_universe_snapshot(pairs: Optional[List[str]] = None) -> Dict[str, dict]:
+    """
+    Один раз за цикл считает тренды и индикаторы всех пар батчем (вместо 21× TA-Lib на пару).
+    Загруженные кадры остаются в снимке: analyze_pair берёт именно их, поэтому окно
+    (вместе с формирующимся баром) совпадает со снимком и MT5 опрашивается один раз за цикл.
+    """
+    global UNIVERSE_SNAPSHOT
+    pairs = list(pairs or PAIRS)
+    started = datetime.now()
+    snapshot = {}
+    m1_frames = {}
+    for tf_name, (n_bars, timeframe) in UNIVERSE_TIMEFRAMES.items():
+        try:
+            frames = {p: get_mt5_data(p, n_bars, timeframe) for p in pairs}
+            taken_at = monotonic()
+            stacks = stack_pair_frames(frames, n_bars)
+            if not stacks:
+                continue
+            entry = {'stamps': {}, 'trend': {}, 'frames': frames, 'taken_at': taken_at}
+            for stack in stacks:
+                entry['stamps'].update(stack['stamps'])
+                entry['trend'].update(batch_analyze_trend(stack))
+            if tf_name == "M1":
+                # индикаторы — для ML-признаков, а они считаются по закрытым барам (ml_feature_window)
+                closed_stacks = stack_pair_frames(
+                    {p: ml_feature_window(df) for p, df in frames.items() if df is not None}, n_bars - 1)
+                if closed_stacks:
+                    entry['closed_stamps'], entry['indicators'] = {}, {}
+                    for closed in closed_stacks:
+                        entry['closed_stamps'].update(closed['stamps'])
+                        entry['indicators'].update(batch_indicator_snapshot(closed))
+                m1_frames = frames
+            snapshot[tf_name] = entry
+        except Exception as e:
+            logging.error(f"❌ Ошибка батч-индикаторов {tf_name}: {e}")
+    UNIVERSE_SNAPSHOT = snapshot
+    # 📦 ML-вероятности всех пар одной матрицей (по тем же окнам M1)
+    if ML_ENABLED:
+        refresh_scan_predictions(m1_frames)
+    elapsed = (datetime.now() - started).total_seconds()
+    logging.info(f"🧮 Снимок вселенной: {len(pairs)} пар × {len(snapshot)} ТФ за {elapsed:.2f} сек")
+    return snapshot
+
+def get_cycle_frame(pair: str, timeframe: str) -> Optional[pd.DataFrame]:
+    """Кадр пары из снимка текущего цикла; нет снимка или он устарел — свежая загрузка из MT5"""
+    entry = UNIVERSE_SNAPSHOT.get(timeframe)
+    if entry is not None and monotonic() - entry['taken_at'] <= UNIVERSE_FRAME_MAX_AGE_SEC:
+        df = entry['frames'].get(pair)
+        if df is not None:
+            return df
+    n_bars, mt5_timeframe = UNIVERSE_TIMEFRAMES[timeframe]
+    return get_mt5_data(pair, n_bars, mt5_timeframe)
+
+def _universe_entry(pair: str, timeframe: str, df: pd.DataFrame) -> Optional[dict]:
+    """Запись снимка, если она посчитана ровно на этом окне df"""
+    entry = UNIVERSE_SNAPSHOT.get(timeframe)
+    if entry is None or df is None or len(df) == 0:
+        return None
+    if entry['stamps'].get(pair) != _bar_stamp(df):
+        return None
+    return entry
+
+def get_universe_trend(pair: str, timeframe: str, df: pd.DataFrame) -> str:
+    """Тренд из батч-снимка; если окно изменилось — обычный analyze_trend"""
+    entry = _universe_entry(pair, timeframe, df)
+    if entry is not None:
+        return entry['trend'][pair]
+    return analyze_trend(df, timeframe)
+
+def get_universe_indicators(pair: str, df: pd.DataFrame) -> Optional[dict]:
+    """Батч-индикаторы M1 для пары, если снимок посчитан ровно на этом окне закрытых баров df"""
+    entry = UNIVERSE_SNAPSHOT.get("M1")
+    if entry is None or 'indicators' not in entry or df is None or len(df) == 0:
+        return None
+    if entry['closed_stamps'].get(pair) != _bar_stamp(df):
+        return None
+    return entry['indicators'].get(pair)
+
 # ===================== ML (SAFE + DYNAMIC FEATURES) =====================
 import os
 import json
@@ -1827,18 +2544,74 @@ def _safe_json_load(path: str):
     except Exception:
         return None
 
+# ---- Запись истории: read-modify-write под межпроцессной блокировкой ----
+# Пишут и бот, и процесс обучения, поэтому одного threading.Lock мало: нужен lock-файл
+# (O_CREAT|O_EXCL работает и на Windows, в отличие от fcntl)
+from contextlib import contextmanager
+from time import sleep
+
+ML_INFO_LOCK_PATH = ML_INFO_PATH + ".lock"
+ML_INFO_LOCK_TIMEOUT_SEC = 10.0
+ML_INFO_LOCK_STALE_SEC = 60.0   # lock-файл старше — остался от упавшего процесса
+_ML_INFO_THREAD_LOCK = threading.Lock()
+
+@contextmanager
+def _ml_info_lock():
+    """Эксклюзивный доступ к ml_info.json для всех потоков и процессов бота"""
+    with _ML_INFO_THREAD_LOCK:
+        deadline = monotonic() + ML_INFO_LOCK_TIMEOUT_SEC
+        while True:
+            try:
+                fd = os.open(ML_INFO_LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if datetime.now().timestamp() - os.path.getmtime(ML_INFO_LOCK_PATH) > ML_INFO_LOCK_STALE_SEC:
+                        os.remove(ML_INFO_LOCK_PATH)
+                        logging.warning(f"⚠️ Снят зависший {ML_INFO_LOCK_PATH}")
+                        continue
+                except FileNotFoundError:
+                    continue
+                if monotonic() > deadline:
+                    raise TimeoutError(f"{ML_INFO_LOCK_PATH} занят дольше {ML_INFO_LOCK_TIMEOUT_SEC:.0f} сек")
+                sleep(0.05)
+        try:
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            yield
+        finally:
+            try:
+                os.remove(ML_INFO_LOCK_PATH)
+            except FileNotFoundError:
+                pass
+
 def _append_ml_info(entry: Dict):
     """История обучений как список."""
     try:
-        data = _safe_json_load(ML_INFO_PATH)
-        if isinstance(data, list):
-            data.append(entry)
-        elif isinstance(data, dict):
-            data = [data, entry]
-        else:
-            data = [entry]
-        with open(ML_INFO_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with _ml_info_lock():
+            data = _safe_json_load(ML_INFO_PATH)
+            if isinstance(data, list):
+                data.append(entry)
+            elif isinstance(data, dict):
+                data = [data, entry]
+            else:
+                data = [entry]
+            _write_json_atomic(ML_INFO_PATH, data)
+    except Exception as e:
+        logging.error(f"⚠️ Не удалось обновить {ML_INFO_PATH}: {e}")
+
+def _update_ml_info_entry(version: str, patch: Dict):
+    """Дополняет запись истории обучений с указанной версией модели."""
+    try:
+        with _ml_info_lock():
+            data = _safe_json_load(ML_INFO_PATH)
+            if not isinstance(data, list):
+                return
+            for entry in reversed(data):
+                if isinstance(entry, dict) and entry.get("version") == version:
+                    entry.update(patch)
+                    break
+            _write_json_atomic(ML_INFO_PATH, data)
     except Exception as e:
         logging.error(f"⚠️ Не удалось обновить {ML_INFO_PATH}: {e}")
 
@@ -1865,236 +2638,669 @@ def _get_expected_feature_list() -> List[str]:
         return info["feature_names"]
     return _load_selected_features_fallback()
 
+def _model_feature_names() -> List[str]:
+    """Признаки активной модели (схема из реестра), иначе — из model_info/файлов артефактов."""
+    active = ML_ACTIVE
+    if active is not None:
+        return active['feature_names']
+    info = model_info if isinstance(model_info, dict) else {}
+    return info.get("feature_names") or _get_expected_feature_list()
+
+# ===================== 🧭 СХЕМА ПРИЗНАКОВ МОДЕЛИ (ИНДЕКСНАЯ КАРТА) =====================
+# Живые признаки приводятся к сохранённой схеме модели: перестановка колонок,
+# значения по умолчанию для отсутствующих, отбрасывание лишних. Скейлер не трогаем.
+SCHEMA_METRICS = {'rows': 0, 'mismatched_rows': 0, 'missing': 0, 'extra': 0, 'rejected_models': 0}
+
+def count_schema_row(n_missing: int, n_extra: int = 0) -> None:
+    SCHEMA_METRICS['rows'] += 1
+    if n_missing or n_extra:
+        SCHEMA_METRICS['mismatched_rows'] += 1
+        SCHEMA_METRICS['missing'] += n_missing
+        SCHEMA_METRICS['extra'] += n_extra
+
+class FeatureSchemaMap:
+    """Индексная карта источник → схема модели; строится один раз на пару списков имён"""
+
+    def __init__(self, source_names: List[str], schema_names: List[str]):
+        self.source_names = list(source_names)
+        self.schema_names = list(schema_names)
+        source_pos = {}
+        for i, name in enumerate(self.source_names):
+            source_pos.setdefault(name, i)
+
+        dst, src = [], []
+        for col, name in enumerate(self.schema_names):
+            if name in source_pos:
+                dst.append(col)
+                src.append(source_pos[name])
+        self.dst = np.asarray(dst, dtype=np.intp)
+        self.src = np.asarray(src, dtype=np.intp)
+
+        schema_set = set(self.schema_names)
+        self.missing = [name for name in self.schema_names if name not in source_pos]
+        self.extra = [name for name in self.source_names if name not in schema_set]
+
+        # Отсутствующие → значение по умолчанию из реестра признаков (неизвестные → 0.0)
+        self.template = np.zeros(len(self.schema_names), dtype=np.float64)
+        for col, name in enumerate(self.schema_names):
+            if name in FEATURE_INDEX:
+                group, pos = FEATURE_INDEX[name]
+                self.template[col] = float(FEATURE_GROUPS[group]['defaults'][pos])
+
+    def map_values(self, values) -> np.ndarray:
+        """Значения в порядке source_names → вектор в порядке схемы модели"""
+        values = np.asarray(values, dtype=np.float64)
+        out = self.template.copy()
+        out[self.dst] = values[self.src]
+        bad = np.isnan(out)
+        out[bad] = self.template[bad]
+
+        count_schema_row(len(self.missing), len(self.extra))
+        return out
+
+SCHEMA_MAPS = {}
+
+def get_schema_map(source_names: List[str], schema_names: List[str]) -> FeatureSchemaMap:
+    key = (tuple(source_names), tuple(schema_names))
+    schema_map = SCHEMA_MAPS.get(key)
+    if schema_map is None:
+        if len(SCHEMA_MAPS) >= 64:
+            SCHEMA_MAPS.clear()
+        schema_map = FeatureSchemaMap(source_names, schema_names)
+        SCHEMA_MAPS[key] = schema_map
+        if schema_map.missing or schema_map.extra:
+            logging.warning(f"🧭 Схема модели: нет {len(schema_map.missing)} признаков {schema_map.missing[:10]}, "
+                            f"лишних {len(schema_map.extra)} {schema_map.extra[:10]}")
+    return schema_map
+
 def _vectorize_for_inference(ml_features: Dict[str, float], expected_features: List[str]) -> np.ndarray:
-    """Собираем строку фич в точном порядке expected_features; отсутствующие → 0.0."""
-    row = [float(ml_features.get(f, 0.0)) for f in expected_features]
-    return np.asarray([row], dtype=float)
+    """Строка фич (1, n) в точном порядке expected_features через индексную карту схемы."""
+    schema_map = get_schema_map(list(ml_features), expected_features)
+    return schema_map.map_values([float(v) for v in ml_features.values()]).reshape(1, -1)
 
 def load_ml_artifacts() -> bool:
-    """Грузим модель, скейлер и последнюю запись model_info."""
-    global ml_model, ml_scaler, model_info
+    """Синхронно загружает активную версию из реестра (старт бота, ручные команды)."""
     try:
-        if os.path.exists(ML_MODEL_PATH) and os.path.exists(ML_SCALER_PATH):
-            ml_model = joblib.load(ML_MODEL_PATH)
-            ml_scaler = joblib.load(ML_SCALER_PATH)
-        else:
-            logging.warning("⚠️ ML артефакты не найдены. Обучите модель.")
-            return False
+        refresh_active_model()
+        return ML_ACTIVE is not None
+    except Exception as e:
+        logging.error(f"❌ Ошибка загрузки ML артефактов: {e}", exc_info=True)
+        return False
 
-        info = _safe_json_load(ML_INFO_LAST)
-        if info is None:
-            data = _safe_json_load(ML_INFO_PATH)
-            if isinstance(data, list) and data:
-                info = data[-1]
-            elif isinstance(data, dict):
-                info = data
-        model_info = info or {}
-        if not isinstance(model_info.get("feature_names", None), list):
-            # всё равно дадим шанс инференсу через pkl-список
-            model_info["feature_names"] = _load_selected_features_fallback()
+# ===================== 🗂 РЕЕСТР ВЕРСИЙ МОДЕЛИ (models/<version>/ + MANIFEST) =====================
+# Версия — неизменяемая папка models/<version>/ с model.pkl, scaler.pkl, info.json.
+# MANIFEST.json указывает на активную версию и переписывается атомарно (tmp + os.replace).
+# В памяти активна одна связка (модель, скейлер, схема признаков): меняется одним присваиванием,
+# поэтому инференс берёт её снимок и никогда не видит смесь двух версий и не ждёт диск.
+import shutil
+
+ML_MODELS_DIR = os.getenv("ML_MODELS_DIR", "models")
+ML_MANIFEST_PATH = os.path.join(ML_MODELS_DIR, "MANIFEST.json")
+ML_REGISTRY_POLL_SEC = int(os.getenv("ML_REGISTRY_POLL_SEC", "60"))
+ML_REGISTRY_KEEP = int(os.getenv("ML_REGISTRY_KEEP", "10"))  # сколько версий хранить на диске
+
+ML_ACTIVE: Optional[dict] = None
+_ML_SWAP_LOCK = threading.Lock()
+
+def _write_json_atomic(path: str, data) -> None:
+    """JSON через временный файл + os.replace: читатель видит либо старый, либо новый файл"""
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_model_manifest() -> Dict:
+    data = _safe_json_load(ML_MANIFEST_PATH)
+    return data if isinstance(data, dict) else {}
+
+def get_active_model() -> Optional[dict]:
+    """Снимок активной связки {version, model, scaler, info, feature_names, forest} или None"""
+    return ML_ACTIVE
+
+def make_model_bundle(version: str, model, scaler, info: Dict, distilled: Optional[dict] = None) -> dict:
+    """Связка для инференса; лес компилируется здесь, а не на горячем пути"""
+    info = dict(info or {})
+    feature_names = info.get("feature_names")
+    if not isinstance(feature_names, list) or not feature_names:
+        feature_names = _load_selected_features_fallback()
+        info["feature_names"] = feature_names
+    # Схема обязана совпадать со скейлером — иначе версия не активируется (никаких переобучений скейлера)
+    n_in = getattr(scaler, "n_features_in_", None)
+    if n_in is not None and n_in != len(feature_names):
+        SCHEMA_METRICS['rejected_models'] += 1
+        raise ValueError(f"версия {version}: скейлер ждёт {n_in} признаков, схема содержит {len(feature_names)}")
+    pin_inference_threads(model)
+    return {
+        'version': version,
+        'model': model,
+        'scaler': scaler,
+        'info': info,
+        'feature_names': list(feature_names),
+        'forest': build_fast_forest(model, scaler),
+        'distilled': distilled
+    }
 
-        logging.info("✅ ML артефакты загружены")
-        return True
+def activate_model_bundle(bundle: dict) -> None:
+    """Атомарная подмена активной связки (и совместимых глобалов ml_model/ml_scaler/model_info)"""
+    global ML_ACTIVE, ml_model, ml_scaler, model_info
+    with _ML_SWAP_LOCK:
+        previous = ML_ACTIVE['version'] if ML_ACTIVE else None
+        ML_ACTIVE = bundle
+        ml_model, ml_scaler, model_info = bundle['model'], bundle['scaler'], bundle['info']
+    logging.info(f"🗂 Активная ML модель: {bundle['version']} (была {previous or '—'}), "
+                 f"{len(bundle['feature_names'])} признаков")
+
+def load_model_bundle(version: str) -> dict:
+    version_dir = os.path.join(ML_MODELS_DIR, version)
+    model = joblib.load(os.path.join(version_dir, "model.pkl"))
+    scaler = joblib.load(os.path.join(version_dir, "scaler.pkl"))
+    info = _safe_json_load(os.path.join(version_dir, "info.json")) or {}
+    distilled_path = os.path.join(version_dir, "distilled.pkl")
+    distilled = joblib.load(distilled_path) if os.path.exists(distilled_path) else None
+    return make_model_bundle(version, model, scaler, info, distilled)
+
+def _new_model_version() -> str:
+    base = datetime.now().strftime("%Y%m%d_%H%M%S")
+    version, n = base, 1
+    while os.path.exists(os.path.join(ML_MODELS_DIR, version)):
+        n += 1
+        version = f"{base}_{n}"
+    return version
+
+def _prune_model_versions(keep: int = ML_REGISTRY_KEEP) -> None:
+    """Удаляет старые версии, кроме активной и предыдущей (для отката)"""
+    try:
+        manifest = read_model_manifest()
+        protected = {manifest.get("active"), manifest.get("previous")}
+        versions = sorted(
+            d for d in os.listdir(ML_MODELS_DIR)
+            if not d.startswith(".") and os.path.isdir(os.path.join(ML_MODELS_DIR, d))
+        )
+        for version in versions[:-keep] if keep > 0 else []:
+            if version not in protected:
+                shutil.rmtree(os.path.join(ML_MODELS_DIR, version), ignore_errors=True)
     except Exception as e:
-        logging.error(f"❌ Ошибка загрузки ML артефактов: {e}", exc_info=True)
+        logging.warning(f"⚠️ Не удалось почистить старые версии моделей: {e}")
+
+def set_active_version(version: str) -> None:
+    """Переключает MANIFEST на опубликованную версию (процессы подхватят её refresh_active_model)"""
+    _write_json_atomic(ML_MANIFEST_PATH, {
+        "active": version,
+        "previous": read_model_manifest().get("active"),
+        "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    })
+
+def publish_model_version(model, scaler, info: Dict, activate: bool = True,
+                          extras: Optional[Dict] = None) -> str:
+    """
+    Пишет версию во временную папку, переименовывает в models/<version>/
+    и (если activate) переключает MANIFEST на неё. extras — доп. артефакты (<имя>.pkl).
+    Возвращает имя версии.
+    """
+    os.makedirs(ML_MODELS_DIR, exist_ok=True)
+    version = _new_model_version()
+    tmp_dir = os.path.join(ML_MODELS_DIR, f".tmp-{version}")
+    os.makedirs(tmp_dir)
+    try:
+        joblib.dump(model, os.path.join(tmp_dir, "model.pkl"))
+        joblib.dump(scaler, os.path.join(tmp_dir, "scaler.pkl"))
+        for name, obj in (extras or {}).items():
+            if obj is not None:
+                joblib.dump(obj, os.path.join(tmp_dir, f"{name}.pkl"))
+        with open(os.path.join(tmp_dir, "info.json"), "w", encoding="utf-8") as f:
+            json.dump(dict(info or {}, version=version), f, ensure_ascii=False, indent=2)
+        os.rename(tmp_dir, os.path.join(ML_MODELS_DIR, version))
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    if activate:
+        set_active_version(version)
+    _prune_model_versions()
+    logging.info(f"🗂 Опубликована версия модели {version}{' (активна)' if activate else ''}")
+    return version
+
+def _import_legacy_artifacts() -> bool:
+    """Разовый перенос ml_model.pkl/ml_scaler.pkl из корня в реестр"""
+    if not (os.path.exists(ML_MODEL_PATH) and os.path.exists(ML_SCALER_PATH)):
         return False
+    info = _safe_json_load(ML_INFO_LAST)
+    if info is None:
+        data = _safe_json_load(ML_INFO_PATH)
+        if isinstance(data, list) and data:
+            info = data[-1]
+        elif isinstance(data, dict):
+            info = data
+    model = joblib.load(ML_MODEL_PATH)
+    scaler = joblib.load(ML_SCALER_PATH)
+    publish_model_version(model, scaler, info or {})
+    logging.info("🗂 Артефакты из корня перенесены в реестр версий")
+    return True
+
+def refresh_active_model(force: bool = False) -> bool:
+    """
+    Сверяет MANIFEST с активной версией и при расхождении грузит новую связку
+    (вызывается при старте и фоновой задачей, не из анализа пар). True — если была подмена.
+    """
+    manifest = read_model_manifest()
+    if not manifest.get("active"):
+        if not _import_legacy_artifacts():
+            if ML_ACTIVE is None:
+                logging.warning("⚠️ ML артефакты не найдены. Обучите модель.")
+            return False
+        manifest = read_model_manifest()
 
-# ===================== ПОДГОТОВКА ФИЧЕЙ (твоя расширенная версия) =====================
-def prepare_ml_features(df):
-    """Готовит полный словарь из 50+ ML-признаков для сделки и обучения (адаптировано)."""
+    version = manifest["active"]
+    active = ML_ACTIVE
+    if not force and active is not None and active['version'] == version:
+        return False
+    activate_model_bundle(load_model_bundle(version))
+    return True
+
+# ===================== 🧩 РЕЕСТР ML-ПРИЗНАКОВ (ЗАВИСИМОСТИ + ПЛАН) =====================
+# Артефакт — общий промежуточный результат (индикаторы, SMC, время свечи).
+# Группа — набор признаков с объявленными зависимостями и значениями по умолчанию.
+# Порядок регистрации групп = порядок ключей prepare_ml_features.
+FEATURE_ARTIFACTS = {}
+FEATURE_GROUPS = {}
+FEATURE_INDEX = {}  # признак → (группа, позиция в группе)
+
+def feature_artifact(name: str):
+    """Регистрирует артефакт, который группы признаков объявляют в deps"""
+    def decorator(func):
+        FEATURE_ARTIFACTS[name] = func
+        return func
+    return decorator
+
+def feature_group(name: str, features: Tuple[str, ...], defaults, deps: Tuple[str, ...] = ()):
+    """Регистрирует группу признаков: func(ctx) возвращает значения в порядке features"""
+    if not isinstance(defaults, (tuple, list)):
+        defaults = (defaults,) * len(features)
+
+    def decorator(func):
+        if name in FEATURE_ARTIFACTS:
+            raise ValueError(f"Имя группы признаков совпадает с артефактом: {name}")
+        FEATURE_GROUPS[name] = {
+            'name': name,
+            'features': tuple(features),
+            'defaults': tuple(defaults),
+            'deps': tuple(deps),
+            'func': func
+        }
+        for pos, feature in enumerate(features):
+            FEATURE_INDEX[feature] = (name, pos)
+        return func
+    return decorator
+
+def _run_feature_group(group: dict, ctx) -> tuple:
+    """Считает группу; при любой ошибке — значения по умолчанию, как в старых try/except"""
     try:
-        if df is None or len(df) < 100:
-            return None
+        for dep in group['deps']:
+            ctx.get(dep)
+        values = tuple(group['func'](ctx))
+        if len(values) != len(group['features']):
+            raise ValueError(f"ожидалось {len(group['features'])} значений, получено {len(values)}")
+        return values
+    except Exception as e:
+        logging.debug(f"Группа признаков {group['name']}: {e}")
+        return group['defaults']
+
+# ---- Бар признаков ML ----
+# Признаки ML считаются на последнем ЗАКРЫТОМ баре M1: формирующийся бар в истории MT5
+# не восстановить (бэкфилл видит только закрытые бары), поэтому онлайн он тоже не входит в окно.
+# Одно определение бара для инференса, записи ml_features сделки и бэкфилла.
+def ml_feature_window(df: pd.DataFrame) -> pd.DataFrame:
+    """Окно признаков ML: кадр MT5 без последнего (формирующегося) бара"""
+    return df.iloc[:-1]
+
+class FeatureContext:
+    """
+    Контекст расчёта признаков для одного окна свечей: артефакты и группы
+    считаются лениво и один раз, сколько бы признаков их ни использовало.
+    """
 
-        close, high, low, volume = df['close'], df['high'], df['low'], df['tick_volume']
-        features = {}
+    def __init__(self, df: pd.DataFrame, pair: Optional[str] = None):
+        self.df = df
+        self.pair = pair
+        self.close = df['close']
+        self.high = df['high']
+        self.low = df['low']
+        self.volume = df['tick_volume']
+        self._cache = {}
+
+    def get(self, name: str):
+        """Артефакт или результат группы признаков по имени"""
+        if name not in self._cache:
+            if name in FEATURE_ARTIFACTS:
+                self._cache[name] = FEATURE_ARTIFACTS[name](self)
+            else:
+                self._cache[name] = _run_feature_group(FEATURE_GROUPS[name], self)
+        return self._cache[name]
+
+    def value(self, feature: str):
+        """Сырое значение признака (до очистки NaN)"""
+        group, pos = FEATURE_INDEX[feature]
+        return self.get(group)[pos]
+
+class FeaturePlan:
+    """
+    Скомпилированный план: для каждой нужной группы — позиции её значений
+    и колонки в векторе модели. Неизвестные признаки остаются 0.0.
+    """
 
-        # Базовые
-        features['price'] = float(close.iloc[-1])
-        features['volume'] = float(volume.iloc[-1]) if not volume.isna().all() else 0.0
-
-        # RSI
-        for period in [14, 21]:
-            rsi = ta.RSI(close, timeperiod=period)
-            features[f'rsi_{period}'] = float(rsi.iloc[-1]) if len(close) >= period and not rsi.isna().all() else 50.0
-
-        # ATR + ratio
-        atr = ta.ATR(high, low, close, timeperiod=14)
-        if len(close) >= 14 and not atr.isna().all():
-            features['atr'] = float(atr.iloc[-1])
-            atr_50 = atr.rolling(50).mean()
-            features['atr_ratio'] = float(atr.iloc[-1] / atr_50.iloc[-1]) if len(atr_50) > 0 and not pd.isna(atr_50.iloc[-1]) else 1.0
+    def __init__(self, feature_names: List[str]):
+        self.feature_names = list(feature_names)
+        self.n_features = len(self.feature_names)
+        self.missing = [f for f in self.feature_names if f not in FEATURE_INDEX]
+
+        by_group = {}
+        for col, feature in enumerate(self.feature_names):
+            if feature in FEATURE_INDEX:
+                group, pos = FEATURE_INDEX[feature]
+                by_group.setdefault(group, ([], []))
+                by_group[group][0].append(pos)
+                by_group[group][1].append(col)
+
+        # Группы — в порядке регистрации, чтобы побочные эффекты шли как раньше
+        self.steps = [
+            (group, np.asarray(by_group[group][0], dtype=np.intp), np.asarray(by_group[group][1], dtype=np.intp))
+            for group in FEATURE_GROUPS if group in by_group
+        ]
+        self.groups = [group for group, _, _ in self.steps]
+
+        # Что НЕ считается для этой модели (группы целиком вне плана)
+        self.skipped_groups = [group for group in FEATURE_GROUPS if group not in by_group]
+        self.skipped_features = [f for group in self.skipped_groups for f in FEATURE_GROUPS[group]['features']]
+
+    def execute(self, ctx: FeatureContext, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Пишет признаки прямо в float64-вектор в порядке колонок модели"""
+        if out is None:
+            out = np.zeros(self.n_features, dtype=np.float64)
         else:
-            features['atr'] = 0.0
-            features['atr_ratio'] = 1.0
+            out.fill(0.0)
+        for group, positions, columns in self.steps:
+            values = np.asarray(ctx.get(group), dtype=np.float64)
+            out[columns] = values[positions]
+        out[np.isnan(out)] = 0.0
+        return out
+
+FEATURE_PLANS = {}
+
+def get_feature_plan(feature_names: List[str]) -> FeaturePlan:
+    """План компилируется один раз на список признаков модели"""
+    key = tuple(feature_names)
+    plan = FEATURE_PLANS.get(key)
+    if plan is None:
+        if len(FEATURE_PLANS) >= 16:
+            FEATURE_PLANS.clear()
+        plan = FeaturePlan(feature_names)
+        FEATURE_PLANS[key] = plan
+        logging.info(f"🧩 План признаков: {plan.n_features} признаков, групп {len(plan.groups)}/{len(FEATURE_GROUPS)}; "
+                     f"не считаются {len(plan.skipped_features)}: {plan.skipped_features}")
+        if plan.missing:
+            logging.warning(f"⚠️ План признаков: нет в реестре {len(plan.missing)} шт. (будут 0.0): {plan.missing[:10]}")
+    return plan
+
+def build_feature_vector(df, feature_names: List[str], pair: Optional[str] = None,
+                         ctx: Optional[FeatureContext] = None) -> Optional[np.ndarray]:
+    """Вектор признаков (1, n) в порядке feature_names без промежуточного словаря"""
+    if df is None or len(df) < 100:
+        return None
+    ctx = ctx or FeatureContext(df, pair)
+    return get_feature_plan(feature_names).execute(ctx).reshape(1, -1)
+
+# ---- Артефакты ----
+@feature_artifact('stream')
+def _artifact_stream(ctx):
+    # отдельный поток: окно признаков кончается закрытым баром, а не формирующимся, как в анализе тренда
+    return get_streaming_indicators(ctx.pair, ctx.df, "M1_CLOSED") if ctx.pair else None
+
+@feature_artifact('batched')
+def _artifact_batched(ctx):
+    return get_universe_indicators(ctx.pair, ctx.df) if ctx.pair else None
+
+@feature_artifact('candles')
+def _artifact_candles(ctx):
+    return detect_candle_patterns(ctx.df.iloc[-4:])
+
+@feature_artifact('smc')
+def _artifact_smc(ctx):
+    df = ctx.df
+    return {
+        'zones': find_supply_demand_zones(df),
+        'structure': find_market_structure(df),
+        'order_blocks': calculate_order_blocks_advanced(df),
+        'fibonacci': calculate_fibonacci_levels(df),
+        'pa_patterns': price_action_patterns(df)
+    }
 
-        # OBV + тренд
-        try:
-            obv = ta.OBV(close, volume)
-            features['obv'] = float(obv.iloc[-1]) if not obv.isna().all() else 0.0
-            features['obv_trend'] = float(obv.diff(5).iloc[-1]) if len(obv) > 5 and not pd.isna(obv.diff(5).iloc[-1]) else 0.0
-        except Exception:
-            features['obv'] = 0.0
-            features['obv_trend'] = 0.0
+@feature_artifact('round_levels')
+def _artifact_round_levels(ctx):
+    return detect_round_levels(ctx.close.iloc[-1], pair=ctx.pair)
+
+@feature_artifact('horizontal_levels')
+def _artifact_horizontal_levels(ctx):
+    return find_horizontal_levels(ctx.df)
+
+@feature_artifact('candle_time')
+def _artifact_candle_time(ctx):
+    return get_candle_time_info()
+
+# ---- Группы признаков ----
+@feature_group('base', ('price', 'volume'), 0.0)
+def _fg_base(ctx):
+    volume = ctx.volume
+    return (float(ctx.close.iloc[-1]), float(volume.iloc[-1]) if not volume.isna().all() else 0.0)
+
+@feature_group('rsi_atr', ('rsi_14', 'rsi_21', 'atr', 'atr_ratio'), (50.0, 50.0, 0.0, 1.0), deps=('batched',))
+def _fg_rsi_atr(ctx):
+    batched = ctx.get('batched')
+    close, high, low = ctx.close, ctx.high, ctx.low
+
+    if batched is not None:
+        # 🧮 Батч-снимок вселенной (посчитан один раз за цикл для всех пар)
+        return tuple(batched[key] for key in ('rsi_14', 'rsi_21', 'atr', 'atr_ratio'))
+
+    # поток трогаем только без батч-снимка
+    stream = ctx.get('stream')
+
+    if stream is not None:
+        # ⚡ Потоковые значения (TA-Lib на окне, пересев каждые STREAM_RESEED_BARS)
+        rsi_values = [float(stream[f'rsi_{p}']) if stream[f'rsi_{p}'] is not None else 50.0 for p in (14, 21)]
+        if stream['atr'] is not None:
+            atr_value = float(stream['atr'])
+            atr_ratio = float(stream['atr'] / stream['atr_ma_50']) if stream['atr_ma_50'] is not None else 1.0
+        else:
+            atr_value, atr_ratio = 0.0, 1.0
+        return (*rsi_values, atr_value, atr_ratio)
+
+    # RSI
+    rsi_values = []
+    for period in [14, 21]:
+        rsi = ta.RSI(close, timeperiod=period)
+        rsi_values.append(float(rsi.iloc[-1]) if len(close) >= period and not rsi.isna().all() else 50.0)
+
+    # ATR + ratio
+    atr = ta.ATR(high, low, close, timeperiod=14)
+    if len(close) >= 14 and not atr.isna().all():
+        atr_50 = atr.rolling(50).mean()
+        atr_value = float(atr.iloc[-1])
+        atr_ratio = float(atr.iloc[-1] / atr_50.iloc[-1]) if len(atr_50) > 0 and not pd.isna(atr_50.iloc[-1]) else 1.0
+    else:
+        atr_value, atr_ratio = 0.0, 1.0
+    return (*rsi_values, atr_value, atr_ratio)
+
+@feature_group('obv_adx', ('obv', 'obv_trend', 'adx'), 0.0, deps=('stream',))
+def _fg_obv_adx(ctx):
+    stream = ctx.get('stream')
+    close, high, low = ctx.close, ctx.high, ctx.low
+
+    if stream is not None:
+        return (
+            float(stream['obv']) if stream['obv'] is not None else 0.0,
+            float(stream['obv_trend']) if stream['obv_trend'] is not None else 0.0,
+            float(stream['adx']) if stream['adx'] is not None else 0.0
+        )
 
-        features['adx'] = float(ta.ADX(high, low, close, timeperiod=14).iloc[-1]) if len(close) >= 14 else 0.0
+    # OBV + тренд
+    try:
+        obv = ta.OBV(close, ctx.volume)
+        obv_value = float(obv.iloc[-1]) if not obv.isna().all() else 0.0
+        obv_trend = float(obv.diff(5).iloc[-1]) if len(obv) > 5 and not pd.isna(obv.diff(5).iloc[-1]) else 0.0
+    except Exception:
+        obv_value, obv_trend = 0.0, 0.0
 
-        # Изменения цены
-        for period in [15, 30, 60]:
-            if len(close) >= period:
-                features[f'price_change_{period}m'] = float((close.iloc[-1] - close.iloc[-period]) / close.iloc[-period] * 100)
-            else:
-                features[f'price_change_{period}m'] = 0.0
+    adx = float(ta.ADX(high, low, close, timeperiod=14).iloc[-1]) if len(close) >= 14 else 0.0
+    return (obv_value, obv_trend, adx)
 
-        features['volatility'] = float(close.pct_change().std() * 100)
+@feature_group('price_change', ('price_change_15m', 'price_change_30m', 'price_change_60m'), 0.0)
+def _fg_price_change(ctx):
+    close = ctx.close
+    return tuple(
+        float((close.iloc[-1] - close.iloc[-period]) / close.iloc[-period] * 100) if len(close) >= period else 0.0
+        for period in (15, 30, 60)
+    )
 
-        # MACD
-        try:
-            macd, _, _ = ta.MACD(close, 12, 26, 9)
-            features['macd'] = float(macd.iloc[-1]) if not macd.isna().all() else 0.0
-        except Exception:
-            features['macd'] = 0.0
+@feature_group('volatility', ('volatility',), 0.0)
+def _fg_volatility(ctx):
+    return (float(ctx.close.pct_change().std() * 100),)
+
+@feature_group('macd', ('macd',), 0.0)
+def _fg_macd(ctx):
+    macd, _, _ = ta.MACD(ctx.close, 12, 26, 9)
+    return (float(macd.iloc[-1]) if not macd.isna().all() else 0.0,)
+
+@feature_group('bollinger', ('bb_position',), 0.5, deps=('batched',))
+def _fg_bollinger(ctx):
+    batched = ctx.get('batched')
+    if batched is not None:
+        return (batched['bb_position'],)
+    close = ctx.close
+    bb_u, _, bb_l = ta.BBANDS(close, timeperiod=20)
+    if not bb_u.isna().all() and not bb_l.isna().all():
+        bb_range = bb_u.iloc[-1] - bb_l.iloc[-1]
+        return (float((close.iloc[-1] - bb_l.iloc[-1]) / max(1e-9, bb_range)),)
+    return (0.5,)
+
+@feature_group('candle_patterns', ('bullish_engulfing', 'bearish_engulfing', 'three_white_soldiers'), 0, deps=('candles',))
+def _fg_candle_patterns(ctx):
+    # Векторный детектор, последняя свеча
+    candle = ctx.get('candles')
+    return (
+        int(candle['bullish_engulfing'][-1]),
+        int(candle['bearish_engulfing'][-1]),
+        int(candle['three_white_soldiers'][-1]) if len(ctx.df) >= 4 else 0
+    )
 
-        # Bollinger
-        try:
-            bb_u, _, bb_l = ta.BBANDS(close, timeperiod=20)
-            if not bb_u.isna().all() and not bb_l.isna().all():
-                bb_range = bb_u.iloc[-1] - bb_l.iloc[-1]
-                features['bb_position'] = float((close.iloc[-1] - bb_l.iloc[-1]) / max(1e-9, bb_range))
-            else:
-                features['bb_position'] = 0.5
-        except Exception:
-            features['bb_position'] = 0.5
+@feature_group('daily', ('distance_to_daily_high', 'distance_to_daily_low', 'daily_range_position'), (50.0, 50.0, 0.5))
+def _fg_daily(ctx):
+    # Расстояния до дневных экстремумов
+    close = ctx.close
+    daily_high = ctx.high.tail(1440).max()
+    daily_low = ctx.low.tail(1440).min()
+    rng = daily_high - daily_low
+    return (
+        float((daily_high - close.iloc[-1]) / daily_high * 100) if daily_high > 0 else 50.0,
+        float((close.iloc[-1] - daily_low) / close.iloc[-1] * 100) if close.iloc[-1] > 0 else 50.0,
+        float((close.iloc[-1] - daily_low) / rng) if rng > 0 else 0.5
+    )
 
-        # Свечные паттерны (упрощённо)
-        try:
-            co, ch, cl, cc = df['open'].iloc[-1], df['high'].iloc[-1], df['low'].iloc[-1], df['close'].iloc[-1]
-            po, ph, pl, pc = df['open'].iloc[-2], df['high'].iloc[-2], df['low'].iloc[-2], df['close'].iloc[-2]
-            features['bullish_engulfing'] = int(pc < po and cc > co and co < pc and cc > po)
-            features['bearish_engulfing'] = int(pc > po and cc < co and co > pc and cc < po)
-            if len(df) >= 4:
-                soldiers = all([
-                    df['close'].iloc[-3] > df['open'].iloc[-3],
-                    df['close'].iloc[-2] > df['open'].iloc[-2],
-                    df['close'].iloc[-1] > df['open'].iloc[-1],
-                    df['close'].iloc[-1] > df['close'].iloc[-2],
-                    df['close'].iloc[-2] > df['close'].iloc[-3]
-                ])
-                features['three_white_soldiers'] = int(soldiers)
-            else:
-                features['three_white_soldiers'] = 0
-        except Exception:
-            features['bullish_engulfing'] = 0
-            features['bearish_engulfing'] = 0
-            features['three_white_soldiers'] = 0
+@feature_group('smc_levels', (
+    'smc_zones_count', 'smc_structure_count', 'smc_ob_count', 'smc_fib_count', 'smc_patterns_count',
+    'smc_has_demand_zone', 'smc_has_supply_zone', 'smc_has_bullish_ob', 'smc_has_bearish_ob',
+    'smc_has_engulfing', 'smc_has_pinbar', 'smc_round_distance_pips', 'smc_round_strength'
+), 0, deps=('smc', 'round_levels'))
+def _fg_smc(ctx):
+    smc = ctx.get('smc')
+    round_info = ctx.get('round_levels')
+    zones, order_blocks, pa_patterns = smc['zones'], smc['order_blocks'], smc['pa_patterns']
+    return (
+        len(zones),
+        len(smc['structure']),
+        len(order_blocks),
+        len(smc['fibonacci']),
+        len(pa_patterns),
+        int(any(z['type'] == 'DEMAND' for z in zones)),
+        int(any(z['type'] == 'SUPPLY' for z in zones)),
+        int(any(ob['type'] == 'BULLISH_OB' for ob in order_blocks)),
+        int(any(ob['type'] == 'BEARISH_OB' for ob in order_blocks)),
+        int(any('ENGULFING' in p['type'] for p in pa_patterns)),
+        int(any('PIN' in p['type'] for p in pa_patterns)),
+        float(round_info['distance_pips']),
+        {'WEAK': 0, 'MEDIUM': 1, 'STRONG': 2, 'VERY_STRONG': 3}.get(round_info['strength'], 0)
+    )
 
-        # Расстояния до дневных экстремумов
-        try:
-            daily_high = high.tail(1440).max()
-            daily_low = low.tail(1440).min()
-            features['distance_to_daily_high'] = float((daily_high - close.iloc[-1]) / daily_high * 100) if daily_high > 0 else 50.0
-            features['distance_to_daily_low'] = float((close.iloc[-1] - daily_low) / close.iloc[-1] * 100) if close.iloc[-1] > 0 else 50.0
-            rng = daily_high - daily_low
-            features['daily_range_position'] = float((close.iloc[-1] - daily_low) / rng) if rng > 0 else 0.5
-        except Exception:
-            features['distance_to_daily_high'] = 50.0
-            features['distance_to_daily_low'] = 50.0
-            features['daily_range_position'] = 0.5
+@feature_group('horizontal', (
+    'horizontal_levels_count', 'distance_to_horizontal_level', 'horizontal_level_strength', 'is_near_horizontal_level'
+), (0, 100, 0, 0), deps=('horizontal_levels',))
+def _fg_horizontal(ctx):
+    horizontal_levels = ctx.get('horizontal_levels')
+    if not horizontal_levels:
+        return (len(horizontal_levels), 100, 0, 0)
+    price = ctx.close.iloc[-1]
+    closest_level = min(horizontal_levels, key=lambda x: abs(x['price'] - price))
+    distance = abs(closest_level['price'] - price) * 10000
+    return (len(horizontal_levels), distance, closest_level['touches'], int(distance < 5))
+
+@feature_group('candle_state', (
+    'candle_seconds_remaining', 'candle_seconds_passed', 'candle_completion_percent',
+    'candle_is_beginning', 'candle_is_middle', 'candle_is_ending',
+    'candle_body_size', 'candle_range', 'candle_body_ratio',
+    'early_gap_signal', 'closing_breakout_signal'
+), 0, deps=('candle_time',))
+def _fg_candle_time(ctx):
+    candle_time = ctx.get('candle_time')
+    df = ctx.df
+    current_candle = df.iloc[-1]
+    body_size = abs(current_candle['close'] - current_candle['open'])
+    candle_range = current_candle['high'] - current_candle['low']
+    return (
+        candle_time['seconds_remaining'],
+        candle_time['seconds_passed'],
+        candle_time['completion_percent'],
+        int(candle_time['is_beginning']),
+        int(candle_time['is_middle']),
+        int(candle_time['is_ending']),
+        body_size,
+        candle_range,
+        body_size / max(1e-9, candle_range),
+        int(early_entry_strategy(df, candle_time, {'direction': 'NEUTRAL'})[0]),
+        int(closing_candle_strategy(df, candle_time, {'direction': 'NEUTRAL'})[0])
+    )
 
-        # --- SMC / уровни (требуют твоих функций; оставляем try/except, как у тебя)
-        try:
-            zones = find_supply_demand_zones(df)
-            structure = find_market_structure(df)
-            order_blocks = calculate_order_blocks_advanced(df)
-            fibonacci = calculate_fibonacci_levels(df)
-            pa_patterns = price_action_patterns(df)
-
-            features['smc_zones_count'] = len(zones)
-            features['smc_structure_count'] = len(structure)
-            features['smc_ob_count'] = len(order_blocks)
-            features['smc_fib_count'] = len(fibonacci)
-            features['smc_patterns_count'] = len(pa_patterns)
-
-            features['smc_has_demand_zone'] = int(any(z['type'] == 'DEMAND' for z in zones))
-            features['smc_has_supply_zone'] = int(any(z['type'] == 'SUPPLY' for z in zones))
-            features['smc_has_bullish_ob'] = int(any(ob['type'] == 'BULLISH_OB' for ob in order_blocks))
-            features['smc_has_bearish_ob'] = int(any(ob['type'] == 'BEARISH_OB' for ob in order_blocks))
-            features['smc_has_engulfing'] = int(any('ENGULFING' in p['type'] for p in pa_patterns))
-            features['smc_has_pinbar'] = int(any('PIN' in p['type'] for p in pa_patterns))
-
-            current_price = close.iloc[-1]
-            round_info = detect_round_levels(current_price)
-            features['smc_round_distance_pips'] = float(round_info['distance_pips'])
-            features['smc_round_strength'] = {'WEAK': 0, 'MEDIUM': 1, 'STRONG': 2, 'VERY_STRONG': 3}.get(round_info['strength'], 0)
-        except Exception:
-            for key in [
-                'smc_zones_count','smc_structure_count','smc_ob_count','smc_fib_count','smc_patterns_count',
-                'smc_has_demand_zone','smc_has_supply_zone','smc_has_bullish_ob','smc_has_bearish_ob',
-                'smc_has_engulfing','smc_has_pinbar','smc_round_distance_pips','smc_round_strength'
-            ]:
-                features[key] = 0
-
-        # Горизонтальные уровни
-        try:
-            horizontal_levels = find_horizontal_levels(df)
-            features['horizontal_levels_count'] = len(horizontal_levels)
-            if horizontal_levels:
-                closest_level = min(horizontal_levels, key=lambda x: abs(x['price'] - close.iloc[-1]))
-                features['distance_to_horizontal_level'] = abs(closest_level['price'] - close.iloc[-1]) * 10000
-                features['horizontal_level_strength'] = closest_level['touches']
-                features['is_near_horizontal_level'] = int(features['distance_to_horizontal_level'] < 5)
-            else:
-                features['distance_to_horizontal_level'] = 100
-                features['horizontal_level_strength'] = 0
-                features['is_near_horizontal_level'] = 0
-        except Exception:
-            features['horizontal_levels_count'] = 0
-            features['distance_to_horizontal_level'] = 100
-            features['horizontal_level_strength'] = 0
-            features['is_near_horizontal_level'] = 0
+@feature_group('exhaustion', ('exhaustion_rsi_extreme',), 0, deps=('rsi_atr',))
+def _fg_exhaustion(ctx):
+    rsi_14 = ctx.value('rsi_14')
+    return (int((rsi_14 < 25) or (rsi_14 > 75)),)
 
-        # Время/свечи
-        try:
-            candle_time = get_candle_time_info()
-            features['candle_seconds_remaining'] = candle_time['seconds_remaining']
-            features['candle_seconds_passed'] = candle_time['seconds_passed']
-            features['candle_completion_percent'] = candle_time['completion_percent']
-            features['candle_is_beginning'] = int(candle_time['is_beginning'])
-            features['candle_is_middle'] = int(candle_time['is_middle'])
-            features['candle_is_ending'] = int(candle_time['is_ending'])
-
-            current_candle = df.iloc[-1]
-            features['candle_body_size'] = abs(current_candle['close'] - current_candle['open'])
-            features['candle_range'] = current_candle['high'] - current_candle['low']
-            features['candle_body_ratio'] = features['candle_body_size'] / max(1e-9, features['candle_range'])
-
-            features['early_gap_signal'] = int(early_entry_strategy(df, candle_time, {'direction': 'NEUTRAL'})[0])
-            features['closing_breakout_signal'] = int(closing_candle_strategy(df, candle_time, {'direction': 'NEUTRAL'})[0])
-        except Exception:
-            for key in [
-                'candle_seconds_remaining','candle_seconds_passed','candle_completion_percent',
-                'candle_is_beginning','candle_is_middle','candle_is_ending',
-                'candle_body_size','candle_range','candle_body_ratio',
-                'early_gap_signal','closing_breakout_signal'
-            ]:
-                features[key] = 0
-
-        # Контекст
-        features['exhaustion_rsi_extreme'] = int((features.get('rsi_14', 50) < 25) or (features.get('rsi_14', 50) > 75))
-
-        # Импульс
-        pc_key = 'price_change_15m' if 'price_change_15m' in features else 'price_change_60m'
-        pc = features.get(pc_key, 0.0)
-        if pc == 0 and len(df) >= 15:
-            pc = float((close.iloc[-1] - close.iloc[-15]) / close.iloc[-15] * 100)
-        features['strong_impulse'] = int(abs(pc) > 0.3)
-
-        volume_avg_20 = df['tick_volume'].tail(20).mean() if 'tick_volume' in df.columns else 1
-        current_volume = df['tick_volume'].iloc[-1] if 'tick_volume' in df.columns else 1
-        features['volume_declining'] = int(current_volume < (volume_avg_20 * 0.8))
-
-        features['signal_vs_trend_conflict'] = 0
-        features['signal_vs_rsi_conflict'] = 0
+@feature_group('impulse', ('strong_impulse',), 0, deps=('price_change',))
+def _fg_impulse(ctx):
+    return (int(abs(ctx.value('price_change_15m')) > 0.3),)
+
+@feature_group('volume_context', ('volume_declining',), 0)
+def _fg_volume_context(ctx):
+    volume_avg_20 = ctx.volume.tail(20).mean()
+    return (int(ctx.volume.iloc[-1] < (volume_avg_20 * 0.8)),)
+
+@feature_group('conflicts', ('signal_vs_trend_conflict', 'signal_vs_rsi_conflict'), 0)
+def _fg_conflicts(ctx):
+    return (0, 0)
+
+# ===================== ПОДГОТОВКА ФИЧЕЙ (твоя расширенная версия) =====================
+def prepare_ml_features(df, pair: Optional[str] = None, ctx: Optional[FeatureContext] = None):
+    """Готовит полный словарь из 50+ ML-признаков для сделки и обучения (адаптировано).
+    Признаки считаются группами из FEATURE_GROUPS; переданный ctx переиспользуется
+    для вектора модели (build_feature_vector / FeaturePlan) без повторных расчётов."""
+    try:
+        if df is None or len(df) < 100:
+            return None
+
+        ctx = ctx or FeatureContext(df, pair)
+        features = {}
+        for name, group in FEATURE_GROUPS.items():
+            features.update(zip(group['features'], ctx.get(name)))
 
         # Чистим NaN
         for k, v in list(features.items()):
@@ -2106,25 +3312,309 @@ def prepare_ml_features(df):
         logging.error(f"Ошибка ML features: {e}", exc_info=True)
         return None
 
+# ---- Признаки по бару: одно вычисление и для модели, и для записи сделки ----
+FEATURE_CACHE = BarResultCache(maxsize=512)
+
+def get_bar_features(pair: str, df: pd.DataFrame, ctx: Optional[FeatureContext] = None) -> Optional[Dict]:
+    """
+    Полный набор признаков (как prepare_ml_features) по ключу (пара, время последнего закрытого бара M1).
+    df — кадр MT5 с формирующимся баром, признаки считаются по ml_feature_window(df).
+    С ctx — считаем из контекста, на котором считался вход модели, и обновляем кэш;
+    без ctx — берём уже посчитанное для этого бара. Хранятся только числа, наружу — копия.
+    """
+    if df is None or len(df) < 2:
+        return None
+    df = ml_feature_window(df)
+    key = ("features", pair, df.index[-1])
+    hit, entry = (False, None) if ctx is not None else FEATURE_CACHE.get(key)
+    if not hit:
+        features = prepare_ml_features(df, pair, ctx=ctx)
+        if not features:
+            return None
+        entry = tuple(
+            (name, value.item() if isinstance(value, np.generic) else value)
+            for name, value in features.items()
+            if isinstance(value, (bool, int, float, np.bool_, np.number))
+        )
+        FEATURE_CACHE.put(key, entry)
+    return dict(entry)
+
+# ===================== 🏗 БЭКФИЛЛ ПРИЗНАКОВ ПО ИСТОРИИ (ВЕКТОРНО) =====================
+# Окно как у analyze_pair: признаки закрытого бара t считаются по барам [t-BACKFILL_WINDOW+1 .. t]
+# (400 баров MT5 минус формирующийся = ml_feature_window)
+BACKFILL_WINDOW = 399
+BACKFILL_CHUNK = 2000
+# Время сделок — локальное (datetime.now()), бары MT5 — во времени сервера
+MT5_TIME_OFFSET_HOURS = float(os.getenv("MT5_TIME_OFFSET_HOURS", "0"))
+
+def get_mt5_history(symbol: str, date_from: datetime, date_to: datetime, timeframe=None) -> Optional[pd.DataFrame]:
+    """Котировки MT5 за диапазон дат (для бэктеста и бэкфилла)"""
+    try:
+        if not mt5.terminal_info():
+            logging.error("MT5 терминал не подключен")
+            return None
+        timeframe = timeframe if timeframe is not None else mt5.TIMEFRAME_M1
+        rates = mt5.copy_rates_range(symbol, timeframe, date_from, date_to)
+        if rates is None or len(rates) == 0:
+            logging.warning(f"Нет истории для {symbol} за {date_from} — {date_to}")
+            return None
+        df = pd.DataFrame(rates)
+        df['time'] = pd.to_datetime(df['time'], unit='s')
+        df.set_index('time', inplace=True)
+        df.attrs['symbol'] = symbol
+        df.attrs['timeframe'] = timeframe
+        return df
+    except Exception as e:
+        logging.error(f"Ошибка получения истории MT5 {symbol}: {e}")
+        return None
+
+def batch_adx(high: np.ndarray, low: np.ndarray, close: np.ndarray, period: int = 14) -> np.ndarray:
+    """ADX (как TA-Lib) последнего бара каждой строки матрицы rows × bars"""
+    rows, n = close.shape
+    out = np.full(rows, np.nan)
+    if n < 2 * period:
+        return out
+    decay = 1.0 - 1.0 / period
+
+    diff_p = high[:, 1:] - high[:, :-1]
+    diff_m = low[:, :-1] - low[:, 1:]
+    minus_dm = np.where((diff_m > 0) & (diff_p < diff_m), diff_m, 0.0)
+    plus_dm = np.where((diff_p > 0) & (diff_p > diff_m), diff_p, 0.0)
+    tr = batch_true_range(high, low, close)[:, 1:]
+
+    def smooth(x):
+        # первые period-1 изменений — сумма, дальше s = s - s/period + x
+        seed = x[:, :period - 1].sum(axis=1)
+        return lfilter([1.0], [1.0, -decay], x[:, period - 1:], axis=1, zi=(decay * seed)[:, None])[0]
+
+    plus_s, minus_s, tr_s = smooth(plus_dm), smooth(minus_dm), smooth(tr)
+    valid_tr = np.abs(tr_s) >= 0.00000001
+    safe_tr = np.where(valid_tr, tr_s, 1.0)
+    plus_di = 100.0 * plus_s / safe_tr
+    minus_di = 100.0 * minus_s / safe_tr
+    di_sum = plus_di + minus_di
+    valid = valid_tr & (np.abs(di_sum) >= 0.00000001)
+    dx = np.where(valid, 100.0 * np.abs(minus_di - plus_di) / np.where(valid, di_sum, 1.0), 0.0)
+
+    adx_seed = dx[:, :period].sum(axis=1) / period
+    if dx.shape[1] > period:
+        out[:] = _wilder_filter(dx[:, period:], adx_seed, period)[:, -1]
+    else:
+        out[:] = adx_seed
+
+    # Пропуски DX (нулевой диапазон) TA-Lib обрабатывает иначе — такие строки считаем им
+    for i in np.flatnonzero(~valid.all(axis=1)):
+        out[i] = ta.ADX(high[i], low[i], close[i], timeperiod=period)[-1]
+    return out
+
+def _backfill_chunk(h, l, c) -> Dict[str, np.ndarray]:
+    """Индикаторы по окнам (rows × window): значение последнего бара каждого окна"""
+    ones = {}
+    ones['rsi_14'] = batch_rsi(c, 14)[:, -1]
+    ones['rsi_21'] = batch_rsi(c, 21)[:, -1]
+    atr = batch_atr(h, l, c, 14)
+    ones['atr'] = atr[:, -1]
+    ones['atr_ma_50'] = atr[:, -50:].mean(axis=1)
+    ones['adx'] = batch_adx(h, l, c, 14)
+    # MACD как TA-Lib: быстрая EMA стартует там же, где медленная
+    slow = batch_ema(c, 26)[:, -1]
+    fast = batch_ema(c[:, 26 - 12:], 12)[:, -1]
+    ones['macd'] = fast - slow
+    return ones
+
+def backfill_feature_matrix(df: pd.DataFrame, window: int = BACKFILL_WINDOW,
+                            chunk_size: int = BACKFILL_CHUNK) -> Optional[pd.DataFrame]:
+    """
+    Признаки для КАЖДОГО бара истории (строки с window-1), как если бы
+    prepare_ml_features вызывали на окне из window баров, заканчивающемся этим баром.
+    Рекурсивные индикаторы считаются батчем по окнам, остальное — rolling/срезами.
+    Группы, зависящие от окна целиком (SMC, уровни, время свечи), сюда не входят.
+    """
+    if df is None or len(df) < max(window, 100):
+        return None
+
+    h = df['high'].to_numpy(dtype=np.float64)
+    l = df['low'].to_numpy(dtype=np.float64)
+    c = df['close'].to_numpy(dtype=np.float64)
+    v = df['tick_volume'].to_numpy(dtype=np.float64)
+    n = len(c)
+    rows = slice(window - 1, n)
+    cols = {}
+
+    # ---- Индикаторы по окнам (батчами, чтобы не раздувать память) ----
+    win = [sliding_window_view(arr, window) for arr in (h, l, c)]
+    parts = []
+    for start in range(0, n - window + 1, chunk_size):
+        stop = min(start + chunk_size, n - window + 1)
+        parts.append(_backfill_chunk(*(w[start:stop] for w in win)))
+    ind = {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+
+    close_t = c[rows]
+    cols['price'] = close_t
+    cols['volume'] = v[rows]
+    cols['rsi_14'] = np.where(np.isnan(ind['rsi_14']), 50.0, ind['rsi_14'])
+    cols['rsi_21'] = np.where(np.isnan(ind['rsi_21']), 50.0, ind['rsi_21'])
+    cols['atr'] = ind['atr']
+    cols['atr_ratio'] = np.where(np.isnan(ind['atr_ma_50']), 1.0, ind['atr'] / ind['atr_ma_50'])
+
+    # OBV окна: объём первого бара окна + знаковые объёмы после него
+    signed = np.zeros(n)
+    signed[1:] = np.sign(np.diff(c)) * v[1:]
+    cum = np.cumsum(signed)
+    first = np.arange(n - window + 1)
+    cols['obv'] = v[first] + cum[rows] - cum[first]
+    cols['obv_trend'] = cum[rows] - cum[window - 1 - 5:n - 5]
+    cols['adx'] = ind['adx']
+
+    for period in (15, 30, 60):
+        back = c[window - period:n - period + 1]
+        cols[f'price_change_{period}m'] = (close_t - back) / back * 100
+
+    pct = pd.Series(c).pct_change()
+    cols['volatility'] = pct.rolling(window - 1).std().to_numpy()[rows] * 100
+    cols['macd'] = ind['macd']
+
+    bb_u, _, bb_l = batch_bbands(c[None, :], 20)
+    bb_range = np.maximum(1e-9, bb_u[0] - bb_l[0])
+    cols['bb_position'] = np.where(np.isnan(bb_u[0]), 0.5, (c - bb_l[0]) / bb_range)[rows]
+
+    candles = detect_candle_patterns(df)
+    cols['bullish_engulfing'] = candles['bullish_engulfing'][rows].astype(np.int64)
+    cols['bearish_engulfing'] = candles['bearish_engulfing'][rows].astype(np.int64)
+    cols['three_white_soldiers'] = candles['three_white_soldiers'][rows].astype(np.int64)
+
+    # «Дневные» экстремумы = tail(1440) окна
+    span = min(window, 1440)
+    daily_high = pd.Series(h).rolling(span).max().to_numpy()[rows]
+    daily_low = pd.Series(l).rolling(span).min().to_numpy()[rows]
+    daily_rng = daily_high - daily_low
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cols['distance_to_daily_high'] = np.where(daily_high > 0, (daily_high - close_t) / daily_high * 100, 50.0)
+        cols['distance_to_daily_low'] = np.where(close_t > 0, (close_t - daily_low) / close_t * 100, 50.0)
+        cols['daily_range_position'] = np.where(daily_rng > 0, (close_t - daily_low) / daily_rng, 0.5)
+
+    cols['exhaustion_rsi_extreme'] = ((cols['rsi_14'] < 25) | (cols['rsi_14'] > 75)).astype(np.int64)
+    cols['strong_impulse'] = (np.abs(cols['price_change_15m']) > 0.3).astype(np.int64)
+    vol_avg_20 = pd.Series(v).rolling(20).mean().to_numpy()[rows]
+    cols['volume_declining'] = (v[rows] < vol_avg_20 * 0.8).astype(np.int64)
+    cols['signal_vs_trend_conflict'] = np.zeros(len(close_t), dtype=np.int64)
+    cols['signal_vs_rsi_conflict'] = np.zeros(len(close_t), dtype=np.int64)
+
+    ordered = [f for f in FEATURE_INDEX if f in cols]
+    return pd.DataFrame({f: cols[f] for f in ordered}, index=df.index[rows])
+
+def backfill_window_features(window_df: pd.DataFrame, entry_time: datetime, pair: Optional[str],
+                             skip_features) -> Dict[str, float]:
+    """Группы, которым нужно окно целиком (SMC, уровни, время свечи) — для одного бара сделки"""
+    ctx = FeatureContext(window_df, pair)
+    ctx._cache['candle_time'] = get_candle_time_info(entry_time)  # время входа, а не «сейчас»
+    values = {}
+    for name, group in FEATURE_GROUPS.items():
+        if all(f in skip_features for f in group['features']):
+            continue
+        for feature, value in zip(group['features'], ctx.get(name)):
+            if feature not in skip_features:
+                values[feature] = value
+    return values
+
+def _trade_entry_time(trade: dict) -> Optional[pd.Timestamp]:
+    """Время входа сделки во времени сервера MT5"""
+    ts = pd.to_datetime(trade.get('timestamp'), errors='coerce')
+    if ts is None or pd.isna(ts):
+        return None
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert(None)
+    return ts + pd.Timedelta(hours=MT5_TIME_OFFSET_HOURS)
+
+def build_backfill_training_matrix(trades: List[dict], window: int = BACKFILL_WINDOW,
+                                   history_loader=None) -> dict:
+    """
+    Полная матрица признаков по истории для всех сделок:
+    1) по каждой паре — один запрос истории и backfill_feature_matrix по всем барам;
+    2) сделка привязывается к последнему ЗАКРЫТОМУ бару до входа (без заглядывания
+       в формирующуюся минуту) — это тот же бар, на котором онлайн считаются признаки (ml_feature_window);
+    3) оконные группы досчитываются только для баров сделок.
+    Возвращает {'X': DataFrame, 'y': ndarray (1=WIN, 0=LOSS, -1=не закрыта), 'trades': [...], 'stats': {...}}.
+    """
+    started = datetime.now()
+    history_loader = history_loader or get_mt5_history
+    feature_names = list(FEATURE_INDEX)
+    by_pair = {}
+    skipped = 0
+    for trade in trades:
+        entry_time = _trade_entry_time(trade)
+        if not trade.get('pair') or entry_time is None:
+            skipped += 1
+            continue
+        by_pair.setdefault(trade['pair'], []).append((entry_time, trade))
+
+    rows, labels, matched = [], [], []
+    bars_total = 0
+    for pair, items in by_pair.items():
+        times = [t for t, _ in items]
+        # Запас истории под окно + выходные
+        date_from = (min(times) - pd.Timedelta(minutes=window * 3) - pd.Timedelta(days=3)).to_pydatetime()
+        date_to = (max(times) + pd.Timedelta(minutes=1)).to_pydatetime()
+        history = history_loader(pair, date_from, date_to)
+        matrix = backfill_feature_matrix(history, window)
+        if matrix is None:
+            skipped += len(items)
+            logging.warning(f"⚠️ Бэкфилл {pair}: нет истории ({len(items)} сделок пропущено)")
+            continue
+        bars_total += len(matrix)
+
+        bar_times = matrix.index.to_numpy()
+        entry_bars = pd.DatetimeIndex([t.floor('min') - pd.Timedelta(minutes=1) for t in times]).to_numpy()
+        pos = np.searchsorted(bar_times, entry_bars, side='right') - 1
+        values = matrix.to_numpy()
+        for i, ((entry_time, trade), p) in enumerate(zip(items, pos)):
+            # Нет бара рядом со входом (дыра в истории) — сделку не привязываем
+            if p < 0 or entry_bars[i] - bar_times[p] > np.timedelta64(10, 'm'):
+                skipped += 1
+                continue
+            end = history.index.get_loc(matrix.index[p]) + 1
+            feats = dict(zip(matrix.columns, values[p]))
+            feats.update(backfill_window_features(history.iloc[end - window:end], entry_time.to_pydatetime(), pair,
+                                                  skip_features=feats))
+            row = {f: feats.get(f, 0.0) for f in feature_names}
+            for k, v in row.items():
+                if pd.isna(v):
+                    row[k] = 0.0
+            rows.append(row)
+            labels.append({'WIN': 1, 'LOSS': 0}.get(trade.get('result'), -1))
+            matched.append(trade)
+
+    X = pd.DataFrame(rows, columns=feature_names)
+    elapsed = (datetime.now() - started).total_seconds()
+    stats = {
+        'pairs': len(by_pair),
+        'bars': bars_total,
+        'trades_matched': len(matched),
+        'trades_skipped': skipped,
+        'seconds': round(elapsed, 2)
+    }
+    logging.info(f"🏗 Бэкфилл признаков: {stats}")
+    return {'X': X, 'y': np.asarray(labels, dtype=int), 'trades': matched, 'stats': stats}
+
 # ===================== ИНФЕРЕНС (БЕЗОПАСНЫЙ) =====================
-def ml_predict_proba_safe(ml_features: Dict[str, float]) -> Optional[float]:
-    """Вероятность WIN (0..1). Никогда не падает из-за несовпадения признаков."""
+def ml_predict_proba_safe(ml_features) -> Optional[float]:
+    """Вероятность WIN (0..1). Никогда не падает из-за несовпадения признаков.
+    ml_features — словарь признаков или FeatureContext (вектор строится по плану)."""
     try:
-        global ml_model, ml_scaler, model_info
-        if ml_model is None or ml_scaler is None:
-            if not load_ml_artifacts():
-                return None
+        active = get_active_model()
+        if active is None:
+            return None
 
-        expected = model_info.get("feature_names", []) or _get_expected_feature_list()
+        expected = active['feature_names']
         if not expected:
             logging.warning("⚠️ feature_names отсутствуют — инференс пропущен")
             return None
 
-        X_raw = _vectorize_for_inference(ml_features or {}, expected)
-        X = ml_scaler.transform(X_raw)
-        if hasattr(ml_model, "predict_proba"):
-            return float(ml_model.predict_proba(X)[0, 1])
-        return float(ml_model.predict(X)[0])
+        if isinstance(ml_features, FeatureContext):
+            X_raw = get_feature_plan(expected).execute(ml_features).reshape(1, -1)
+        else:
+            X_raw = _vectorize_for_inference(ml_features or {}, expected)
+        return float(ml_predict_matrix(X_raw, active)[0])
     except Exception as e:
         logging.error(f"❌ Ошибка ML инференса: {e}", exc_info=True)
         return None
@@ -2159,6 +3649,501 @@ def ml_predict_enhanced(features_dict: dict, pair: str, current_price: float):
         logging.error(f"❌ Ошибка ml_predict_enhanced для {pair}: {e}", exc_info=True)
         return {"probability": 0.5, "confidence": 0.0, "signal": None}
 
+# ===================== ⚡ КОМПИЛИРОВАННЫЙ ЛЕС (ПЛОСКИЕ МАССИВЫ) =====================
+from time import monotonic
+
+def compile_forest(model) -> Optional[dict]:
+    """
+    Экспорт RandomForestClassifier в плоские массивы всех деревьев:
+    feature, threshold, left, right, value (доля класса 1 в узле), roots.
+    Листья ссылаются сами на себя, поэтому обход — фиксированные max_depth шагов.
+    """
+    estimators = getattr(model, "estimators_", None)
+    classes = getattr(model, "classes_", None)
+    if not estimators or classes is None or len(classes) != 2:
+        return None
+    if not all(hasattr(est, "tree_") for est in estimators):
+        return None
+
+    features, thresholds, missing_lefts, lefts, rights, values, roots = [], [], [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for est in estimators:
+        tree = est.tree_
+        n = tree.node_count
+        left = tree.children_left.astype(np.intp)
+        right = tree.children_right.astype(np.intp)
+        is_leaf = left == -1
+        own = np.arange(n, dtype=np.intp)
+
+        counts = tree.value[:, 0, :].astype(np.float64)
+        totals = counts.sum(axis=1)
+        totals[totals == 0.0] = 1.0
+
+        # NaN идёт туда же, куда у sklearn (missing_go_to_left; без него — вправо, как сравнение с NaN)
+        missing = getattr(tree, "missing_go_to_left", None)
+        missing_left = np.zeros(n, dtype=bool) if missing is None else np.asarray(missing, dtype=bool)
+
+        features.append(np.where(is_leaf, 0, tree.feature).astype(np.intp))
+        thresholds.append(np.where(is_leaf, np.inf, tree.threshold).astype(np.float64))
+        missing_lefts.append(missing_left & ~is_leaf)
+        lefts.append(np.where(is_leaf, own, left) + offset)
+        rights.append(np.where(is_leaf, own, right) + offset)
+        values.append(counts[:, 1] / totals)
+        roots.append(offset)
+        offset += n
+        max_depth = max(max_depth, int(tree.max_depth))
+
+    return {
+        'feature': np.concatenate(features),
+        'threshold': np.concatenate(thresholds),
+        'missing_left': np.concatenate(missing_lefts),
+        'left': np.concatenate(lefts),
+        'right': np.concatenate(rights),
+        'value': np.concatenate(values),
+        'roots': np.asarray(roots, dtype=np.intp),
+        'max_depth': max_depth,
+        'n_trees': len(estimators),
+        'n_features': int(getattr(model, "n_features_in_", 0))
+    }
+
+def forest_predict_proba(forest: dict, X: np.ndarray) -> np.ndarray:
+    """P(класс 1) для строк X по плоским массивам — как predict_proba sklearn"""
+    # sklearn сравнивает признаки во float32 с порогами во float64
+    X32 = np.atleast_2d(np.asarray(X, dtype=np.float32))
+    if forest['n_features'] and X32.shape[1] != forest['n_features']:
+        raise ValueError(f"ожидалось {forest['n_features']} признаков, получено {X32.shape[1]}")
+    n_rows = X32.shape[0]
+    node = np.broadcast_to(forest['roots'], (n_rows, forest['n_trees'])).copy()
+    rows = np.arange(n_rows)[:, None]
+    feature, threshold, left, right = forest['feature'], forest['threshold'], forest['left'], forest['right']
+    missing_left = forest['missing_left']
+    has_nan = bool(np.isnan(X32).any())
+    for _ in range(forest['max_depth']):
+        x = X32[rows, feature[node]]
+        go_left = x <= threshold[node]
+        if has_nan:
+            go_left = np.where(np.isnan(x), missing_left[node], go_left)
+        node = np.where(go_left, left[node], right[node])
+    return forest['value'][node].sum(axis=1) / forest['n_trees']
+
+def _fast_scale(scaler, X: np.ndarray) -> np.ndarray:
+    """StandardScaler.transform без проверок входа (те же операции: -mean, /scale)"""
+    if not isinstance(scaler, StandardScaler):
+        return scaler.transform(X)
+    X = np.array(X, dtype=np.float64, copy=True)
+    if scaler.with_mean:
+        X -= scaler.mean_
+    if scaler.with_std:
+        X /= scaler.scale_
+    return X
+
+# sklearn суммирует деревья в потоках (n_jobs) в произвольном порядке — расхождение только в последних битах
+FAST_FOREST_TOLERANCE = 1e-12
+
+def _forest_max_diff(forest: dict, model, scaler, probe_raw: np.ndarray) -> float:
+    """Максимальное расхождение с predict_proba на пробных строках"""
+    fast = forest_predict_proba(forest, _fast_scale(scaler, probe_raw))
+    reference = model.predict_proba(scaler.transform(probe_raw))[:, 1]
+    return float(np.max(np.abs(fast - reference)))
+
+def _forest_probe_rows(scaler, n_features: int, n_rows: int = 256) -> np.ndarray:
+    """Пробные строки для сверки: вокруг средних скейлера"""
+    rng = np.random.default_rng(42)
+    mean = getattr(scaler, "mean_", np.zeros(n_features))
+    scale = getattr(scaler, "scale_", np.ones(n_features))
+    return mean + scale * rng.normal(0.0, 1.5, size=(n_rows, n_features))
+
+def build_fast_forest(model, scaler) -> Optional[dict]:
+    """
+    Скомпилированный лес для модели; хранится только в её связке (make_model_bundle).
+    Включается только если на пробных строках совпадает с predict_proba (до FAST_FOREST_TOLERANCE).
+    """
+    if model is None:
+        return None
+    forest = None
+    try:
+        forest = compile_forest(model)
+        if forest is not None and scaler is not None:
+            max_diff = _forest_max_diff(forest, model, scaler, _forest_probe_rows(scaler, forest['n_features']))
+            if max_diff > FAST_FOREST_TOLERANCE:
+                logging.warning("⚠️ Компилированный лес расходится с sklearn — используем predict_proba")
+                forest = None
+    except Exception as e:
+        logging.error(f"❌ Ошибка компиляции леса: {e}")
+        forest = None
+
+    if forest is not None:
+        logging.info(f"⚡ Лес скомпилирован: {forest['n_trees']} деревьев, {len(forest['value'])} узлов, глубина {forest['max_depth']}")
+    return forest
+
+def benchmark_fast_forest(model, scaler, repeats: int = 30) -> dict:
+    """
+    Сверка и замер одной строки: sklearn (transform + predict_proba) против плоских массивов.
+    Для тестов и ручной проверки — в обучение и дообучение не входит.
+    """
+    forest = compile_forest(model)
+    if forest is None:
+        return {'compiled': False}
+    probe_raw = _forest_probe_rows(scaler, forest['n_features'])
+    max_diff = _forest_max_diff(forest, model, scaler, probe_raw)
+
+    row = probe_raw[:1]
+    def timed(fn):
+        samples = []
+        for _ in range(repeats):
+            started = monotonic()
+            fn()
+            samples.append(monotonic() - started)
+        return float(np.median(samples)) * 1000.0
+
+    sklearn_ms = timed(lambda: model.predict_proba(scaler.transform(row))[:, 1])
+    compiled_ms = timed(lambda: forest_predict_proba(forest, _fast_scale(scaler, row)))
+    return {
+        'compiled': True,
+        'equivalent': max_diff <= FAST_FOREST_TOLERANCE,
+        'max_abs_diff': max_diff,
+        'sklearn_ms': round(sklearn_ms, 3),
+        'compiled_ms': round(compiled_ms, 3),
+        'speedup': round(sklearn_ms / max(compiled_ms, 1e-9), 1)
+    }
+
+# ===================== 🧵 БЮДЖЕТ ПОТОКОВ ИНФЕРЕНСА =====================
+# Модель считает в один поток (n_jobs=1, BLAS/OpenMP = ML_BLAS_THREADS), а параллелизм задаёт
+# пул фиксированного размера — потоков скоринга не больше, чем ядер, сколько бы пользователей ни было.
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+ML_INFERENCE_WORKERS = int(os.getenv("ML_INFERENCE_WORKERS", str(os.cpu_count() or 2)))
+ML_BLAS_THREADS = int(os.getenv("ML_BLAS_THREADS", "1"))
+
+ML_INFERENCE_POOL = ThreadPoolExecutor(max_workers=ML_INFERENCE_WORKERS, thread_name_prefix="ml-infer")
+ML_INFERENCE_LATENCY = deque(maxlen=2000)  # секунды на вызов, включая ожидание в очереди пула
+# Сглаженная задержка НА СТРОКУ (для фолбэка на дистиллированную модель): батч скана и
+# одиночный вызов сравнимы только в пересчёте на строку
+ML_LATENCY_EWMA = 0.0
+_ML_LATENCY_LOCK = threading.Lock()
+_ML_THREAD_LIMITER = None
+
+def limit_native_threads(n_threads: int = ML_BLAS_THREADS) -> None:
+    """Ограничивает потоки BLAS/OpenMP процесса (вызывается один раз при старте бота)"""
+    global _ML_THREAD_LIMITER
+    if threadpool_limits is None:
+        logging.warning("⚠️ threadpoolctl не установлен — потоки BLAS/OpenMP не ограничены")
+        return
+    if _ML_THREAD_LIMITER is None:
+        _ML_THREAD_LIMITER = threadpool_limits(limits=n_threads)
+        logging.info(f"🧵 BLAS/OpenMP: {n_threads} поток(а), пул инференса: {ML_INFERENCE_WORKERS}")
+
+def pin_inference_threads(model):
+    """predict_proba без joblib-потоков внутри: параллелизм даёт пул инференса"""
+    for est in [model] + list(getattr(model, "estimators_", []) or []):
+        if hasattr(est, "n_jobs"):
+            try:
+                est.n_jobs = 1
+            except Exception:
+                pass
+    return model
+
+def run_inference(fn, *args, rows: int = 1):
+    """Выполняет скоринг в пуле инференса (из потока самого пула — сразу, без взаимной блокировки)"""
+    global ML_LATENCY_EWMA
+    started = monotonic()
+    try:
+        if threading.current_thread().name.startswith("ml-infer"):
+            return fn(*args)
+        return ML_INFERENCE_POOL.submit(fn, *args).result()
+    finally:
+        elapsed = monotonic() - started
+        ML_INFERENCE_LATENCY.append(elapsed)
+        with _ML_LATENCY_LOCK:
+            ML_LATENCY_EWMA = 0.8 * ML_LATENCY_EWMA + 0.2 * elapsed / max(rows, 1)
+
+def inference_latency_stats() -> dict:
+    samples = np.asarray(ML_INFERENCE_LATENCY, dtype=float) * 1000.0
+    if samples.size == 0:
+        return {'calls': 0}
+    return {
+        'calls': int(samples.size),
+        'p50_ms': round(float(np.percentile(samples, 50)), 3),
+        'p99_ms': round(float(np.percentile(samples, 99)), 3),
+        'workers': ML_INFERENCE_WORKERS
+    }
+
+# ===================== 🪶 ДИСТИЛЛИРОВАННАЯ МОДЕЛЬ (ФОЛБЭК ПО ЛАТЕНТНОСТИ) =====================
+# Линейная модель на логите вероятностей основной модели: строка считается за микросекунды.
+# Если сглаженная задержка основной модели превышает бюджет — отвечает она, а каждый
+# ML_FALLBACK_PROBE_EVERY-й вызов всё равно идёт в основную модель, чтобы заметить разгрузку.
+from sklearn.linear_model import Ridge
+
+ML_LATENCY_BUDGET_MS = float(os.getenv("ML_LATENCY_BUDGET_MS", "25"))  # на строку (см. ML_LATENCY_EWMA)
+ML_FALLBACK_PROBE_EVERY = int(os.getenv("ML_FALLBACK_PROBE_EVERY", "10"))
+ML_DISTILL_CLIP = 1e-3
+
+ML_DISTILLED_STATS = {'full_calls': 0, 'over_budget_calls': 0, 'fallback_rows': 0}
+
+def distilled_predict_proba(distilled: dict, X_scaled: np.ndarray) -> np.ndarray:
+    """P(WIN) дистиллированной модели по уже масштабированным признакам"""
+    z = np.atleast_2d(X_scaled) @ distilled['coef'] + distilled['intercept']
+    return 1.0 / (1.0 + np.exp(-z))
+
+def out_of_fold_proba(model, X: np.ndarray, y: np.ndarray, splits: List[tuple],
+                      sample_weight: Optional[np.ndarray] = None) -> np.ndarray:
+    """P(WIN) каждой строки от копии модели, обученной без её фолда (те же фолды, что у CV)"""
+    from sklearn.base import clone
+    proba = np.full(len(X), np.nan)
+    for train_idx, test_idx in splits:
+        estimator = clone(model)
+        if sample_weight is not None:
+            try:
+                estimator.fit(X[train_idx], y[train_idx], sample_weight=sample_weight[train_idx])
+            except TypeError:
+                estimator.fit(X[train_idx], y[train_idx])  # старый sklearn без sample_weight у MLP
+        else:
+            estimator.fit(X[train_idx], y[train_idx])
+        proba[test_idx] = estimator.predict_proba(X[test_idx])[:, 1]
+    return proba
+
+def distill_model(model, X_train_s: np.ndarray, X_test_s: np.ndarray, y_train: Optional[np.ndarray] = None,
+                  splits: Optional[List[tuple]] = None,
+                  sample_weight: Optional[np.ndarray] = None) -> Tuple[Optional[dict], dict]:
+    """
+    Обучает линейную модель на логите вероятностей основной модели на train
+    и меряет расхождение с ней на отложенной выборке (test).
+    Цели на train — вне выборки: OOB леса (если он их посчитал) или out-of-fold по splits;
+    predict_proba на своих же строках у леса почти 0/1 и учит копию лишней уверенности.
+    """
+    try:
+        def teacher(X):
+            return np.clip(model.predict_proba(X)[:, 1], ML_DISTILL_CLIP, 1.0 - ML_DISTILL_CLIP)
+
+        oob = getattr(model, "oob_decision_function_", None)
+        if oob is not None and len(oob) == len(X_train_s):
+            p_train, teacher_kind = np.asarray(oob, dtype=float)[:, 1], 'oob'
+        elif y_train is not None and splits:
+            p_train = out_of_fold_proba(model, X_train_s, np.asarray(y_train), splits, sample_weight)
+            teacher_kind = 'out_of_fold'
+        else:
+            p_train, teacher_kind = teacher(X_train_s), 'in_sample'
+        # строки, не попавшие ни в OOB, ни в фолд, — на вероятностях самой модели
+        missing = np.isnan(p_train)
+        if missing.any():
+            p_train[missing] = model.predict_proba(X_train_s[missing])[:, 1]
+        p_train = np.clip(p_train, ML_DISTILL_CLIP, 1.0 - ML_DISTILL_CLIP)
+        ridge = Ridge(alpha=1.0).fit(X_train_s, np.log(p_train / (1.0 - p_train)))
+        distilled = {
+            'coef': np.asarray(ridge.coef_, dtype=np.float64),
+            'intercept': float(ridge.intercept_),
+            'n_features': int(X_train_s.shape[1])
+        }
+
+        X_eval = X_test_s if len(X_test_s) else X_train_s
+        p_full = teacher(X_eval)
+        p_fast = distilled_predict_proba(distilled, X_eval)
+        diff = np.abs(p_fast - p_full)
+
+        row = X_eval[:1]
+        started = monotonic()
+        for _ in range(200):
+            distilled_predict_proba(distilled, row)
+        score_us = (monotonic() - started) / 200 * 1e6
+
+        report = {
+            'type': 'ridge_logit',
+            'teacher': teacher_kind,
+            'fidelity_mae': round(float(diff.mean()), 4),
+            'fidelity_max_err': round(float(diff.max()), 4),
+            'signal_agreement': round(float(np.mean((p_fast >= 0.5) == (p_full >= 0.5))), 4),
+            'corr': round(float(np.corrcoef(p_fast, p_full)[0, 1]), 4) if len(p_full) > 1 and np.std(p_full) > 0 else None,
+            'score_us': round(score_us, 2),
+            'latency_budget_ms': ML_LATENCY_BUDGET_MS
+        }
+        logging.info(f"🪶 Дистиллированная модель: {report}")
+        return distilled, report
+    except Exception as e:
+        logging.error(f"❌ Ошибка дистилляции модели: {e}", exc_info=True)
+        return None, {'error': str(e)}
+
+def _use_distilled_fallback() -> bool:
+    """Основная модель не укладывается в бюджет задержки (кроме пробных вызовов)"""
+    if ML_LATENCY_EWMA * 1000.0 <= ML_LATENCY_BUDGET_MS:
+        return False
+    ML_DISTILLED_STATS['over_budget_calls'] += 1
+    return ML_DISTILLED_STATS['over_budget_calls'] % max(ML_FALLBACK_PROBE_EVERY, 1) != 0
+
+# ===================== 📦 БАТЧ-ИНФЕРЕНС ML (СКАН + МИКРОБАТЧИ) =====================
+ML_BATCH_MAX_WAIT = float(os.getenv("ML_BATCH_MAX_WAIT_MS", "5")) / 1000.0
+ML_BATCH_MAX_SIZE = int(os.getenv("ML_BATCH_MAX_SIZE", "64"))
+
+def ml_predict_matrix(X: np.ndarray, active: Optional[dict] = None) -> np.ndarray:
+    """P(WIN) для матрицы (n × признаков): один transform и один predict_proba на всех.
+    active — снимок связки из реестра (по умолчанию текущая активная). Считается в пуле инференса."""
+    active = active if active is not None else get_active_model()
+    if active is None:
+        raise RuntimeError("ML модель не загружена")
+    if active.get('distilled') is not None and _use_distilled_fallback():
+        # 🪶 Основная модель вне бюджета задержки — считаем линейной копией прямо в этом потоке
+        X = np.atleast_2d(X)
+        ML_DISTILLED_STATS['fallback_rows'] += len(X)
+        return distilled_predict_proba(active['distilled'], _fast_scale(active['scaler'], X))
+    ML_DISTILLED_STATS['full_calls'] += 1
+    return run_inference(_score_matrix, X, active, rows=len(np.atleast_2d(X)))
+
+def _score_matrix(X: np.ndarray, active: dict) -> np.ndarray:
+    model, scaler = active['model'], active['scaler']
+    if active['forest'] is not None:
+        # ⚡ Плоские массивы дают те же вероятности без накладных расходов sklearn
+        return forest_predict_proba(active['forest'], _fast_scale(scaler, X))
+    X_scaled = scaler.transform(X)
+    if hasattr(model, "predict_proba"):
+        return model.predict_proba(X_scaled)[:, 1]
+    return np.asarray(model.predict(X_scaled), dtype=float)
+
+class MLMicroBatcher:
+    """
+    Склеивает одновременные запросы из потоков analyze_pair в один predict_proba.
+    Первый пришедший поток — «лидер»: ждёт до max_wait попутчиков (или max_size строк),
+    считает матрицу и раздаёт вероятности по слотам.
+    """
+
+    def __init__(self, max_wait: float = ML_BATCH_MAX_WAIT, max_size: int = ML_BATCH_MAX_SIZE):
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self._cond = threading.Condition()
+        self._pending = []
+        self._has_leader = False
+        self.batches = 0
+        self.rows = 0
+
+    def predict(self, row: np.ndarray, active: Optional[dict] = None) -> float:
+        active = active if active is not None else get_active_model()
+        slot = {'done': False, 'value': None, 'error': None, 'active': active}
+        with self._cond:
+            self._pending.append((np.asarray(row, dtype=np.float64).ravel(), slot))
+            is_leader = not self._has_leader
+            self._has_leader = True
+            if len(self._pending) >= self.max_size:
+                self._cond.notify_all()
+
+        if is_leader:
+            deadline = monotonic() + self.max_wait
+            with self._cond:
+                while len(self._pending) < self.max_size:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, []
+                self._has_leader = False
+            self._run(batch)
+            with self._cond:
+                self._cond.notify_all()
+        else:
+            with self._cond:
+                while not slot['done']:
+                    self._cond.wait()
+
+        if slot['error'] is not None:
+            raise slot['error']
+        return slot['value']
+
+    def _run(self, batch: list):
+        # Строки разных версий модели (подмена посреди скана) считаем раздельно — каждую своей связкой
+        by_version = {}
+        for row, slot in batch:
+            by_version.setdefault(id(slot['active']), []).append((row, slot))
+        for items in by_version.values():
+            try:
+                probs = ml_predict_matrix(np.vstack([row for row, _ in items]), items[0][1]['active'])
+                for (_, slot), proba in zip(items, probs):
+                    slot['value'] = float(proba)
+            except Exception as e:
+                for _, slot in items:
+                    slot['error'] = e
+            finally:
+                for _, slot in items:
+                    slot['done'] = True
+        self.batches += 1
+        self.rows += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'avg_batch': round(self.rows / self.batches, 2) if self.batches else 0.0
+        }
+
+ML_BATCHER = MLMicroBatcher()
+
+# ---- Прогнозы всей вселенной на цикл сканирования ----
+ML_SCAN_PREDICTIONS: Dict[str, dict] = {}
+# Попадания analyze_pair в батч скана: промахи значат, что окно или версия модели разошлись со сканом
+ML_SCAN_STATS = {'hits': 0, 'misses': 0}
+_ML_SCAN_STATS_LOCK = threading.Lock()
+
+def refresh_scan_predictions(frames: Dict[str, pd.DataFrame]) -> Dict[str, dict]:
+    """
+    Признаки всех пар по плану модели → матрица (пары × признаки) → один predict_proba.
+    frames — кадры снимка цикла: analyze_pair получает те же объекты (get_cycle_frame),
+    поэтому окно совпадает и готовые вероятность, вектор и контекст признаков берутся как есть.
+    """
+    global ML_SCAN_PREDICTIONS
+    predictions = {}
+    try:
+        active = get_active_model()
+        if active is None:
+            return predictions
+        feature_names = active['feature_names']
+        if not feature_names:
+            return predictions
+        plan = get_feature_plan(feature_names)
+
+        # окна закрытых баров — так же, как в analyze_pair и в бэкфилле
+        valid = [(p, ml_feature_window(df)) for p, df in frames.items() if df is not None and len(df) > 100]
+        if not valid:
+            return predictions
+        X = np.zeros((len(valid), plan.n_features), dtype=np.float64)
+        contexts = []
+        for i, (pair, df) in enumerate(valid):
+            ctx = FeatureContext(df, pair)
+            plan.execute(ctx, out=X[i])
+            contexts.append(ctx)
+
+        probs = ml_predict_matrix(X, active)
+        for i, (pair, df) in enumerate(valid):
+            predictions[pair] = {
+                'stamp': _bar_stamp(df),
+                'model': active['version'],
+                'ctx': contexts[i],
+                'row': X[i],
+                'proba': float(probs[i])
+            }
+        logging.info(f"📦 Батч-инференс: {len(valid)} пар × {plan.n_features} признаков одним predict_proba")
+    except Exception as e:
+        logging.error(f"❌ Ошибка батч-инференса: {e}", exc_info=True)
+    finally:
+        ML_SCAN_PREDICTIONS = predictions
+    return predictions
+
+def get_scan_prediction(pair: str, df: pd.DataFrame, active: Optional[dict] = None) -> Optional[dict]:
+    """Прогноз из батча скана, если он посчитан на этом же окне и этой же версией модели (df — кадр MT5)"""
+    entry = ML_SCAN_PREDICTIONS.get(pair)
+    active = active if active is not None else get_active_model()
+    if entry is None or active is None or df is None or len(df) < 2:
+        return None
+    if entry['model'] != active['version'] or entry['stamp'] != _bar_stamp(ml_feature_window(df)):
+        with _ML_SCAN_STATS_LOCK:
+            ML_SCAN_STATS['misses'] += 1
+        return None
+    with _ML_SCAN_STATS_LOCK:
+        ML_SCAN_STATS['hits'] += 1
+    return entry
+
 # ===================== ВАЛИДАЦИЯ СИГНАЛА (оставлено совместимым) =====================
 def validate_ml_signal_with_context(ml_result, trend_analysis, pair):
     """Валидирует ML-сигнал с учётом тренда/RSI/импульса."""
@@ -2275,25 +4260,601 @@ async def repair_ml_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда Telegram /repairml — восстанавливает отсутствующие ml_features для сделок"""
     user_id = update.effective_user.id
 
-    if MULTI_USER_MODE and not is_admin(user_id):
-        await update.message.reply_text("❌ Эта команда доступна только администратору.")
-        return
+    if MULTI_USER_MODE and not is_admin(user_id):
+        await update.message.reply_text("❌ Эта команда доступна только администратору.")
+        return
+
+    await update.message.reply_text("🔄 Запускаю восстановление ml_features для всех сделок...")
+
+    repaired_count = repair_ml_features()
+
+    if repaired_count > 0:
+        await update.message.reply_text(
+            f"✅ Обновлено ml_features для {repaired_count} сделок!\n"
+            f"🚀 Теперь можно запустить /forcetrain для переобучения модели."
+        )
+    else:
+        await update.message.reply_text("ℹ️ Все сделки уже содержат ml_features, восстановление не требуется.")
+
+
+# ===================== 🧠 ОБНОВЛЁННЫЙ БЛОК ОБУЧЕНИЯ ML (RandomForest + MLPClassifier + Oversampling) =====================
+# ===================== 🗄 КОЛОНОЧНЫЙ ДАТАСЕТ ДЛЯ ОБУЧЕНИЯ =====================
+# Append-only колонки на диске: X.f32 (сделки × признаки), y.i1, ts.i8 (нс), pair.i2, signal.i8.
+# meta.json (схема признаков, справочник пар, число строк) переписывается атомарно ПОСЛЕ
+# записи колонок — читатель (в т.ч. процесс обучения) видит только целые строки через memmap.
+# Пересборка пишет новое поколение (gen-*) рядом и атомарно переключает CURRENT.json: файлы,
+# открытые читателями через memmap, на месте никогда не обрезаются.
+import hashlib
+
+ML_DATASET_DIR = os.getenv("ML_DATASET_DIR", "ml_dataset")
+
+def _signal_hash(trade: Dict) -> int:
+    """Стабильный int64-идентификатор сигнала: signal_id сделки или (пара, минута входа, направление)"""
+    signal_id = trade.get('signal_id') or (
+        f"{trade.get('pair')}|{str(trade.get('timestamp', ''))[:16]}|{trade.get('direction')}"
+    )
+    digest = hashlib.blake2b(str(signal_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+def make_signal_id(pair: str, bar_time, direction: str) -> str:
+    """ID сигнала: одна пара, один бар M1, одно направление — сколько бы пользователей его ни получили"""
+    return f"{pair}|{pd.Timestamp(bar_time).strftime('%Y-%m-%d %H:%M')}|{direction}"
+
+# Вес строки после схлопывания копий сигнала: none — 1, count — число копий, sqrt — корень из него
+ML_DEDUP_WEIGHTING = os.getenv("ML_DEDUP_WEIGHTING", "none").lower()
+
+def dedup_signal_rows(signal: np.ndarray, weighting: str = ML_DEDUP_WEIGHTING) -> Tuple[np.ndarray, np.ndarray]:
+    """Индексы первых вхождений каждого сигнала (в исходном порядке) и веса строк"""
+    _, first, counts = np.unique(np.asarray(signal), return_index=True, return_counts=True)
+    order = np.argsort(first)
+    keep = first[order]
+    counts = counts[order].astype(float)
+    if weighting == "count":
+        weights = counts
+    elif weighting == "sqrt":
+        weights = np.sqrt(counts)
+    else:
+        weights = np.ones(len(keep))
+    return keep, weights
+
+def _trade_timestamp_ns(trade: Dict) -> int:
+    try:
+        stamp = pd.Timestamp(trade.get('timestamp'))
+        return 0 if pd.isna(stamp) else int(stamp.value)
+    except Exception:
+        return 0
+
+def _is_training_trade(trade: Dict) -> bool:
+    return trade.get('result') in ('WIN', 'LOSS') and isinstance(trade.get('ml_features'), dict)
+
+def _dataset_schema_from_trades(trades: List[Dict]) -> List[str]:
+    """Схема как раньше в train_ml_model: ключи последней сделки с ≥10 признаками"""
+    for trade in reversed(trades[-400:]):
+        feats = trade.get('ml_features')
+        if isinstance(feats, dict) and len(feats) >= 10:
+            return list(feats.keys())
+    return list(FEATURE_INDEX)
+
+def trades_to_columns(trades: List[Dict], feature_names: List[str], pair_codes: Dict[str, int]) -> dict:
+    """Сделки → колонки (отсутствующие и нечисловые признаки = 0.0). pair_codes дополняется."""
+    feature_pos = {name: col for col, name in enumerate(feature_names)}
+    n = len(trades)
+    X = np.zeros((n, len(feature_names)), dtype=np.float32)
+    y = np.zeros(n, dtype=np.int8)
+    ts = np.zeros(n, dtype=np.int64)
+    pair = np.zeros(n, dtype=np.int16)
+    signal = np.zeros(n, dtype=np.int64)
+    for i, trade in enumerate(trades):
+        for key, value in trade['ml_features'].items():
+            col = feature_pos.get(key)
+            if col is not None and isinstance(value, (bool, int, float, np.bool_, np.number)):
+                X[i, col] = value
+        y[i] = 1 if trade.get('result') == 'WIN' else 0
+        ts[i] = _trade_timestamp_ns(trade)
+        pair[i] = pair_codes.setdefault(str(trade.get('pair')), len(pair_codes))
+        signal[i] = _signal_hash(trade)
+    return {'X': X, 'y': y, 'ts': ts, 'pair': pair, 'signal': signal}
+
+class ColumnarDatasetStore:
+    """Append-only колоночный датасет сделок для обучения (см. описание раздела)"""
+
+    COLUMNS = {'X': np.float32, 'y': np.int8, 'ts': np.int64, 'pair': np.int16, 'signal': np.int64}
+    KEEP_GENERATIONS = 2  # текущее + предыдущее (его ещё может читать идущее дообучение)
+
+    def __init__(self, path: str = ML_DATASET_DIR):
+        self.root = path
+        # Один замок на запись: дозапись сделки и пересборка целиком не пересекаются
+        self._lock = threading.RLock()
+
+    @property
+    def path(self) -> str:
+        """Каталог текущего поколения (старый формат без CURRENT.json — сам корень)"""
+        current = _safe_json_load(os.path.join(self.root, "CURRENT.json"))
+        if isinstance(current, dict) and current.get('generation'):
+            return os.path.join(self.root, current['generation'])
+        return self.root
+
+    def _file(self, column: str, path: Optional[str] = None) -> str:
+        return os.path.join(path or self.path, f"{column}.bin")
+
+    def meta(self, path: Optional[str] = None) -> Dict:
+        data = _safe_json_load(os.path.join(path or self.path, "meta.json"))
+        return data if isinstance(data, dict) else {}
+
+    @property
+    def rows(self) -> int:
+        return int(self.meta().get('rows', 0))
+
+    def _row_width(self, column: str, meta: Dict) -> int:
+        return len(meta['feature_names']) if column == 'X' else 1
+
+    def _create_generation(self, feature_names: List[str]) -> Tuple[str, str]:
+        """Пустое поколение рядом с текущим (ещё не опубликовано)"""
+        generation = f"gen-{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"  # имена сортируются по времени
+        path = os.path.join(self.root, generation)
+        os.makedirs(path)
+        for column in self.COLUMNS:
+            open(self._file(column, path), "wb").close()
+        _write_json_atomic(os.path.join(path, "meta.json"), {
+            'feature_names': list(feature_names),
+            'pairs': [],
+            'rows': 0,
+            'generation': generation,
+            'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+        return generation, path
+
+    def _publish_generation(self, generation: str) -> None:
+        _write_json_atomic(os.path.join(self.root, "CURRENT.json"), {'generation': generation})
+        # старые поколения — по возможности (на Windows открытый memmap не даст удалить, удалим позже)
+        generations = sorted(name for name in os.listdir(self.root) if name.startswith("gen-"))
+        for name in generations[:-self.KEEP_GENERATIONS]:
+            if name != generation:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def create(self, feature_names: List[str]) -> None:
+        """Новый пустой датасет (новое поколение; старое остаётся читателям до следующей пересборки)"""
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            generation, _ = self._create_generation(feature_names)
+            self._publish_generation(generation)
+
+    def _append_columns(self, path: str, meta: Dict, trades: List[Dict]) -> Dict:
+        pair_codes = {name: code for code, name in enumerate(meta['pairs'])}
+        columns = trades_to_columns(trades, meta['feature_names'], pair_codes)
+        rows = int(meta['rows'])
+        for column, dtype in self.COLUMNS.items():
+            committed = rows * self._row_width(column, meta) * np.dtype(dtype).itemsize
+            with open(self._file(column, path), "r+b") as f:
+                f.truncate(committed)  # хвост после сбоя между записью колонок и meta
+                f.seek(committed)
+                f.write(np.ascontiguousarray(columns[column], dtype=dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        meta = dict(meta, pairs=sorted(pair_codes, key=pair_codes.get), rows=rows + len(trades))
+        _write_json_atomic(os.path.join(path, "meta.json"), meta)
+        return meta
+
+    def append_trades(self, trades: List[Dict]) -> int:
+        """Дописывает закрытые сделки (WIN/LOSS с ml_features). Возвращает число добавленных строк."""
+        trades = [t for t in trades if _is_training_trade(t)]
+        if not trades:
+            return 0
+        with self._lock:
+            path = self.path
+            meta = self.meta(path)
+            if not meta:
+                return 0
+            generation = meta.get('generation')
+            # сделка уже попала в это поколение при пересборке (закрылась, пока она шла)
+            trades = [t for t in trades if generation is None or t.get('_dataset_generation') != generation]
+            if not trades:
+                return 0
+            self._append_columns(path, meta, trades)
+            for trade in trades:
+                trade['_dataset_generation'] = generation
+        return len(trades)
+
+    def load(self) -> Optional[dict]:
+        """Колонки зафиксированных строк как memmap (только чтение), без построчной работы"""
+        path = self.path
+        meta = self.meta(path)
+        if not meta:
+            return None
+        rows = int(meta['rows'])
+        data = {'feature_names': list(meta['feature_names']), 'pairs': list(meta['pairs']), 'rows': rows,
+                'generation': meta.get('generation')}
+        for column, dtype in self.COLUMNS.items():
+            width = self._row_width(column, meta)
+            shape = (rows, width) if column == 'X' else (rows,)
+            if rows == 0:
+                data[column] = np.zeros(shape, dtype=dtype)
+            else:
+                data[column] = np.memmap(self._file(column, path), dtype=dtype, mode="r", shape=shape)
+        return data
+
+    def rebuild(self, trades) -> int:
+        """
+        Пересоздаёт датасет из истории сделок (миграция, пересчёт признаков).
+        trades — список или функция, возвращающая его: функция вызывается уже под замком,
+        чтобы сделка, закрытая во время пересборки, не попала в датасет дважды.
+        Новое поколение собирается целиком и только потом публикуется.
+        """
+        with self._lock:
+            if callable(trades):
+                trades = trades()
+            completed = [t for t in trades if _is_training_trade(t)]
+            os.makedirs(self.root, exist_ok=True)
+            generation, path = self._create_generation(_dataset_schema_from_trades(completed))
+            try:
+                meta = self._append_columns(path, self.meta(path), completed) if completed else self.meta(path)
+            except Exception:
+                shutil.rmtree(path, ignore_errors=True)
+                raise
+            self._publish_generation(generation)
+            for trade in completed:
+                trade['_dataset_generation'] = generation
+        logging.info(f"🗄 Датасет обучения пересобран ({generation}): {len(completed)} строк, "
+                     f"{len(meta['feature_names'])} признаков")
+        return len(completed)
+
+DATASET_STORE = ColumnarDatasetStore()
+
+def ensure_dataset_store() -> None:
+    """Разовая миграция: если датасета ещё нет — собираем из trade_history пользователей"""
+    if not DATASET_STORE.meta():
+        DATASET_STORE.rebuild(collect_training_trades)
+
+def rebuild_dataset_store() -> int:
+    """Пересборка датасета по командам админа; не во время обучения (оно читает датасет)"""
+    if get_running_training_job() is not None:
+        raise RuntimeError("идёт обучение — пересборка датасета отложена, повторите после его завершения")
+    return DATASET_STORE.rebuild(collect_training_trades)
+
+def append_closed_trade(trade: Dict) -> None:
+    """Закрытая сделка → строка датасета (вызывается при закрытии)"""
+    try:
+        if _is_training_trade(trade):
+            ensure_dataset_store()
+            DATASET_STORE.append_trades([trade])
+    except Exception as e:
+        logging.error(f"❌ Ошибка записи сделки в датасет обучения: {e}")
+
+def dataset_from_trades(trades: List[Dict]) -> dict:
+    """Те же колонки, что в датасете, из снимка сделок (без записи на диск)"""
+    completed = [t for t in trades if _is_training_trade(t)]
+    feature_names = _dataset_schema_from_trades(completed)
+    data = trades_to_columns(completed, feature_names, {})
+    data.update(feature_names=feature_names, rows=len(completed))
+    return data
+
+# ===================== 🪟 ОКНО ОБУЧЕНИЯ =====================
+# Обучение берёт последние ML_TRAIN_WINDOW_ROWS строк датасета (и/или ML_TRAIN_WINDOW_DAYS дней)
+# плюс равномерную выборку ML_RESERVOIR_ROWS более старых сигналов. Колонки signal/ts читаются
+# с диска кусками по ML_DATASET_CHUNK_ROWS, матрица признаков — только для выбранных строк:
+# память и время переобучения не растут вместе с историей. 0 — ограничение выключено.
+ML_TRAIN_WINDOW_ROWS = int(os.getenv("ML_TRAIN_WINDOW_ROWS", "50000"))
+ML_TRAIN_WINDOW_DAYS = int(os.getenv("ML_TRAIN_WINDOW_DAYS", "0"))
+ML_RESERVOIR_ROWS = int(os.getenv("ML_RESERVOIR_ROWS", "10000"))
+ML_DATASET_CHUNK_ROWS = int(os.getenv("ML_DATASET_CHUNK_ROWS", "65536"))
+_RESERVOIR_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+def _reservoir_keys(signal: np.ndarray, seed: int) -> np.ndarray:
+    """Псевдослучайный ключ сигнала: все копии одного сигнала попадают в выборку вместе"""
+    with np.errstate(over="ignore"):
+        return (signal.astype(np.int64).view(np.uint64) ^ np.uint64(seed)) * _RESERVOIR_MIX
+
+def select_training_rows(dataset: dict, window_rows: int = None, window_days: int = None,
+                         reservoir_size: int = None, seed: int = 42) -> Tuple[np.ndarray, Dict]:
+    """
+    Строки датасета для обучения (по возрастанию): окно свежих строк + резервуар старых.
+    Резервуар — k наименьших ключей сигналов, сливается по кускам (память O(k + кусок)).
+    """
+    window_rows = ML_TRAIN_WINDOW_ROWS if window_rows is None else window_rows
+    window_days = ML_TRAIN_WINDOW_DAYS if window_days is None else window_days
+    reservoir_size = ML_RESERVOIR_ROWS if reservoir_size is None else reservoir_size
+    total = int(dataset['rows'])
+    first_window_row = max(0, total - window_rows) if window_rows > 0 else 0
+    cutoff_ns = (pd.Timestamp(datetime.now() - timedelta(days=window_days)).value
+                 if window_days > 0 else None)
+
+    window_parts = []
+    res_keys = np.empty(0, dtype=np.uint64)
+    res_rows = np.empty(0, dtype=np.int64)
+    for start in range(0, total, ML_DATASET_CHUNK_ROWS):
+        end = min(total, start + ML_DATASET_CHUNK_ROWS)
+        chunk_rows = np.arange(start, end, dtype=np.int64)
+        in_window = chunk_rows >= first_window_row
+        if cutoff_ns is not None:
+            in_window &= np.asarray(dataset['ts'][start:end]) >= cutoff_ns
+        window_parts.append(chunk_rows[in_window])
+        if reservoir_size > 0 and not in_window.all():
+            old = ~in_window
+            res_keys = np.concatenate([res_keys, _reservoir_keys(np.asarray(dataset['signal'][start:end])[old], seed)])
+            res_rows = np.concatenate([res_rows, chunk_rows[old]])
+            if len(res_keys) > reservoir_size:
+                keep = np.argpartition(res_keys, reservoir_size - 1)[:reservoir_size]
+                res_keys, res_rows = res_keys[keep], res_rows[keep]
+
+    window = np.concatenate(window_parts) if window_parts else np.empty(0, dtype=np.int64)
+    selected = np.sort(np.concatenate([window, res_rows]))
+    return selected, {"total_rows": total, "window_rows": int(len(window)), "reservoir_rows": int(len(res_rows))}
+
+ML_TRAIN_N_JOBS = int(os.getenv("ML_TRAIN_N_JOBS", "-1"))
+ML_CV_N_JOBS = int(os.getenv("ML_CV_N_JOBS", "2"))  # процессов на фолды CV (вне процесса обучения)
+
+def cross_val_on_folds(model, X: np.ndarray, y: np.ndarray, splits: List[tuple]) -> Tuple[float, float]:
+    """CV на заранее нарезанных фолдах: фолды параллельно, модель внутри фолда — в одном потоке"""
+    from sklearn.base import clone
+    n_jobs = max(1, min(ML_CV_N_JOBS, len(splits)))
+    estimator = clone(model)
+    if n_jobs > 1 and 'n_jobs' in estimator.get_params():
+        estimator.set_params(n_jobs=1)
+    scores = cross_val_score(estimator, X, y, cv=splits, scoring='accuracy', n_jobs=n_jobs)
+    return float(np.mean(scores)), float(np.std(scores))
+
+class TrainingCancelled(Exception):
+    """Обучение отменено администратором (проверяется между этапами)"""
+
+# ===================== 🔬 ПОИСК ГИПЕРПАРАМЕТРОВ =====================
+# ML_HPARAM_SEARCH=1: перед финальным обучением кандидаты RandomForest/MLP оцениваются на
+# walk-forward фолдах (TimeSeriesSplit) в пуле процессов. Фолды идут раундами: после каждого
+# слабые кандидаты отсекаются. Поиск ограничен по времени (ML_SEARCH_BUDGET_SEC) и по CPU.
+# Лидерборд попадает в model_info["hparam_search"] → ml_info.json.
+import multiprocessing
+import queue as queue_module
+from sklearn.model_selection import StratifiedKFold, TimeSeriesSplit
+from sklearn.utils import resample
+from time import process_time
+
+ML_HPARAM_SEARCH = os.getenv("ML_HPARAM_SEARCH", "0").lower() in ("1", "true", "yes")
+ML_SEARCH_WORKERS = int(os.getenv("ML_SEARCH_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+ML_SEARCH_CANDIDATES = int(os.getenv("ML_SEARCH_CANDIDATES", "24"))
+ML_SEARCH_FOLDS = int(os.getenv("ML_SEARCH_FOLDS", "4"))
+ML_SEARCH_BUDGET_SEC = float(os.getenv("ML_SEARCH_BUDGET_SEC", "600"))
+ML_SEARCH_CPU_BUDGET_SEC = float(os.getenv("ML_SEARCH_CPU_BUDGET_SEC", str(ML_SEARCH_BUDGET_SEC * ML_SEARCH_WORKERS)))
+ML_SEARCH_KEEP_FRACTION = 0.5  # доля кандидатов, проходящих в следующий раунд
+ML_SEARCH_PRUNE_MARGIN = 0.03  # и не хуже лидера больше чем на 3 п.п.
+ML_SEARCH_LEADERBOARD = 10
+SEARCH_MP = multiprocessing.get_context("spawn")
+
+DEFAULT_RF_PARAMS = {
+    'n_estimators': 250,
+    'max_depth': 7,
+    'min_samples_split': 15,
+    'min_samples_leaf': 6,
+    'max_features': 0.6,
+    'max_samples': 0.85,
+    'min_weight_fraction_leaf': 0.00,
+    'random_state': 42,
+    'class_weight': 'balanced_subsample',
+}
+DEFAULT_MLP_PARAMS = {
+    'hidden_layer_sizes': (64, 32),
+    'activation': 'tanh',
+    'solver': 'adam',
+    'learning_rate_init': 0.001,
+    'alpha': 0.0001,
+    'max_iter': 400,
+    'random_state': 42,
+    'early_stopping': True,
+    'n_iter_no_change': 10,
+    'validation_fraction': 0.15,
+}
+SEARCH_SPACE = {
+    "rf": {
+        'n_estimators': [150, 250, 400],
+        'max_depth': [5, 7, 9, 12],
+        'min_samples_leaf': [3, 6, 12],
+        'max_features': [0.4, 0.6, 0.8],
+        'max_samples': [0.7, 0.85, None],
+    },
+    "mlp": {
+        'hidden_layer_sizes': [(32,), (64, 32), (128, 64)],
+        'activation': ['tanh', 'relu'],
+        'alpha': [0.0001, 0.001, 0.01],
+        'learning_rate_init': [0.0005, 0.001, 0.003],
+    },
+}
+
+_SEARCH_DATA: Dict[str, np.ndarray] = {}
+
+def _search_worker_init(X: np.ndarray, y: np.ndarray, w: np.ndarray):
+    """Данные передаются в каждый процесс пула один раз, а не с каждой задачей"""
+    _SEARCH_DATA.update(X=X, y=y, w=w)
 
-    await update.message.reply_text("🔄 Запускаю восстановление ml_features для всех сделок...")
+def build_estimator(kind: str, params: Dict, n_jobs: int = 1):
+    from sklearn.neural_network import MLPClassifier
+    if kind == "rf":
+        return RandomForestClassifier(**dict(DEFAULT_RF_PARAMS, **params, n_jobs=n_jobs))
+    return MLPClassifier(**dict(DEFAULT_MLP_PARAMS, **params))
 
-    repaired_count = repair_ml_features()
+def oversample_minority(index: np.ndarray, y: np.ndarray, random_state: int = 42) -> np.ndarray:
+    """Индексы строк, где WIN дублированы до числа LOSS, если WIN заметно меньше (иначе как есть)"""
+    minority = index[y[index] == 1]
+    majority = index[y[index] == 0]
+    if len(minority) == 0 or len(majority) == 0 or len(minority) / len(majority) >= 0.8:
+        return index
+    upsampled = resample(minority, replace=True, n_samples=len(majority), random_state=random_state)
+    return np.concatenate([majority, upsampled])
 
-    if repaired_count > 0:
-        await update.message.reply_text(
-            f"✅ Обновлено ml_features для {repaired_count} сделок!\n"
-            f"🚀 Теперь можно запустить /forcetrain для переобучения модели."
-        )
-    else:
-        await update.message.reply_text("ℹ️ Все сделки уже содержат ml_features, восстановление не требуется.")
+def _evaluate_candidate_fold(kind: str, params: Dict, train_idx: np.ndarray, test_idx: np.ndarray) -> Tuple[float, float]:
+    """
+    Точность кандидата на одном walk-forward фолде и потраченное CPU-время процесса.
+    Балансировка — только в train-части фолда; test-часть остаётся с реальной долей классов.
+    """
+    cpu_started = process_time()
+    X, y, w = _SEARCH_DATA['X'], _SEARCH_DATA['y'], _SEARCH_DATA['w']
+    train_idx = oversample_minority(train_idx, y)
+    scaler = StandardScaler()
+    X_train = scaler.fit_transform(X[train_idx])
+    model = build_estimator(kind, params)
+    try:
+        model.fit(X_train, y[train_idx], sample_weight=w[train_idx])
+    except TypeError:
+        model.fit(X_train, y[train_idx])
+    score = accuracy_score(y[test_idx], model.predict(scaler.transform(X[test_idx])))
+    return float(score), process_time() - cpu_started
+
+def sample_search_candidates(n: int = ML_SEARCH_CANDIDATES, seed: int = 42) -> List[dict]:
+    """Текущие конфиги + случайные точки из SEARCH_SPACE поровну для RF и MLP (без повторов)"""
+    rng = random.Random(seed)
+    candidates = [{"kind": "rf", "params": {}}, {"kind": "mlp", "params": {}}]
+    seen = {("rf", "{}"), ("mlp", "{}")}
+    attempts = 0
+    while len(candidates) < max(n, 2) and attempts < n * 20:
+        attempts += 1
+        kind = "rf" if len(candidates) % 2 == 0 else "mlp"
+        params = {name: rng.choice(values) for name, values in SEARCH_SPACE[kind].items()}
+        key = (kind, json.dumps(params, sort_keys=True, default=str))
+        if key not in seen:
+            seen.add(key)
+            candidates.append({"kind": kind, "params": params})
+    return candidates
+
+def _prune_candidates(alive: List[dict]) -> List[dict]:
+    ranked = sorted(alive, key=lambda c: c["mean_acc"], reverse=True)
+    keep = max(2, int(np.ceil(len(ranked) * ML_SEARCH_KEEP_FRACTION)))
+    leader = ranked[0]["mean_acc"]
+    survivors = [c for c in ranked[:keep] if c["mean_acc"] >= leader - ML_SEARCH_PRUNE_MARGIN]
+    for c in ranked:
+        if c not in survivors:
+            c["pruned"] = True
+    return survivors
+
+def run_hparam_search(X: np.ndarray, y: np.ndarray, w: np.ndarray, cancel_event=None,
+                      workers: int = ML_SEARCH_WORKERS) -> dict:
+    """
+    Раунды по фолдам: в раунде k все живые кандидаты считают фолд k параллельно,
+    затем слабые отсекаются. Возвращает лучшие параметры RF/MLP и лидерборд.
+    X — уникальные строки train-части в порядке времени (без масштабирования и балансировки).
+    При исчерпании бюджета или отмене процессы пула завершаются, не дожидаясь начатых фолдов.
+    """
+    started = monotonic()
+    deadline = started + ML_SEARCH_BUDGET_SEC
+    folds = list(TimeSeriesSplit(n_splits=max(2, ML_SEARCH_FOLDS)).split(X))
+    candidates = sample_search_candidates()
+    for c in candidates:
+        c.update(scores=[], mean_acc=0.0, pruned=False)
+
+    pool = None
+    if workers > 1:
+        try:
+            pool = SEARCH_MP.Pool(processes=workers, initializer=_search_worker_init, initargs=(X, y, w))
+        except Exception as e:
+            logging.warning(f"⚠️ Пул процессов для поиска недоступен ({e}) — считаем последовательно")
+    if pool is None:
+        _search_worker_init(X, y, w)
 
+    cpu_spent, stop_reason = 0.0, None
+    alive = list(candidates)
+    try:
+        for fold_no, (train_idx, test_idx) in enumerate(folds):
+            if pool is not None:
+                finished = queue_module.Queue()
+                for n, c in enumerate(alive):
+                    pool.apply_async(_evaluate_candidate_fold, (c["kind"], c["params"], train_idx, test_idx),
+                                     callback=lambda result, n=n: finished.put((n, result, None)),
+                                     error_callback=lambda error, n=n: finished.put((n, None, error)))
+                pending = len(alive)
+                while pending:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise TrainingCancelled("Поиск гиперпараметров")
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        stop_reason = "budget_time"
+                        break
+                    try:
+                        n, result, error = finished.get(timeout=min(1.0, remaining))
+                    except queue_module.Empty:
+                        continue
+                    pending -= 1
+                    c = alive[n]
+                    if error is None:
+                        score, cpu = result
+                        c["scores"].append(score)
+                        cpu_spent += cpu
+                    else:
+                        logging.warning(f"⚠️ Кандидат {c['kind']} {c['params']} упал: {error}")
+                        c["pruned"] = True
+            else:
+                for c in alive:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise TrainingCancelled("Поиск гиперпараметров")
+                    if monotonic() >= deadline:
+                        stop_reason = "budget_time"
+                        break
+                    score, cpu = _evaluate_candidate_fold(c["kind"], c["params"], train_idx, test_idx)
+                    c["scores"].append(score)
+                    cpu_spent += cpu
+
+            # Незавершённый раунд не сравниваем: отсечение только по одинаковому числу фолдов
+            for c in alive:
+                if c["scores"]:
+                    c["mean_acc"] = float(np.mean(c["scores"]))
+            if stop_reason:
+                break
+            alive = [c for c in alive if not c["pruned"] and len(c["scores"]) == fold_no + 1]
+            if cpu_spent >= ML_SEARCH_CPU_BUDGET_SEC:
+                stop_reason = "budget_cpu"
+                break
+            if fold_no < len(folds) - 1:
+                alive = _prune_candidates(alive)
+            logging.info(f"🔬 Раунд {fold_no + 1}/{len(folds)}: осталось {len(alive)} кандидатов, "
+                         f"{monotonic() - started:.0f} сек, CPU {cpu_spent:.0f} сек")
+    finally:
+        if pool is not None:
+            # Все нужные результаты уже получены: начатые фолды (бюджет, отмена) убиваем вместе с процессами,
+            # чтобы они не конкурировали с финальным обучением RF/MLP
+            pool.terminate()
+            pool.join()
+
+    def rank_key(c):
+        return (len(c["scores"]), c["mean_acc"])
+
+    scored = sorted((c for c in candidates if c["scores"]), key=rank_key, reverse=True)
+    best = {}
+    for kind in ("rf", "mlp"):
+        of_kind = [c for c in scored if c["kind"] == kind]
+        best[kind] = of_kind[0]["params"] if of_kind else {}
+
+    leaderboard = [{
+        "kind": c["kind"],
+        "params": {k: (list(v) if isinstance(v, tuple) else v) for k, v in c["params"].items()} or "default",
+        "folds": len(c["scores"]),
+        "cv_accuracy": round(c["mean_acc"] * 100, 2),
+        "pruned": c["pruned"],
+    } for c in scored[:ML_SEARCH_LEADERBOARD]]
+    result = {
+        "best": best,
+        "leaderboard": leaderboard,
+        "candidates": len(candidates),
+        "folds": len(folds),
+        "workers": workers if pool is not None else 1,
+        "elapsed_sec": round(monotonic() - started, 1),
+        "cpu_sec": round(cpu_spent, 1),
+        "stopped": stop_reason or "completed",
+    }
+    if leaderboard:
+        top = leaderboard[0]
+        logging.info(f"🔬 Поиск завершён ({result['stopped']}): лидер {top['kind']} {top['params']} "
+                     f"CV={top['cv_accuracy']:.2f}% за {result['elapsed_sec']} сек")
+    return result
+
+def collect_training_trades() -> List[Dict]:
+    """История сделок для обучения: все пользователи или один (MULTI_USER_MODE)"""
+    all_trades = []
+    if MULTI_USER_MODE:
+        for user_data in users.values():
+            all_trades.extend(user_data.get('trade_history', []))
+        logging.info(f"📊 ML: собрано {len(all_trades)} сделок из {len(users)} пользователей")
+    else:
+        all_trades.extend(single_user_data.get('trade_history', []))
+        logging.info(f"📊 ML: собрано {len(all_trades)} сделок из одного пользователя")
+    return all_trades
 
-# ===================== 🧠 ОБНОВЛЁННЫЙ БЛОК ОБУЧЕНИЯ ML (RandomForest + MLPClassifier + Oversampling) =====================
-def train_ml_model():
+def train_ml_model(trades: Optional[List[Dict]] = None, progress=None, cancel_event=None,
+                   exclude_rows: Optional[np.ndarray] = None, activate: bool = True):
     """
     Устойчивое обучение:
     - time-based split
@@ -2301,135 +4862,141 @@ def train_ml_model():
     - oversampling для балансировки классов WIN/LOSS
     - выбор фич: из pkl/истории или по важности (top-K)
     - сохраняем победившую модель + метаинформацию
+    trades — снимок сделок (в процессе обучения), progress(stage, pct) — отчёт о ходе,
+    cancel_event — отмена между этапами. exclude_rows — строки датасета, отложенные для
+    сравнения с чемпионом; activate=False — версия публикуется, но не становится активной.
     """
     global ml_model, ml_scaler, model_info
 
+    stage_timings: Dict[str, float] = {}
+    current_stage = {'name': None, 'started': monotonic()}
+
+    def stage(name: str, pct: int):
+        if cancel_event is not None and cancel_event.is_set():
+            raise TrainingCancelled(name)
+        now = monotonic()
+        if current_stage['name'] is not None:
+            stage_timings[current_stage['name']] = round(now - current_stage['started'], 3)
+        current_stage.update(name=name, started=now)
+        if progress is not None:
+            progress(name, pct)
+
     try:
         # ========== 1️⃣ СБОР ДАННЫХ ==========
-        all_trades = []
-        if MULTI_USER_MODE:
-            for user_data in users.values():
-                all_trades.extend(user_data.get('trade_history', []))
-            logging.info(f"📊 ML: собрано {len(all_trades)} сделок из {len(users)} пользователей")
-        else:
-            all_trades.extend(single_user_data.get('trade_history', []))
-            logging.info(f"📊 ML: собрано {len(all_trades)} сделок из одного пользователя")
+        stage("Сбор данных", 0)
+        # Колоночный датасет (memmap) или, если передан, снимок сделок
+        dataset = dataset_from_trades(trades) if trades is not None else DATASET_STORE.load()
+        if not dataset or dataset['rows'] == 0:
+            logging.warning(f"⚠ Недостаточно данных для обучения: 0 < {MIN_SAMPLES_TO_TRAIN}")
+            return
 
-        completed = [
-            t for t in all_trades
-            if t.get('result') in ('WIN', 'LOSS')
-            and isinstance(t.get('ml_features'), dict)
-        ]
-        if len(completed) < MIN_SAMPLES_TO_TRAIN:
-            logging.warning(f"⚠ Недостаточно данных для обучения: {len(completed)} < {MIN_SAMPLES_TO_TRAIN}")
+        # 🪟 Окно свежих строк + резервуар старых (колонки читаются кусками)
+        selected, window_info = select_training_rows(dataset)
+        # 🔁 Один сигнал, разосланный N пользователям, — одна строка (вес по ML_DEDUP_WEIGHTING)
+        signal = np.asarray(dataset['signal'][selected])
+        keep, row_weights = dedup_signal_rows(signal)
+        rows = selected[keep]
+        if exclude_rows is not None and len(exclude_rows):
+            mask = ~np.isin(signal[keep], np.asarray(dataset['signal'][exclude_rows]))
+            rows, row_weights = rows[mask], row_weights[mask]
+        n_samples = len(rows)
+        logging.info(f"📊 ML: {dataset['rows']} завершённых сделок, окно {window_info['window_rows']} + "
+                     f"резервуар {window_info['reservoir_rows']} → {n_samples} уникальных сигналов")
+        if n_samples < MIN_SAMPLES_TO_TRAIN:
+            logging.warning(f"⚠ Недостаточно данных для обучения: {n_samples} < {MIN_SAMPLES_TO_TRAIN}")
             return
 
         # ========== 2️⃣ ФОРМИРОВАНИЕ ФИЧ ==========
-        base_feature_names = None
-        for t in reversed(completed[-400:]):
-            feats = t.get('ml_features')
-            if isinstance(feats, dict) and len(feats) >= 10:
-                base_feature_names = list(feats.keys())
-                break
+        stage("Формирование признаков", 5)
+        base_feature_names = dataset['feature_names']
         if not base_feature_names:
             logging.warning("❌ Нет сделок с ml_features — обучение невозможно")
             return
-
-        X, y, ts = [], [], []
-        for tr in completed:
-            feats = tr.get('ml_features', {})
-            X.append([float(feats.get(f, 0.0)) for f in base_feature_names])
-            y.append(1 if tr.get('result') == 'WIN' else 0)
-            ts.append(tr.get('timestamp', None))
-
-        X = np.asarray(X, dtype=float)
-        y = np.asarray(y, dtype=int)
-        ts = pd.to_datetime(pd.Series(ts), errors='coerce').astype('int64').fillna(0).to_numpy()
+        X_all = dataset['X']
+        y_all = np.asarray(dataset['y'][rows], dtype=int)
+        ts = np.asarray(dataset['ts'][rows])
 
         # ========== ⚖️ 3️⃣ БАЛАНСИРОВКА КЛАССОВ (oversampling) ==========
-        from sklearn.utils import resample
-        X_df = pd.DataFrame(X, columns=base_feature_names)
-        y_df = pd.Series(y, name='target')
-        df_balanced = pd.concat([X_df, y_df], axis=1)
-
-        minority = df_balanced[df_balanced.target == 1]
-        majority = df_balanced[df_balanced.target == 0]
-
-        # oversampling только если WIN сильно меньше
-        if len(minority) / len(majority) < 0.8:
-            minority_upsampled = resample(
-                minority,
-                replace=True,
-                n_samples=len(majority),
-                random_state=42
-            )
-            df_balanced = pd.concat([majority, minority_upsampled])
-            logging.info(f"⚖️ Балансировка классов: WIN {len(minority)} → {len(minority_upsampled)}")
+        stage("Балансировка классов", 10)
+        # oversampling только если WIN сильно меньше (работаем с индексами строк)
+        index = oversample_minority(np.arange(n_samples), y_all)
+        if len(index) > n_samples:
+            wins = int(np.sum(y_all == 1))
+            logging.info(f"⚖️ Балансировка классов: WIN {wins} → {len(index) - (n_samples - wins)}")
         else:
+            index = np.arange(n_samples)
             logging.info("⚖️ Балансировка не требуется — классы сбалансированы")
 
-        # обновляем X и y после балансировки
-        X = df_balanced[base_feature_names].values
-        y = df_balanced["target"].values
-
         # ========== 4️⃣ TIME-BASED SPLIT ==========
-        order = np.argsort(ts[:len(X)])  # сортируем по времени
-        X, y = X[order], y[order]
+        order = index[np.argsort(ts[index], kind="stable")]  # сортируем по времени входа
+        X = np.asarray(X_all[rows[order]])  # одна выборка строк из memmap
+        y = y_all[order]
+        w = row_weights[order]
         split_idx = int(len(X) * 0.75)
         X_train, X_test = X[:split_idx], X[split_idx:]
         y_train, y_test = y[:split_idx], y[split_idx:]
+        w_train = w[:split_idx]
         logging.info(f"🕒 Time-based split: train={len(X_train)}, test={len(X_test)}")
 
-        # ========== 5️⃣ МАСШТАБИРОВАНИЕ ==========
-        scaler = StandardScaler()
-        X_train_s = scaler.fit_transform(X_train)
-        X_test_s = scaler.transform(X_test)
-
-        # ========== 6️⃣ RANDOM FOREST ==========
-        params = {
-            'n_estimators': 250,
-            'max_depth': 7,
-            'min_samples_split': 15,
-            'min_samples_leaf': 6,
-            'max_features': 0.6,
-            'max_samples': 0.85,
-            'min_weight_fraction_leaf': 0.00,
-            'random_state': 42,
-            'class_weight': 'balanced_subsample',
-            'n_jobs': -1,
-        }
-        base_model = RandomForestClassifier(**params)
-        base_model.fit(X_train_s, y_train)
-
-        # оценка
-        train_acc = accuracy_score(y_train, base_model.predict(X_train_s))
-        test_acc = accuracy_score(y_test, base_model.predict(X_test_s))
-        overfit_ratio = train_acc / max(test_acc, 1e-6)
-
-        # ========== 7️⃣ ВЫБОР ПРИЗНАКОВ ==========
+        # ========== 5️⃣ ВЫБОР ПРИЗНАКОВ ==========
+        # Сохранённый список признаков — лес на всех признаках (только ради важностей) не нужен
         preserved = _get_expected_feature_list()
+        base_model = scaler = None
         if preserved:
             selected_features = [f for f in preserved if f in base_feature_names]
             logging.info(f"📝 Используем сохранённый список признаков: {len(selected_features)} шт.")
         else:
+            # ========== 6️⃣ RANDOM FOREST (важности признаков) ==========
+            stage("RandomForest (все признаки)", 15)
+            scaler = StandardScaler()
+            X_train_s = scaler.fit_transform(X_train)
+            base_model = build_estimator("rf", {}, n_jobs=ML_TRAIN_N_JOBS)
+            base_model.fit(X_train_s, y_train, sample_weight=w_train)
+
             importances = base_model.feature_importances_
             pairs = list(zip(base_feature_names, importances))
             pairs.sort(key=lambda x: x[1], reverse=True)
             k = min(TOP_K_FEATURES or len(pairs), len(pairs))
-            selected_features = [f for f, _ in pairs[:k]]
-            logging.info(f"🏆 Выбраны top-{len(selected_features)} признаков по важности")
+            if k == len(pairs):
+                selected_features = list(base_feature_names)  # все признаки — порядок датасета
+                logging.info(f"🏆 Используются все {k} признаков")
+            else:
+                selected_features = [f for f, _ in pairs[:k]]
+                logging.info(f"🏆 Выбраны top-{len(selected_features)} признаков по важности")
 
+        # ========== 7️⃣ RANDOM FOREST ==========
+        stage("Выбор признаков и RandomForest", 35)
         idx = {f: i for i, f in enumerate(base_feature_names)}
         cols = [idx[f] for f in selected_features if f in idx]
         X_train_top = X_train[:, cols]
         X_test_top = X_test[:, cols]
 
-        scaler2 = StandardScaler()
-        X_train_top_s = scaler2.fit_transform(X_train_top)
+        # Масштабированные матрицы — одни на RF, MLP и все фолды CV
+        if base_model is not None and cols == list(range(len(base_feature_names))):
+            scaler2, X_train_top_s = scaler, X_train_s
+        else:
+            scaler2 = StandardScaler()
+            X_train_top_s = scaler2.fit_transform(X_train_top)
         X_test_top_s = scaler2.transform(X_test_top)
 
-        model_rf = RandomForestClassifier(**params)
-        model_rf.fit(X_train_top_s, y_train)
+        # 🔬 Поиск гиперпараметров на walk-forward фолдах (по умолчанию — текущие конфиги)
+        search = None
+        best_params = {"rf": {}, "mlp": {}}
+        if ML_HPARAM_SEARCH:
+            stage("Поиск гиперпараметров", 40)
+            # Уникальные строки train-части по времени: дубли балансировки исказили бы фолды
+            search_ids = np.unique(order[:split_idx])
+            search_ids = search_ids[np.argsort(ts[search_ids], kind="stable")]
+            X_search = np.asarray(X_all[rows[search_ids]])[:, cols]
+            search = run_hparam_search(X_search, y_all[search_ids], row_weights[search_ids],
+                                       cancel_event=cancel_event)
+            best_params = search["best"]
+
+        if scaler2 is scaler and not best_params["rf"]:
+            model_rf = base_model  # тот же лес на тех же данных — второй раз не обучаем
+        else:
+            model_rf = build_estimator("rf", best_params["rf"], n_jobs=ML_TRAIN_N_JOBS)
+            model_rf.fit(X_train_top_s, y_train, sample_weight=w_train)
 
         y_tr2 = model_rf.predict(X_train_top_s)
         y_te2 = model_rf.predict(X_test_top_s)
@@ -2438,10 +5005,12 @@ def train_ml_model():
         f12 = f1_score(y_test, y_te2, zero_division=0)
         overfit_ratio2 = train_acc2 / max(test_acc2, 1e-6)
 
+        # Фолды нарезаются один раз и общие для RF и MLP
+        stage("Кросс-валидация RandomForest", 50)
         folds = min(5, max(2, len(X_train_top_s)//400))
+        cv_splits = list(StratifiedKFold(n_splits=folds).split(X_train_top_s, y_train))
         try:
-            cv_scores = cross_val_score(model_rf, X_train_top_s, y_train, cv=folds, scoring='accuracy')
-            cv_mean, cv_std = float(np.mean(cv_scores)), float(np.std(cv_scores))
+            cv_mean, cv_std = cross_val_on_folds(model_rf, X_train_top_s, y_train, cv_splits)
         except Exception as e:
             logging.warning(f"CV пропущен: {e}")
             cv_mean, cv_std = float('nan'), float('nan')
@@ -2449,20 +5018,13 @@ def train_ml_model():
         logging.info(f"✅ RandomForest: Test={test_acc2:.3f} | Train={train_acc2:.3f} | Overfit={overfit_ratio2:.2f}")
 
         # ========== 8️⃣ MLP CLASSIFIER ==========
-        from sklearn.neural_network import MLPClassifier
+        stage("MLPClassifier", 65)
         try:
-            mlp = MLPClassifier(
-                hidden_layer_sizes=(64, 32),
-                activation='tanh',
-                solver='adam',
-                learning_rate_init=0.001,
-                max_iter=400,
-                random_state=42,
-                early_stopping=True,
-                n_iter_no_change=10,
-                validation_fraction=0.15,
-            )
-            mlp.fit(X_train_top_s, y_train)
+            mlp = build_estimator("mlp", best_params["mlp"])
+            try:
+                mlp.fit(X_train_top_s, y_train, sample_weight=w_train)
+            except TypeError:
+                mlp.fit(X_train_top_s, y_train)  # старый sklearn без sample_weight у MLP
 
             y_pred_mlp_train = mlp.predict(X_train_top_s)
             y_pred_mlp_test = mlp.predict(X_test_top_s)
@@ -2471,10 +5033,8 @@ def train_ml_model():
             test_acc_mlp = accuracy_score(y_test, y_pred_mlp_test)
             overfit_mlp = train_acc_mlp / max(test_acc_mlp, 1e-6)
 
-            folds_mlp = min(5, max(2, len(X_train_top_s)//400))
             try:
-                cv_scores_mlp = cross_val_score(mlp, X_train_top_s, y_train, cv=folds_mlp, scoring='accuracy')
-                cv_mean_mlp, cv_std_mlp = float(np.mean(cv_scores_mlp)), float(np.std(cv_scores_mlp))
+                cv_mean_mlp, cv_std_mlp = cross_val_on_folds(mlp, X_train_top_s, y_train, cv_splits)
             except Exception as e:
                 logging.warning(f"CV (MLP) пропущен: {e}")
                 cv_mean_mlp, cv_std_mlp = float('nan'), float('nan')
@@ -2511,12 +5071,16 @@ def train_ml_model():
             best_cv = cv_mean
             best_overfit = overfit_ratio2
 
-        # ========== 🔟 СОХРАНЕНИЕ ==========
-        joblib.dump(best_model, ML_MODEL_PATH)
-        joblib.dump(best_scaler, ML_SCALER_PATH)
-
+        # ========== 🔟 СОХРАНЕНИЕ (новая версия в реестре) ==========
+        stage("Сохранение версии", 90)
         win_rate_overall = float(np.mean(y)) * 100.0
 
+        # 🪶 Компактная копия для фолбэка под нагрузкой
+        distilled, distill_report = distill_model(best_model, X_train_top_s, X_test_top_s,
+                                                  y_train=y_train, splits=cv_splits, sample_weight=w_train)
+        stage_timings[current_stage['name']] = round(monotonic() - current_stage['started'], 3)
+        logging.info("⏱ Этапы обучения: " + ", ".join(f"{k} {v:.1f}с" for k, v in stage_timings.items()))
+
         model_info = {
             "trained_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "n_features": len(selected_features),
@@ -2529,21 +5093,555 @@ def train_ml_model():
             "train_samples": int(len(y_train)),
             "test_samples": int(len(y_test)),
             "win_rate": round(win_rate_overall, 2),
-            "model_type": best_type
+            "trades_raw": int(dataset['rows']),
+            "unique_signals": int(n_samples),
+            "dedup_weighting": ML_DEDUP_WEIGHTING,
+            "training_window": window_info,
+            # Сколько строк колоночного датасета видела модель — отсюда продолжит дообучение
+            "dataset_rows": (int(np.min(exclude_rows)) if exclude_rows is not None and len(exclude_rows)
+                             else int(dataset['rows'])) if trades is None else None,
+            # Поколение датасета: после пересборки номера строк другие, водяной знак недействителен
+            "dataset_generation": dataset.get('generation') if trades is None else None,
+            "full_refit_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "updates_since_full": 0,
+            "model_type": best_type,
+            "skipped_features": get_feature_plan(selected_features).skipped_features,
+            "distilled": distill_report,
+            "hparam_search": search,
+            "stage_timings_sec": stage_timings,
+            "feature_importance_fit": base_model is not None
         }
 
-        with open(ML_INFO_LAST, "w", encoding="utf-8") as f:
-            json.dump(model_info, f, ensure_ascii=False, indent=2)
+        version = publish_model_version(best_model, best_scaler, model_info, activate=activate,
+                                        extras={"distilled": distilled})
+        model_info["version"] = version
         _append_ml_info(model_info)
 
-        ml_model, ml_scaler = best_model, best_scaler
+        if activate:
+            _write_json_atomic(ML_INFO_LAST, model_info)
+            # Объекты уже в памяти — подменяем связку сразу, без повторного чтения с диска
+            activate_model_bundle(make_model_bundle(version, best_model, best_scaler, model_info, distilled))
         logging.info(f"✅ Финальная модель: {best_type} | Test={best_test_acc:.3f} | Train={best_train_acc:.3f}")
 
         return model_info
 
+    except TrainingCancelled as e:
+        logging.warning(f"🛑 Обучение ML отменено на этапе: {e}")
+        return {"error": "Обучение отменено", "cancelled": True}
     except Exception as e:
         logging.error(f"❌ Ошибка обучения ML: {e}", exc_info=True)
 
+# ===================== 🏭 ОБУЧЕНИЕ В ОТДЕЛЬНОМ ПРОЦЕССЕ =====================
+# /retrain запускает train_ml_model в дочернем процессе (spawn): event loop, сканирование и
+# инференс работают как обычно. Процесс публикует версию в реестр (models/<version>/ + MANIFEST),
+# основной бот подхватывает её refresh_active_model. Прогресс — через очередь, отмена — через Event.
+import atexit
+import multiprocessing
+import queue as queue_module
+import uuid
+
+TRAINING_MP = multiprocessing.get_context("spawn")
+TRAINING_POLL_SEC = 5
+TRAINING_CANCEL_GRACE_SEC = 30  # после отмены ждём конца этапа, затем terminate()
+TRAINING_JOBS: Dict[str, dict] = {}
+# Слот обучения: запуск процесса обучения и дообучение в потоке не пересекаются (одна публикация за раз)
+TRAINING_SLOT_LOCK = threading.Lock()
+
+def _terminate_training_jobs():
+    """При выходе бота процесс обучения (не daemon) не должен держать завершение"""
+    for job in TRAINING_JOBS.values():
+        process = job.get('process')
+        if process is not None and process.is_alive():
+            process.terminate()
+            process.join(5)
+
+atexit.register(_terminate_training_jobs)
+
+def _training_process_main(job_id: str, trades: Optional[List[Dict]], progress_queue, cancel_event,
+                           challenger: bool = False):
+    """Точка входа дочернего процесса обучения"""
+    global ML_TRAIN_N_JOBS, ML_CV_N_JOBS
+
+    def progress(stage_name: str, pct: int):
+        progress_queue.put(('progress', stage_name, pct))
+
+    # Одно ядро на обучение моделей и фолды CV: CPU сканирования не отнимаем (параллелен только пул поиска)
+    ML_TRAIN_N_JOBS = 1
+    ML_CV_N_JOBS = 1
+    try:
+        logging.info(f"🏭 Обучение {job_id}: процесс {os.getpid()}")
+        if challenger:
+            result = run_champion_challenger(progress=progress, cancel_event=cancel_event)
+        else:
+            result = train_ml_model(trades=trades, progress=progress, cancel_event=cancel_event)
+        if result is None:
+            progress_queue.put(('error', "недостаточно данных или ошибка обучения (см. лог)"))
+        else:
+            progress_queue.put(('done', result))
+    except BaseException as e:
+        progress_queue.put(('error', str(e)))
+
+def get_running_training_job() -> Optional[dict]:
+    for job in TRAINING_JOBS.values():
+        if job['status'] in ('running', 'cancelling'):
+            return job
+    return None
+
+def start_training_job(chat_id: Optional[int], challenger: bool = False) -> dict:
+    """
+    Дочерний процесс обучения на колоночном датасете. Одновременно — только одно обучение.
+    challenger=True — новая модель становится активной, только если обыграет текущую.
+    """
+    if not TRAINING_SLOT_LOCK.acquire(blocking=False):
+        raise RuntimeError("идёт дообучение модели — повторите через минуту")
+    try:
+        return _start_training_process(chat_id, challenger)
+    finally:
+        TRAINING_SLOT_LOCK.release()
+
+def _start_training_process(chat_id: Optional[int], challenger: bool) -> dict:
+    running = get_running_training_job()
+    if running is not None:
+        raise RuntimeError(f"обучение {running['id']} уже идёт")
+
+    ensure_dataset_store()
+    job_id = datetime.now().strftime("%H%M%S-") + uuid.uuid4().hex[:6]
+    progress_queue = TRAINING_MP.Queue()
+    cancel_event = TRAINING_MP.Event()
+    process = TRAINING_MP.Process(
+        target=_training_process_main,
+        args=(job_id, None, progress_queue, cancel_event, challenger),
+        name=f"ml-train-{job_id}",
+        daemon=False  # daemon-процессу нельзя заводить пул для поиска гиперпараметров
+    )
+    process.start()
+
+    job = {
+        'id': job_id,
+        'chat_id': chat_id,
+        'process': process,
+        'queue': progress_queue,
+        'cancel': cancel_event,
+        'challenger': challenger,
+        'status': 'running',
+        'stage': None,
+        'pct': 0,
+        'result': None,
+        'error': None,
+        'started': monotonic(),
+        'cancel_requested': None
+    }
+    TRAINING_JOBS[job_id] = job
+    logging.info(f"🏭 Обучение {job_id} запущено (pid={process.pid})")
+    return job
+
+def cancel_training_job(job_id: Optional[str] = None) -> Optional[dict]:
+    job = TRAINING_JOBS.get(job_id) if job_id else get_running_training_job()
+    if job is None or job['status'] not in ('running', 'cancelling'):
+        return None
+    job['cancel'].set()
+    job['status'] = 'cancelling'
+    job['cancel_requested'] = monotonic()
+    logging.warning(f"🛑 Запрошена отмена обучения {job['id']}")
+    return job
+
+def poll_training_job(job: dict) -> List[tuple]:
+    """Забирает сообщения процесса; возвращает новые этапы прогресса. Обновляет статус задачи."""
+    updates = []
+
+    def drain():
+        while True:
+            try:
+                message = job['queue'].get_nowait()
+            except queue_module.Empty:
+                return
+            if message[0] == 'progress':
+                job['stage'], job['pct'] = message[1], message[2]
+                updates.append((message[1], message[2]))
+            elif message[0] == 'done':
+                job['result'] = message[1]
+            elif message[0] == 'error':
+                job['error'] = message[1]
+
+    process = job['process']
+    drain()
+    if not process.is_alive():
+        process.join(5)
+        drain()  # последнее сообщение могло прийти между чтением очереди и выходом процесса
+
+    if (job['status'] == 'cancelling' and process.is_alive()
+            and monotonic() - job['cancel_requested'] > TRAINING_CANCEL_GRACE_SEC):
+        logging.warning(f"🛑 Обучение {job['id']} не остановилось за {TRAINING_CANCEL_GRACE_SEC} сек — terminate()")
+        process.terminate()
+        process.join(5)
+        job['status'] = 'cancelled'
+    elif job['result'] is not None or job['error'] is not None or not process.is_alive():
+        process.join(5)
+        if job['status'] == 'cancelling' or (job['result'] or {}).get('cancelled'):
+            job['status'] = 'cancelled'
+        elif job['result'] is not None and not job['result'].get('error'):
+            job['status'] = 'done'
+        else:
+            job['status'] = 'failed'
+            job['error'] = job['error'] or (job['result'] or {}).get('error') or f"процесс завершился (код {process.exitcode})"
+    return updates
+
+# ===================== 🌱 ИНКРЕМЕНТАЛЬНОЕ ДООБУЧЕНИЕ =====================
+# Между полными переобучениями модель догоняет свежие закрытые сделки за секунды:
+# лес получает ML_INCREMENTAL_TREES новых деревьев (warm_start) на строках датасета после
+# info["dataset_rows"], MLP — partial_fit. Скейлер и схема признаков не меняются.
+# Деревья полного обучения (info["base_trees"]) не вытесняются — только старые добавленные.
+# Самые свежие ML_INCREMENTAL_CHECK_FRACTION новых строк — проверка: версия публикуется, только
+# если на них не хуже текущей; эти строки войдут в обучение следующего дообучения.
+# Раз в ML_FULL_REFIT_EVERY дообучений или ML_FULL_REFIT_HOURS часов — полное обучение в процессе.
+import copy
+from sklearn.utils.class_weight import compute_class_weight
+
+ML_INCREMENTAL_INTERVAL_SEC = int(os.getenv("ML_INCREMENTAL_INTERVAL_SEC", "1800"))
+ML_INCREMENTAL_MIN_ROWS = int(os.getenv("ML_INCREMENTAL_MIN_ROWS", "30"))
+ML_INCREMENTAL_TREES = int(os.getenv("ML_INCREMENTAL_TREES", "20"))
+ML_INCREMENTAL_MAX_TREES = int(os.getenv("ML_INCREMENTAL_MAX_TREES", "400"))  # старые добавленные вытесняются
+ML_INCREMENTAL_CHECK_FRACTION = float(os.getenv("ML_INCREMENTAL_CHECK_FRACTION", "0.3"))
+ML_FULL_REFIT_EVERY = int(os.getenv("ML_FULL_REFIT_EVERY", "12"))
+ML_FULL_REFIT_HOURS = float(os.getenv("ML_FULL_REFIT_HOURS", "24"))
+
+def needs_full_refit(info: Optional[Dict]) -> bool:
+    """Пора ли полное переобучение вместо очередного дообучения"""
+    if not info or info.get("dataset_rows") is None:
+        return True  # неизвестно, какие строки модель уже видела
+    if info.get("dataset_generation") != DATASET_STORE.meta().get('generation'):
+        return True  # датасет пересобран после обучения — строки перенумерованы
+    if int(info.get("updates_since_full", 0)) >= ML_FULL_REFIT_EVERY:
+        return True
+    try:
+        full_at = datetime.strptime(info.get("full_refit_at") or info.get("trained_at"), "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return True
+    return (datetime.now() - full_at).total_seconds() >= ML_FULL_REFIT_HOURS * 3600
+
+def _grow_forest(model, X_s: np.ndarray, y: np.ndarray, weights: np.ndarray, base_trees: int):
+    """
+    Копия леса с новыми деревьями на свежих строках. Первые base_trees деревьев (полное обучение)
+    остаются всегда; сверх лимита отбрасываются самые старые из добавленных.
+    """
+    grown = copy.deepcopy(model)
+    class_weight = grown.class_weight
+    if class_weight in ("balanced", "balanced_subsample"):
+        # Пресет balanced при warm_start не поддерживается — явные веса по свежим строкам
+        balanced = compute_class_weight("balanced", classes=grown.classes_, y=y)
+        grown.set_params(class_weight=dict(zip(grown.classes_, balanced)))
+    grown.set_params(warm_start=True, n_estimators=len(grown.estimators_) + ML_INCREMENTAL_TREES)
+    grown.fit(X_s, y, sample_weight=weights)
+    room = max(ML_INCREMENTAL_TREES, ML_INCREMENTAL_MAX_TREES - base_trees)
+    added = grown.estimators_[base_trees:]
+    if len(added) > room:
+        grown.estimators_ = grown.estimators_[:base_trees] + added[-room:]
+    grown.set_params(warm_start=False, n_estimators=len(grown.estimators_), class_weight=class_weight)
+    return grown
+
+def incremental_update_model(hold_back: int = 0) -> Optional[Dict]:
+    """
+    Дообучает активную модель на новых строках датасета и публикует версию.
+    None — дообучение не требуется или невозможно (тогда ждём полного обучения).
+    hold_back — сколько самых свежих строк не трогать (окно сравнения для претендента).
+    """
+    active = get_active_model()
+    if active is None:
+        return None
+    info = active['info']
+    watermark = info.get("dataset_rows")
+    dataset = DATASET_STORE.load()
+    if watermark is None or not dataset:
+        return None
+    upto = dataset['rows'] - max(0, int(hold_back))
+    if upto - int(watermark) < ML_INCREMENTAL_MIN_ROWS:
+        return None
+    if info.get("dataset_generation") != dataset['generation']:
+        logging.info("🌱 Дообучение пропущено: датасет пересобран после обучения модели, нужно полное обучение")
+        return None
+
+    column = {name: i for i, name in enumerate(dataset['feature_names'])}
+    missing = [name for name in active['feature_names'] if name not in column]
+    if missing:
+        logging.info(f"🌱 Дообучение пропущено: в датасете нет признаков модели ({len(missing)}), нужно полное обучение")
+        return None
+
+    fresh = np.arange(int(watermark), upto)
+    keep, weights = dedup_signal_rows(dataset['signal'][fresh])
+    fresh = fresh[keep]
+    y_new = np.asarray(dataset['y'][fresh], dtype=int)
+
+    cols = [column[name] for name in active['feature_names']]
+    X_new = np.asarray(dataset['X'][fresh])[:, cols].astype(float)
+    X_new_s = active['scaler'].transform(X_new)
+
+    # Свежая часть — проверка перед публикацией; обучаемся на остальных новых строках
+    n_check = max(1, int(round(len(fresh) * ML_INCREMENTAL_CHECK_FRACTION)))
+    fit, check = slice(0, len(fresh) - n_check), slice(len(fresh) - n_check, None)
+    if len(np.unique(y_new[fit])) < 2:
+        return None  # новым деревьям нужны оба класса, копим строки дальше
+
+    model = active['model']
+    # Точность текущей модели на ещё не виденных сделках — честная оценка перед обновлением
+    prequential_acc = float(accuracy_score(y_new, model.predict(X_new_s)))
+    base_trees = None
+    started = monotonic()
+    if isinstance(model, RandomForestClassifier):
+        base_trees = int(info.get("base_trees", max(0, len(model.estimators_)
+                                                    - ML_INCREMENTAL_TREES * int(info.get("updates_since_full", 0)))))
+        updated = _grow_forest(model, X_new_s[fit], y_new[fit], weights[fit], base_trees)
+    elif hasattr(model, "partial_fit"):
+        updated = copy.deepcopy(model)
+        if getattr(updated, "early_stopping", False):
+            updated.set_params(early_stopping=False)  # partial_fit несовместим с early_stopping
+            updated.best_loss_ = np.inf  # после early_stopping лучший loss не сохраняется
+        updated.partial_fit(X_new_s[fit], y_new[fit])
+    else:
+        logging.info(f"🌱 {type(model).__name__} не поддерживает дообучение — ждём полного обучения")
+        return None
+    fit_ms = (monotonic() - started) * 1000
+
+    check_before = float(accuracy_score(y_new[check], model.predict(X_new_s[check])))
+    check_after = float(accuracy_score(y_new[check], updated.predict(X_new_s[check])))
+    if check_after < check_before:
+        logging.info(f"🌱 Дообучение {active['version']} отклонено: на {n_check} свежих сделках "
+                     f"{check_after:.1%} < {check_before:.1%} у текущей версии")
+        return None
+
+    new_info = dict(info)
+    new_info.pop("fast_inference", None)  # замер старых версий к новому лесу не относится
+    new_info.update({
+        "trained_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        # Проверочные строки модель не видела — с них начнётся следующее дообучение
+        "dataset_rows": int(fresh[check][0]),
+        "updates_since_full": int(info.get("updates_since_full", 0)) + 1,
+        "incremental": {
+            "base_version": active['version'],
+            "rows_added": int(len(fresh) - n_check),
+            "prequential_accuracy": round(prequential_acc * 100, 2),
+            "check_rows": int(n_check),
+            "check_accuracy_before": round(check_before * 100, 2),
+            "check_accuracy_after": round(check_after * 100, 2),
+            "fit_ms": round(fit_ms, 1),
+            "n_estimators": len(getattr(updated, "estimators_", []) or []) or None,
+        },
+    })
+    if base_trees is not None:
+        new_info["base_trees"] = base_trees
+    new_info.pop("version", None)
+    # Дистиллированная копия остаётся от полного обучения — фолбэк, а не точная реплика
+    version = publish_model_version(updated, active['scaler'], new_info, extras={"distilled": active['distilled']})
+    new_info["version"] = version
+    _write_json_atomic(ML_INFO_LAST, new_info)
+    activate_model_bundle(make_model_bundle(version, updated, active['scaler'], new_info, active['distilled']))
+    logging.info(f"🌱 Дообучение {active['version']} → {version}: +{len(fresh) - n_check} сделок за {fit_ms:.0f} мс, "
+                 f"точность на новых {prequential_acc:.1%}, на проверке {check_before:.1%} → {check_after:.1%}")
+    return new_info
+
+def run_incremental_update(hold_back: int = 0) -> Optional[Dict]:
+    """Дообучение в слоте обучения: /retrain и ночное обучение не публикуют версию одновременно с ним"""
+    if not TRAINING_SLOT_LOCK.acquire(blocking=False):
+        return None
+    try:
+        if get_running_training_job() is not None:
+            return None
+        return incremental_update_model(hold_back)
+    finally:
+        TRAINING_SLOT_LOCK.release()
+
+async def incremental_training_job(context: ContextTypes.DEFAULT_TYPE):
+    """Плановое обновление модели: дообучение или, когда пора, полное обучение в процессе"""
+    if get_running_training_job() is not None:
+        return
+    try:
+        active = get_active_model()
+        if active is not None and needs_full_refit(active['info']):
+            # Полное обучение идёт через сравнение с чемпионом; после проигрыша не повторяем сразу
+            if (ML_LAST_REFIT_ATTEMPT is None
+                    or monotonic() - ML_LAST_REFIT_ATTEMPT >= ML_FULL_REFIT_HOURS * 3600):
+                if await asyncio.to_thread(challenge_window_ready, active['info']):
+                    await start_scheduled_training(context, "плановое полное")
+                else:
+                    # Дообучение на паузе: свежие сделки копятся как окно, которого чемпион не видел
+                    logging.info("🥊 Полное обучение ждёт окна сравнения: чемпион видел почти все сделки")
+                return
+            # Пока полное обучение отложено — дообучаемся, но свежие строки оставляем претенденту
+            await asyncio.to_thread(run_incremental_update, ML_CHALLENGE_MIN_ROWS)
+            return
+        await asyncio.to_thread(run_incremental_update)
+    except Exception as e:
+        logging.error(f"❌ Ошибка планового дообучения ML: {e}", exc_info=True)
+
+# ===================== 🥊 ЧЕМПИОН / ПРЕТЕНДЕНТ =====================
+# Ночью (и при плановом полном обучении) в процессе обучения учится претендент. Самые свежие
+# уникальные сигналы откладываются: претендент их не видит, и на этом окне сравниваются
+# чемпион (активная версия) и претендент — точность и задержка инференса одной строки.
+# Окно берётся только из строк после водяного знака чемпиона (info["dataset_rows"] того же
+# поколения датасета): сделки, на которых чемпион учился, в сравнение не попадают. Если знак
+# неизвестен (старая версия, датасет пересобран), чемпион оценивается на том же свежем окне
+# справочно — он мог учиться на этих строках, поэтому его оценка скорее завышена. Без оценки
+# чемпиона претендент не повышается никогда.
+# Претендент становится активным, только если проходит порог задержки и точнее чемпиона
+# минимум на ML_PROMOTE_MIN_GAIN. Итог сравнения пишется в его запись ml_info.json.
+ML_NIGHTLY_RETRAIN_AT = os.getenv("ML_NIGHTLY_RETRAIN_AT", "03:30")
+ML_CHALLENGE_HOLDOUT_FRACTION = float(os.getenv("ML_CHALLENGE_HOLDOUT_FRACTION", "0.15"))
+ML_CHALLENGE_MIN_ROWS = int(os.getenv("ML_CHALLENGE_MIN_ROWS", "50"))
+ML_PROMOTE_MIN_GAIN = float(os.getenv("ML_PROMOTE_MIN_GAIN", "0.5"))  # п.п. точности
+ML_CHALLENGE_LATENCY_ROWS = 200
+ML_LAST_REFIT_ATTEMPT: Optional[float] = None
+
+def champion_unseen_rows(dataset: dict, info: Optional[Dict]) -> Optional[np.ndarray]:
+    """
+    Первые вхождения сигналов после водяного знака чемпиона — сделки, которых он не видел.
+    None — водяной знак неизвестен (старая версия или датасет пересобран после её обучения).
+    """
+    watermark = (info or {}).get("dataset_rows")
+    if watermark is None or info.get("dataset_generation") != dataset.get('generation'):
+        return None
+    rows, _ = dedup_signal_rows(dataset['signal'])  # первое вхождение после знака — сигнал новый
+    return rows[rows >= int(watermark)]
+
+def challenge_window_ready(info: Optional[Dict]) -> bool:
+    """Хватает ли невиденных чемпионом строк, чтобы сравнение с претендентом было честным"""
+    dataset = DATASET_STORE.load()
+    if not dataset:
+        return False
+    unseen = champion_unseen_rows(dataset, info)
+    return unseen is None or len(unseen) >= ML_CHALLENGE_MIN_ROWS
+
+def challenge_holdout(dataset: dict, champion_info: Optional[Dict] = None) -> Tuple[np.ndarray, bool]:
+    """
+    Строки самых свежих (по порядку закрытия) уникальных сигналов — общее окно для чемпиона
+    и претендента — и можно ли на нём оценивать чемпиона. Пустое окно — сравнивать не на чем.
+    """
+    rows, _ = dedup_signal_rows(dataset['signal'])
+    n = max(ML_CHALLENGE_MIN_ROWS, int(len(rows) * ML_CHALLENGE_HOLDOUT_FRACTION))
+    unseen = champion_unseen_rows(dataset, champion_info) if champion_info else None
+    if unseen is not None:
+        rows, n = unseen, min(n, len(unseen))
+        if n < ML_CHALLENGE_MIN_ROWS:
+            return np.array([], dtype=np.int64), False
+    if dataset['rows'] - n < MIN_SAMPLES_TO_TRAIN:
+        return np.array([], dtype=np.int64), False
+    return np.sort(rows[-n:]), unseen is not None
+
+def evaluate_bundle(bundle: dict, dataset: dict, rows: np.ndarray) -> Optional[Dict]:
+    """Точность и задержка версии на строках датасета; None — в датасете нет её признаков"""
+    column = {name: i for i, name in enumerate(dataset['feature_names'])}
+    if any(name not in column for name in bundle['feature_names']):
+        return None
+    cols = [column[name] for name in bundle['feature_names']]
+    X = np.asarray(dataset['X'][rows])[:, cols].astype(np.float64)
+    y = np.asarray(dataset['y'][rows], dtype=int)
+
+    pred = (_score_matrix(X, bundle) >= 0.5).astype(int)
+    latencies = []
+    for row in X[:ML_CHALLENGE_LATENCY_ROWS]:
+        started = monotonic()
+        _score_matrix(row.reshape(1, -1), bundle)  # тот же путь, что у analyze_pair
+        latencies.append((monotonic() - started) * 1000)
+    return {
+        "rows": int(len(y)),
+        "accuracy": round(float(accuracy_score(y, pred)) * 100, 2),
+        "f1": round(float(f1_score(y, pred, zero_division=0)) * 100, 2),
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "latency_p95_ms": round(float(np.percentile(latencies, 95)), 3),
+    }
+
+def decide_promotion(champion: Optional[Dict], challenger: Optional[Dict],
+                     has_champion: bool = True) -> Tuple[bool, str]:
+    """has_champion=False — активной версии нет, сравнивать не с чем (первое обучение)"""
+    if challenger is None:
+        return False, "претендента не удалось оценить"
+    if challenger["latency_p95_ms"] > ML_LATENCY_BUDGET_MS:
+        return False, f"задержка p95 {challenger['latency_p95_ms']:.1f} мс > {ML_LATENCY_BUDGET_MS} мс"
+    if not has_champion:
+        return True, "активной версии нет"
+    if champion is None:
+        return False, "чемпиона нельзя оценить на текущем датасете — повышение только через /retrain"
+    gain = challenger["accuracy"] - champion["accuracy"]
+    if gain < ML_PROMOTE_MIN_GAIN:
+        return False, f"прирост точности {gain:+.2f} п.п. < {ML_PROMOTE_MIN_GAIN} п.п."
+    return True, f"прирост точности {gain:+.2f} п.п."
+
+def run_champion_challenger(progress=None, cancel_event=None) -> Optional[Dict]:
+    """Обучает претендента без отложенного окна, сравнивает с чемпионом, при победе активирует"""
+    dataset = DATASET_STORE.load()
+    if not dataset or dataset['rows'] == 0:
+        return None
+    champion_version = read_model_manifest().get("active")
+    champion = None
+    if champion_version:
+        try:
+            champion = load_model_bundle(champion_version)
+        except Exception as e:
+            logging.warning(f"⚠️ Чемпион {champion_version} не загрузился для сравнения: {e}")
+    holdout, champion_comparable = challenge_holdout(dataset, champion['info'] if champion else None)
+    if len(holdout) == 0:
+        logging.warning("⚠ Нет окна сделок, невиденных чемпионом, — сравнение и обучение пропущены")
+        return None
+    if champion is not None and not champion_comparable:
+        logging.info(f"🥊 Чемпион {champion_version} учился на неизвестных строках датасета — его оценка справочная")
+
+    info = train_ml_model(progress=progress, cancel_event=cancel_event, exclude_rows=holdout, activate=False)
+    if not info or info.get("error"):
+        return info
+    if progress is not None:
+        progress("Сравнение с чемпионом", 95)
+
+    champion_metrics = evaluate_bundle(champion, dataset, holdout) if champion is not None else None
+    challenger_metrics = evaluate_bundle(load_model_bundle(info["version"]), dataset, holdout)
+    promoted, reason = decide_promotion(champion_metrics, challenger_metrics, has_champion=bool(champion_version))
+    if promoted:
+        set_active_version(info["version"])
+        _write_json_atomic(ML_INFO_LAST, info)
+
+    ts = np.asarray(dataset['ts'])[holdout]
+    report = {
+        "at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "champion": champion_version,
+        "challenger": info["version"],
+        "window": {
+            "rows": int(len(holdout)),
+            "from": str(pd.Timestamp(int(ts.min()))),
+            "to": str(pd.Timestamp(int(ts.max()))),
+        },
+        "champion_metrics": champion_metrics,
+        # True — чемпион мог учиться на строках окна, его точность завышена
+        "champion_advisory": champion_metrics is not None and not champion_comparable,
+        "challenger_metrics": challenger_metrics,
+        "promoted": promoted,
+        "reason": reason,
+    }
+    _update_ml_info_entry(info["version"], {"champion_challenger": report})
+    info["champion_challenger"] = report
+    logging.info(f"🥊 {info['version']} против {champion_version or '—'}: "
+                 f"{'повышен до чемпиона' if promoted else 'остаётся претендентом'} ({reason})")
+    return info
+
+async def start_scheduled_training(context: ContextTypes.DEFAULT_TYPE, reason: str):
+    """Фоновое обучение претендента (без чата администратора)"""
+    global ML_LAST_REFIT_ATTEMPT
+    ML_LAST_REFIT_ATTEMPT = monotonic()
+    job = await asyncio.to_thread(start_training_job, None, True)
+    logging.info(f"🏭 {reason.capitalize()} обучение претендента {job['id']}")
+    context.job_queue.run_repeating(
+        training_progress_job,
+        interval=TRAINING_POLL_SEC,
+        first=TRAINING_POLL_SEC,
+        name=f"training_{job['id']}",
+        data={'job_id': job['id']},
+    )
+
+async def nightly_retrain_job(context: ContextTypes.DEFAULT_TYPE):
+    if get_running_training_job() is not None:
+        logging.info("🌙 Ночное обучение пропущено: уже идёт другое обучение")
+        return
+    try:
+        await start_scheduled_training(context, "ночное")
+    except Exception as e:
+        logging.error(f"❌ Ошибка запуска ночного обучения: {e}", exc_info=True)
+
 # ===================== (опционально) МЯГКИЙ БУСТ УВЕРЕННОСТИ =====================
 # Если пользуешься комплексной шкалой уверенности SMC/GPT, можно вызывать это место:
 ML_CONF_THRESHOLDS = {"boost2": 0.62, "boost1": 0.58, "cut1": 0.45, "cut2": 0.40}
@@ -2575,6 +5673,94 @@ def apply_ml_confidence_boost(base_conf: int, ml_features: Dict[str, float]) ->
     return new_conf, proba, expl
 
 # ===================== GPT ANALYSIS =====================
+# Запросы к GPT идут через AsyncOpenAI в собственном event loop (поток "gpt-loop"):
+# поток analyze_pair ждёт ответ не дольше GPT_DEADLINE_SEC, в API одновременно уходит
+# не больше GPT_MAX_CONCURRENCY запросов, одинаковые чтения (пара, бар M1) склеиваются
+# в один запрос, а готовый ответ на том же баре берётся из кэша.
+from concurrent.futures import TimeoutError as FuturesTimeoutError  # до 3.11 не совпадает со встроенным
+
+GPT_MODEL = os.getenv("GPT_MODEL", "gpt-4o-mini")
+GPT_MAX_CONCURRENCY = int(os.getenv("GPT_MAX_CONCURRENCY", "4"))
+GPT_DEADLINE_SEC = float(os.getenv("GPT_DEADLINE_SEC", "12"))
+GPT_REQUEST_TIMEOUT_SEC = float(os.getenv("GPT_REQUEST_TIMEOUT_SEC", "45"))
+GPT_STATS = {'requests': 0, 'coalesced': 0, 'cache_hits': 0, 'timeouts': 0, 'errors': 0}
+_GPT_STATS_LOCK = threading.Lock()  # счётчики меняют и gpt-loop, и потоки analyze_pair
+GPT_RESULTS = BarResultCache(maxsize=256)
+
+class GPTStage:
+    """Фоновый event loop GPT: клиент, семафор и незавершённые запросы живут только в нём"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loop = None
+        self.client = None
+        self.semaphore = None
+        self.inflight = {}
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="gpt-loop", daemon=True).start()
+                self.loop = loop
+        return self.loop
+
+    async def _complete(self, prompt: str) -> str:
+        if self.client is None:
+            self.client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL or None,
+                                      timeout=GPT_REQUEST_TIMEOUT_SEC, max_retries=1)
+            self.semaphore = asyncio.Semaphore(GPT_MAX_CONCURRENCY)
+        async with self.semaphore:
+            with _GPT_STATS_LOCK:
+                GPT_STATS['requests'] += 1
+            resp = await self.client.chat.completions.create(
+                model=GPT_MODEL,
+                messages=[{"role": "system", "content": "Ты профессиональный трейдер. Отвечай только JSON."},
+                          {"role": "user", "content": prompt}],
+                temperature=0.1,
+            )
+        return resp.choices[0].message.content or ""
+
+    def _finish(self, key, task: asyncio.Task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if task.cancelled():
+            return
+        if task.exception() is not None:  # забираем ошибку, даже если все ожидающие ушли по дедлайну
+            with _GPT_STATS_LOCK:
+                GPT_STATS['errors'] += 1
+            logging.warning(f"GPT error: {task.exception()}")
+        else:
+            GPT_RESULTS.put(key, task.result())
+
+    async def read(self, key, prompt: str) -> str:
+        """Один запрос на ключ; дедлайн у каждого ожидающего свой и не отменяет общий запрос"""
+        hit, text = GPT_RESULTS.get(key)
+        if hit:
+            with _GPT_STATS_LOCK:
+                GPT_STATS['cache_hits'] += 1
+            return text
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._complete(prompt))
+            self.inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._finish(k, t))
+        else:
+            with _GPT_STATS_LOCK:
+                GPT_STATS['coalesced'] += 1
+        return await asyncio.wait_for(asyncio.shield(task), GPT_DEADLINE_SEC)
+
+    def read_blocking(self, key, prompt: str) -> str:
+        """Для потоков analyze_pair: ждёт ответ не дольше дедлайна (TimeoutError — без GPT)"""
+        future = asyncio.run_coroutine_threadsafe(self.read(key, prompt), self._ensure_loop())
+        try:
+            return future.result(timeout=GPT_DEADLINE_SEC + 5)
+        except FuturesTimeoutError:
+            future.cancel()  # общий запрос под shield продолжится и попадёт в кэш
+            raise
+
+GPT_STAGE = GPTStage()
+
 def gpt_full_market_read(pair: str, df_m1: pd.DataFrame, df_m5: pd.DataFrame):
     """GPT-анализ с улучшенной логикой времени экспирации (1-4 минуты)"""
     try:
@@ -2619,15 +5805,15 @@ def gpt_full_market_read(pair: str, df_m1: pd.DataFrame, df_m5: pd.DataFrame):
 
 Данные свечей (первые 50 из 400): {json.dumps(candles[:50], ensure_ascii=False)}
 """
-        resp = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role":"system","content":"Ты профессиональный трейдер. Отвечай только JSON."},
-                      {"role":"user","content":prompt}],
-            temperature=0.1,
-            timeout=45
-        )
-        
-        text = resp.choices[0].message.content.strip()
+        try:
+            text = GPT_STAGE.read_blocking(("gpt", pair, df_m1.index[-1]), prompt)
+        except (FuturesTimeoutError, asyncio.TimeoutError):
+            with _GPT_STATS_LOCK:
+                GPT_STATS['timeouts'] += 1
+            logging.warning(f"⏱ GPT {pair}: нет ответа за {GPT_DEADLINE_SEC:.0f} сек — анализ без GPT")
+            return None, None
+
+        text = text.strip()
         if "```" in text:
             text = text.replace("```json","").replace("```","").strip()
             
@@ -2653,60 +5839,70 @@ def gpt_full_market_read(pair: str, df_m1: pd.DataFrame, df_m5: pd.DataFrame):
         logging.warning(f"GPT error: {e}")
         return None, None
 # ===================== ROUND LEVELS DETECTION =====================
-def detect_round_levels(price: float, pip_distance: float = 0.0050) -> dict:
-    """УЛУЧШЕННОЕ определение круглых уровней"""
-    # Определяем разряд цены для поиска круглых уровней
-    if price >= 100:
-        # Для JPY пар
-        round_levels = [
-            round(price / 5) * 5 - 10,  # Ближайшие уровни
-            round(price / 5) * 5 - 5,
-            round(price / 5) * 5,
-            round(price / 5) * 5 + 5,
-            round(price / 5) * 5 + 10
-        ]
-        threshold = 1.0  # 100 пипсов для JPY
-    elif price >= 1.0:
-        # Для основных пар
-        base = int(price)
-        round_levels = []
-        for i in range(base - 2, base + 3):
-            round_levels.extend([
-                i + 0.0000,
-                i + 0.1000,
-                i + 0.2000, 
-                i + 0.3000,
-                i + 0.4000,
-                i + 0.5000,
-                i + 0.6000,
-                i + 0.7000,
-                i + 0.8000,
-                i + 0.9000
-            ])
-        threshold = 0.0020  # 20 пипсов
-    else:
-        # Для экзотических пар
-        round_levels = [0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
-        threshold = 0.0020
-    
-    # Находим ближайший круглый уровень
-    closest_level = min(round_levels, key=lambda x: abs(x - price))
+# Шаг сетки и порог «близости» в пипсах (JPY: 5.00 и 100 пипсов; остальные: 0.1000 и 20 пипсов)
+ROUND_LEVEL_STEP_PIPS = {"JPY": 500, "DEFAULT": 1000}
+ROUND_LEVEL_THRESHOLD_PIPS = {"JPY": 100, "DEFAULT": 20}
+ROUND_STRENGTH_NAMES = ("WEAK", "MEDIUM", "STRONG", "VERY_STRONG")
+ROUND_LEVEL_GRIDS = {}
+
+def get_round_level_grid(pair: Optional[str] = None, price: Optional[float] = None) -> dict:
+    """
+    Параметры сетки круглых уровней инструмента: размер пипса и digits из
+    mt5.symbol_info (fallback — по имени пары), шаг сетки и порог в цене.
+    Без пары класс инструмента определяется по цене (>= 100 — JPY).
+    """
+    if pair and pair in ROUND_LEVEL_GRIDS:
+        return ROUND_LEVEL_GRIDS[pair]
+
+    is_jpy = ("JPY" in pair) if pair else (price is not None and price >= 100)
+    pip_size = 0.01 if is_jpy else 0.0001
+    digits = 3 if is_jpy else 5
+    from_metadata = False
+
+    if pair:
+        try:
+            info = mt5.symbol_info(pair)
+            if info is not None and info.point > 0:
+                digits = int(info.digits)
+                pip_size = info.point * 10 if digits in (3, 5) else info.point
+                from_metadata = True
+        except Exception as e:
+            logging.debug(f"symbol_info({pair}) недоступен: {e}")
+
+    kind = "JPY" if is_jpy else "DEFAULT"
+    grid = {
+        "pip_size": pip_size,
+        "digits": digits,
+        "step": ROUND_LEVEL_STEP_PIPS[kind] * pip_size,
+        "threshold": ROUND_LEVEL_THRESHOLD_PIPS[kind] * pip_size
+    }
+    # Кэшируем только сетки, построенные по метаданным символа
+    if pair and from_metadata:
+        ROUND_LEVEL_GRIDS[pair] = grid
+    return grid
+
+def _round_strength_code(distance, threshold):
+    """Код силы уровня: 0=WEAK, 1=MEDIUM, 2=STRONG, 3=VERY_STRONG (работает и для массивов)"""
+    return (
+        (distance <= threshold * 0.6).astype(np.int8) +
+        (distance <= threshold * 0.3).astype(np.int8) +
+        (distance <= threshold * 0.1).astype(np.int8)
+    )
+
+def detect_round_levels(price: float, pip_distance: float = 0.0050, pair: Optional[str] = None) -> dict:
+    """УЛУЧШЕННОЕ определение круглых уровней (O(1) по сетке инструмента)"""
+    grid = get_round_level_grid(pair, price)
+    step = grid["step"]
+    threshold = grid["threshold"]
+
+    # Ближайший круглый уровень — арифметически, без перебора кандидатов
+    closest_level = round(round(price / step) * step, grid["digits"])
     distance = abs(price - closest_level)
-    distance_pips = distance * 10000
+    distance_pips = distance / grid["pip_size"]
     
-    # УЛУЧШЕННАЯ логика силы
-    if distance <= threshold * 0.1:
-        strength = "VERY_STRONG"
-        confidence_boost = 3
-    elif distance <= threshold * 0.3:
-        strength = "STRONG" 
-        confidence_boost = 2
-    elif distance <= threshold * 0.6:
-        strength = "MEDIUM"
-        confidence_boost = 1
-    else:
-        strength = "WEAK"
-        confidence_boost = 0
+    strength_code = int(_round_strength_code(np.float64(distance), threshold))
+    strength = ROUND_STRENGTH_NAMES[strength_code]
+    confidence_boost = strength_code
     
     return {
         "closest_level": closest_level,
@@ -2717,6 +5913,25 @@ def detect_round_levels(price: float, pip_distance: float = 0.0050) -> dict:
         "is_near_round": distance <= threshold
     }
 
+def annotate_round_levels(prices, pair: Optional[str] = None) -> dict:
+    """
+    Векторная версия detect_round_levels для целого ряда цен (обучение/бэктест).
+    Возвращает массивы closest_level, distance, distance_pips, strength_code, is_near_round.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    ref_price = float(np.nanmedian(prices)) if prices.size else None
+    grid = get_round_level_grid(pair, ref_price)
+    step = grid["step"]
+
+    closest = np.round(np.round(prices / step) * step, grid["digits"])
+    distance = np.abs(prices - closest)
+    return {
+        "closest_level": closest,
+        "distance": distance,
+        "distance_pips": distance / grid["pip_size"],
+        "strength_code": _round_strength_code(distance, grid["threshold"]),
+        "is_near_round": distance <= grid["threshold"]
+    }
 
 def log_trade_to_file(trade: dict, result: str = None):
     """
@@ -2774,12 +5989,16 @@ def get_mt5_data(symbol: str, n: int, timeframe) -> Optional[pd.DataFrame]:
         df = pd.DataFrame(rates)
         df['time'] = pd.to_datetime(df['time'], unit='s')
         df.set_index('time', inplace=True)
+        # 🗃 Символ и таймфрейм для ключей BAR_CACHE (переживают iloc/tail/copy)
+        df.attrs['symbol'] = symbol
+        df.attrs['timeframe'] = timeframe
         return df
 
     except Exception as e:
         logging.error(f"Ошибка получения данных MT5: {e}")
         return None
 
+@bar_cached
 def analyze_trend(df, timeframe_name="M1"):
     """Определяет тренд на заданном таймфрейме"""
     if df is None or len(df) < 50:
@@ -2835,7 +6054,6 @@ def is_against_strong_trend(signal, trend_analysis):
 def analyze_pair(pair: str):
     try:
 
-        global ml_model, ml_scaler, ml_features_count
         # 🕒 ПРОВЕРЯЕМ ФИКСИРОВАННЫЙ ГРАФИК РАБОТЫ БОТА
         if not is_trading_time():
             logging.info(f"⏸ Вне рабочего времени бота — пропускаем анализ {pair}")
@@ -2843,11 +6061,32 @@ def analyze_pair(pair: str):
         
         logging.info(f"🔍 Начало анализа пары: {pair}")
 
-        # 1️⃣ Получаем данные
-        df_m1 = get_mt5_data(pair, 400, mt5.TIMEFRAME_M1)
-        df_m5 = get_mt5_data(pair, 200, mt5.TIMEFRAME_M5)
-        df_m15 = get_mt5_data(pair, 100, mt5.TIMEFRAME_M15)
-        df_m30 = get_mt5_data(pair, 80, mt5.TIMEFRAME_M30)
+        # 🗂 Снимок активной модели на весь анализ (подмена версии не затронет текущий расчёт)
+        active_model = get_active_model()
+
+        # 1️⃣ Получаем данные: кадры снимка цикла (на них посчитаны батч-индикаторы и батч-инференс),
+        # вне цикла или при устаревшем снимке — напрямую из MT5
+        df_m1 = get_cycle_frame(pair, "M1")
+
+        # 🗃 Тот же бар M1, та же версия модели и те же переключатели ML/GPT — отдаём готовый результат.
+        # Фильтры времени (is_trading_time выше, is_trade_allowed в ручном поиске) в кэш не попадают:
+        # они проверяются до обращения к нему на каждом вызове
+        active_version = active_model['version'] if active_model else None
+        cache_key = bar_cache_key("analyze_pair", df_m1, (active_version, ML_ENABLED, USE_GPT)) if df_m1 is not None else None
+        if cache_key is not None:
+            hit, cached = BAR_CACHE.get(cache_key)
+            if hit:
+                logging.info(f"🗃 {pair}: бар не изменился — результат из кэша")
+                return cached
+
+        def remember(result):
+            if cache_key is not None:
+                BAR_CACHE.put(cache_key, result)
+            return result
+
+        df_m5 = get_cycle_frame(pair, "M5")
+        df_m15 = get_cycle_frame(pair, "M15")
+        df_m30 = get_cycle_frame(pair, "M30")
         if df_m1 is None or df_m5 is None:
             logging.warning(f"⚠ Нет данных для {pair}")
             return None, None, 0, "NO_DATA", None
@@ -2856,36 +6095,41 @@ def analyze_pair(pair: str):
         logging.info(f"💰 {pair}: текущая цена = {current_price:.5f}")
 
         # 2️⃣ Тренды и уровни
-        trend_analysis = enhanced_trend_analysis(df_m1)
-        m5_trend = analyze_trend(df_m5, "M5")
-        m15_trend = analyze_trend(df_m15, "M15")
-        m30_trend = analyze_trend(df_m30, "M30")
-        round_info = detect_round_levels(current_price)
+        trend_analysis = enhanced_trend_analysis(df_m1, pair)
+        m5_trend = get_universe_trend(pair, "M5", df_m5)
+        m15_trend = get_universe_trend(pair, "M15", df_m15)
+        m30_trend = get_universe_trend(pair, "M30", df_m30)
+        round_info = detect_round_levels(current_price, pair=pair)
         logging.info(f"📊 Тренды M5={m5_trend}, M15={m15_trend}, M30={m30_trend}")
         logging.info(f"🎯 Круглый уровень: {round_info['closest_level']} сила={round_info['strength']}")
 
         # 3️⃣ Подготовка ML фичей (42 признака)
-        ml_enabled_for_this_pair = ML_ENABLED
-        if ML_ENABLED and (ml_model is None or ml_scaler is None):
-            initialize_ml_model()
-            if ml_model is None or ml_scaler is None:
-                ml_enabled_for_this_pair = False
-                logging.warning(f"⏭ {pair}: ML анализ пропущен - модель недоступна")
-
-        ml_features_dict = prepare_ml_features(df_m1)
+        # Модель с диска здесь не грузим — её подхватывает фоновая задача реестра
+        ml_enabled_for_this_pair = ML_ENABLED and active_model is not None
+        if ML_ENABLED and active_model is None:
+            logging.warning(f"⏭ {pair}: ML анализ пропущен - модель недоступна")
+
+        # 📦 Если пара уже посчитана батчем скана на этом же окне — берём контекст и вероятность
+        scan_prediction = get_scan_prediction(pair, df_m1, active_model) if ml_enabled_for_this_pair else None
+        # ML-признаки — по закрытым барам (ml_feature_window), как в бэкфилле истории
+        feature_ctx = scan_prediction['ctx'] if scan_prediction else FeatureContext(ml_feature_window(df_m1), pair)
+        ml_features_dict = None
         ml_features_data = None
         feats_array = None
 
-        if ml_features_dict is not None:
-            # 🧠 Сохраняем словарь для истории сделки
-            ml_features_data = ml_features_dict.copy()
-
-            # ➡️ Преобразуем dict → array для подачи в ML модель
-            feature_names = list(ml_features_dict.keys())
-            feats_array = np.array([ml_features_dict[f] for f in feature_names]).reshape(1, -1)
-            ml_features_data['round_level_info'] = round_info
+        if ml_enabled_for_this_pair and len(feature_ctx.df) >= 100:
+            # ➡️ Только признаки активной модели (план по model_info["feature_names"]),
+            # вектор сразу в порядке колонок модели
+            feature_plan = get_feature_plan(active_model['feature_names'] or list(FEATURE_INDEX))
+            if scan_prediction is not None:
+                feats_array = scan_prediction['row'].reshape(1, -1)
+            else:
+                feats_array = feature_plan.execute(feature_ctx).reshape(1, -1)
+            ml_features_dict = dict(zip(feature_plan.feature_names, feats_array[0]))
+            count_schema_row(len(feature_plan.missing))
 
-            logging.info(f"📊 {pair}: подготовлены {len(feature_names)} ML фичей")
+            logging.info(f"📊 {pair}: подготовлены {feature_plan.n_features} ML фичей "
+                         f"({len(feature_plan.groups)}/{len(FEATURE_GROUPS)} групп)")
 
         # 4️⃣ Анализ источников сигналов
         smc_result = {
@@ -2906,23 +6150,12 @@ def analyze_pair(pair: str):
         # --- ML ---
         if ml_enabled_for_this_pair and feats_array is not None:
             try:
-                # 🔧 ДОБАВЬ ЭТОТ БЛОК ДЛЯ ИСПРАВЛЕНИЯ SCALER
-                current_feature_count = feats_array.shape[1]
-                if (ml_scaler is not None and 
-                    hasattr(ml_scaler, 'n_features_in_') and 
-                    ml_scaler.n_features_in_ != current_feature_count):
-            
-                    logging.warning(f"🔄 Размерность не совпадает: scaler={ml_scaler.n_features_in_}, данные={current_feature_count}")
-                    logging.info("🔄 Пересоздаю scaler с правильной размерностью...")
-            
-                    # ПЕРЕСОЗДАЕМ SCALER С ПРАВИЛЬНОЙ РАЗМЕРНОСТЬЮ
-                    ml_scaler = StandardScaler()
-                    ml_scaler.fit(feats_array)  # Обучаем на текущих данных
-        
-                # ✅ ТЕПЕРЬ ЭТА СТРОКА БУДЕТ РАБОТАТЬ БЕЗ ОШИБОК
-                feats_scaled = ml_scaler.transform(feats_array)
-        
-                ml_pred = ml_model.predict_proba(feats_scaled)[0][1]
+                # Вектор уже в схеме модели (план по её feature_names), ширина сверена при активации версии
+                # 📦 Вероятность из батча скана или через микробатчер (один predict_proba на всех)
+                if scan_prediction is not None:
+                    ml_pred = scan_prediction['proba']
+                else:
+                    ml_pred = ML_BATCHER.predict(feats_array[0], active_model)
                 ml_confidence = round(ml_pred * 100, 1)
                 ml_signal = "BUY" if ml_pred >= 0.5 else "SELL"
 
@@ -2938,8 +6171,13 @@ def analyze_pair(pair: str):
             except Exception as e:
                 logging.error(f"❌ Ошибка ML для {pair}: {e}")
 
+        smc_priority = bool(smc_result['signal'] and smc_result['confidence'] >= 5)
+        ml_priority = bool(ml_result and ml_result['signal'] and ml_result['validated'] and ml_result['confidence'] >= 0.6)
+
         # --- GPT ---
-        if USE_GPT:
+        # Запрос только если ответ может повлиять на решение: SMC/ML не решили, а фильтры GPT проходят
+        if (USE_GPT and not smc_priority and not ml_priority
+                and smc_result['confidence'] >= 2 and ml_result and ml_result['confidence'] >= 0.4):
             gpt_signal, gpt_expiry = gpt_full_market_read(pair, df_m1, df_m5)
             if gpt_signal:
                 gpt_result = {"signal": gpt_signal, "confidence": 6, "expiry": gpt_expiry, "source": "GPT"}
@@ -2952,7 +6190,7 @@ def analyze_pair(pair: str):
         final_source = None
 
         # 📌 1. ВЫСОКИЙ ПРИОРИТЕТ: SMC с уверенностью >= 5
-        if smc_result['signal'] and smc_result['confidence'] >= 5:
+        if smc_priority:
             final_signal = smc_result['signal']
             final_confidence = smc_result['confidence']
             final_expiry = smc_result['expiry']
@@ -2960,7 +6198,7 @@ def analyze_pair(pair: str):
             logging.info(f"🎯 SMC ПРИОРИТЕТ: {final_signal} (conf={final_confidence})")
 
         # 📌 2. СРЕДНИЙ ПРИОРИТЕТ: ML если валидирован и SMC слабый/отсутствует
-        elif ml_result and ml_result['signal'] and ml_result['validated'] and ml_result['confidence'] >= 0.6:
+        elif ml_priority:
             # Дополнительная проверка контекста
             rsi_val = ml_features_dict.get('rsi', 50)
             if (ml_result['signal'] == 'BUY' and rsi_val < 65) or \
@@ -2986,16 +6224,20 @@ def analyze_pair(pair: str):
         # 6️⃣ 🔥 ФИНАЛЬНАЯ ПРОВЕРКА: запрет сигналов против сильного тренда
         if final_signal and is_against_strong_trend(final_signal, trend_analysis):
             logging.warning(f"⛔ ОТМЕНА: сигнал {final_signal} против сильного тренда")
-            return None, None, 0, "AGAINST_STRONG_TREND", ml_features_data
+            return remember((None, None, 0, "AGAINST_STRONG_TREND", ml_features_data))
 
         # 7️⃣ Возврат
         if final_signal:
             logging.info(f"🚀 {pair}: Окончательный сигнал = {final_signal} ({final_source}, conf={final_confidence})")
-    
-            return final_signal, final_expiry, final_confidence, final_source, ml_features_data
+
+            # 🧠 Полный набор признаков — только для сохраняемой сделки (обучение):
+            # из того же feature_ctx, что и вход модели, и в кэш по (пара, бар) для создания сделки
+            ml_features_data = get_bar_features(pair, df_m1, ctx=feature_ctx)
+
+            return remember((final_signal, final_expiry, final_confidence, final_source, ml_features_data))
         
         logging.info(f"❌ {pair}: сигналов нет или они отфильтрованы")
-        return None, None, 0, "NO_SIGNAL", ml_features_data
+        return remember((None, None, 0, "NO_SIGNAL", ml_features_data))
 
     except Exception as e:
         logging.error(f"💥 Ошибка анализа пары {pair}: {e}", exc_info=True)
@@ -3190,6 +6432,7 @@ async def auto_close_stuck_trades():
                 udata.setdefault("trade_history", []).append(current_trade)
                 udata["current_trade"] = None
                 closed_count += 1
+                await asyncio.to_thread(append_closed_trade, current_trade)
 
                 logging.warning(f"⚠️ Автоматически закрыта зависшая сделка у пользователя {uid}")
 
@@ -3225,6 +6468,9 @@ async def auto_trading_loop(context: ContextTypes.DEFAULT_TYPE):
 
         logging.info(f"🔄 Запуск авто-трейдинг цикла для {len(users)} пользователей...")
 
+        # 🧮 Батч-индикаторы по всем парам — один раз на цикл, а не на каждого пользователя
+        await asyncio.to_thread(refresh_universe_snapshot)
+
         async def process_user(uid: int, udata: dict):
             """Асинхронная обработка одного пользователя с таймаутом и ограничением"""
             async with semaphore:
@@ -3257,6 +6503,14 @@ async def auto_trading_loop(context: ContextTypes.DEFAULT_TYPE):
     finally:
         duration = (datetime.now() - start_time).total_seconds()
         logging.info(f"⏱️ Цикл завершён за {duration:.1f} сек")
+        logging.info(f"🗃 BAR_CACHE: {BAR_CACHE.stats()}")
+        logging.info(f"📦 ML_BATCHER: {ML_BATCHER.stats()} | батч скана: {ML_SCAN_STATS}")
+        logging.info(f"🧭 Схема признаков: {SCHEMA_METRICS}")
+        logging.info(f"🧠 FEATURE_CACHE: {FEATURE_CACHE.stats()}")
+        logging.info(f"🧵 Инференс: {inference_latency_stats()} | 🪶 фолбэк: {ML_DISTILLED_STATS}")
+        with _GPT_STATS_LOCK:
+            gpt_stats = dict(GPT_STATS)
+        logging.info(f"💬 GPT: {gpt_stats}")
 
 
 # ===================== ⚙️ TRADE RESULT CHECKER (ASYNC VERSION) =====================
@@ -3330,6 +6584,7 @@ async def check_trade_result(context: ContextTypes.DEFAULT_TYPE):
             "source": current_trade.get("source", "UNKNOWN"),
             "expiry_minutes": current_trade.get("expiry_minutes", 1),
             "ml_features": current_trade.get("ml_features"),
+            "signal_id": current_trade.get("signal_id"),
             "check_attempts": attempt,
             "closed_successfully": True
         }
@@ -3338,6 +6593,7 @@ async def check_trade_result(context: ContextTypes.DEFAULT_TYPE):
         user_data.setdefault("trade_history", []).append(closed_trade)
         user_data["current_trade"] = None
         user_data["trade_counter"] = len(user_data["trade_history"])
+        await asyncio.to_thread(append_closed_trade, closed_trade)
 
         # 💾 Сохраняем безопасно
         await asyncio.to_thread(save_users_data)
@@ -3597,6 +6853,7 @@ async def force_close_expired_trade(context, user_id, trade):
             "source": trade.get("source", "UNKNOWN"),
             "expiry_minutes": trade.get("expiry_minutes", 1),
             "ml_features": trade.get("ml_features", None),
+            "signal_id": trade.get("signal_id"),
             "closed_successfully": False,
             "force_closed": True,
             "close_reason": "EXPIRED_TIMEOUT"
@@ -3605,6 +6862,7 @@ async def force_close_expired_trade(context, user_id, trade):
         # 💾 Сохраняем данные пользователя
         user_info.setdefault("trade_history", []).append(closed_trade)
         user_info["current_trade"] = None
+        await asyncio.to_thread(append_closed_trade, closed_trade)
         await async_save_users_data()  # 🔄 безопасная асинхронная запись
 
         logging.warning(f"🔒 Просроченная сделка #{trade_id} у пользователя {user_id} закрыта (таймаут)")
@@ -3747,6 +7005,7 @@ async def process_auto_trade_for_user(user_id: int, user_data: Dict, context: Co
                 continue
 
             signal, expiry, conf, source = result[:4]
+            signal_features = result[4] if len(result) > 4 else None
 
             # 🎯 Фильтрация слабых сигналов
             if not signal or conf < 6:
@@ -3760,8 +7019,11 @@ async def process_auto_trade_for_user(user_id: int, user_data: Dict, context: Co
             entry_price = df['close'].iloc[-1]
             trade_number = user_data['trade_counter'] + 1
 
-            # 🧠 Подготовка ML-признаков
-            ml_features_dict = await asyncio.to_thread(prepare_ml_features, df)
+            # 🧠 ML-признаки — те же, что видела модель в analyze_pair (без повторного расчёта)
+            if signal_features:
+                ml_features_dict = dict(signal_features)
+            else:
+                ml_features_dict = await asyncio.to_thread(get_bar_features, pair, df)
 
             # 📝 Формируем сообщение
             signal_text = (
@@ -3823,6 +7085,7 @@ async def process_auto_trade_for_user(user_id: int, user_data: Dict, context: Co
                 'stake': float(STAKE_AMOUNT),
                 'timestamp': datetime.now().isoformat(),
                 'ml_features': ml_features_dict or {},
+                'signal_id': make_signal_id(pair, df.index[-1], signal),
                 'source': source,
                 'confidence': int(conf)
             }
@@ -4119,6 +7382,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "• /settings - настройки\n" 
                 "• /next - следующий сигнал\n"
                 "• /retrain - переобучить ML\n"
+                "• /canceltrain - отменить переобучение\n"
                 "• /stop - остановить бота\n"
                 "• /start - запустить бота\n"
                 "• /logs - просмотр логов\n"
@@ -4355,7 +7619,8 @@ async def next_signal_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                     'signal': signal,
                     'entry_price': entry_price,
                     'expiry': expiry,
-                    'ml_features': ml_features_data,
+                    'ml_features': dict(ml_features_data) if ml_features_data else None,
+                    'signal_id': make_signal_id(pair, df.index[-1], signal),
                     'source': source
                 }
                 return
@@ -4443,6 +7708,9 @@ async def model_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
             train_samples = info.get("train_samples", 0)
             test_samples = info.get("test_samples", 0)
+            skipped_features = info.get("skipped_features")
+            if skipped_features is None and isinstance(info.get("feature_names"), list):
+                skipped_features = get_feature_plan(info["feature_names"]).skipped_features
 
             stats_text = (
                 f"📊 СТАТИСТИКА ML МОДЕЛИ\n\n"
@@ -4457,6 +7725,20 @@ async def model_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                 f"📚 Обучающих: {train_samples}\n"
                 f"🎯 Кросс-валидация: {cv_acc*100:.2f}% ± {cv_std*100:.2f}%"
             )
+            if skipped_features:
+                stats_text += f"\n⏭ Не считаются при анализе: {len(skipped_features)} признаков"
+            active = get_active_model()
+            if active is not None:
+                stats_text += f"\n🗂 Активная версия: {active['version']}"
+            incremental = info.get("incremental")
+            if isinstance(incremental, dict):
+                stats_text += (f"\n🌱 Дообучений с полного обучения: {info.get('updates_since_full', 0)} "
+                               f"(последнее: +{incremental.get('rows_added', 0)} сделок, "
+                               f"точность на новых {incremental.get('prequential_accuracy', 0):.1f}%)")
+            distilled_info = info.get("distilled")
+            if isinstance(distilled_info, dict) and "fidelity_mae" in distilled_info:
+                stats_text += (f"\n🪶 Фолбэк-модель: MAE {distilled_info['fidelity_mae']:.3f}, "
+                               f"совпадение сигналов {distilled_info['signal_agreement']*100:.1f}%")
 
         await update.message.reply_text(
             stats_text,
@@ -4483,87 +7765,154 @@ async def retrain_model_command(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return
 
-    # 🔄 Уведомление о старте
+    # 🏭 Обучение — в отдельном процессе, бот продолжает работать
+    markup = ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
+    try:
+        job = await asyncio.to_thread(start_training_job, update.effective_chat.id)
+    except RuntimeError as e:
+        await update.message.reply_text(f"⏳ Переобучение не запущено: {e}. Отмена: /canceltrain", reply_markup=markup)
+        return
+    except Exception as e:
+        logging.exception(f"[ML] Ошибка запуска процесса обучения: {e}")
+        await update.message.reply_text(f"❌ Критическая ошибка при переобучении: {e}", reply_markup=markup)
+        return
+
     await update.message.reply_text(
-        "🔄 Запускаю переобучение ML модели... Это может занять несколько минут.",
-        reply_markup=ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
+        f"🔄 Переобучение ML модели запущено в отдельном процессе (задача {job['id']}).\n"
+        f"Бот продолжает работать, прогресс пришлю сюда. Отмена: /canceltrain",
+        reply_markup=markup
+    )
+    context.job_queue.run_repeating(
+        training_progress_job,
+        interval=TRAINING_POLL_SEC,
+        first=TRAINING_POLL_SEC,
+        name=f"training_{job['id']}",
+        data={'job_id': job['id']},
     )
 
-    try:
-        # 🚀 Запуск обучения
-        result = train_ml_model()
-
-        # ✅ Успех
-        if result and not result.get("error"):
-            test_acc = result.get("test_accuracy", 0)
-            cv_accuracy = result.get("cv_accuracy", 0)
-            trades_used = result.get("trades_used", 0)
-            overfit = result.get("overfitting_ratio", 0)
-            f1 = result.get("f1_score", 0)
-            model_type = result.get("model_type", "N/A")
-            win_rate = result.get("win_rate", 0)
-            n_features = result.get("n_features", 0)
-            train_acc = result.get("train_accuracy", 0)
-            test_samples = result.get("test_samples", 0)
-            train_samples = result.get("train_samples", 0)
-
-            # Корректировка процентов
-            if test_acc <= 1:
-                test_acc *= 100
-            if cv_accuracy <= 1:
-                cv_accuracy *= 100
-
-            # 🏆 Финальное сообщение
-            msg = (
-                f"✅ ML модель успешно переобучена!\n"
-                f"📊 Точность (тест): {test_acc:.2f}%\n"
-                f"🎯 Кросс-валидация: {cv_accuracy:.2f}%\n"
-                f"📈 Сделок использовано: {trades_used}\n"
-                f"🧠 Тип модели: {model_type}\n"
-                f"📋 Признаков: {n_features} | Train={train_samples} | Test={test_samples}\n"
-                f"📊 Win rate: {win_rate:.2f}%\n"
-                f"📊 F1 Score: {f1:.2f}% | Overfit: {overfit:.2f}\n"
-            )
+async def training_progress_job(context: ContextTypes.DEFAULT_TYPE):
+    """Прогресс процесса обучения → чат администратора; по завершении — подхват новой версии"""
+    job = TRAINING_JOBS.get(context.job.data['job_id'])
+    if job is None:
+        context.job.schedule_removal()
+        return
 
-            # Отправляем основное сообщение
-            await update.message.reply_text(
-                msg,
-                reply_markup=ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
-            )
+    try:
+        updates = poll_training_job(job)
+        chat_id = job['chat_id']
+        if updates and job['status'] == 'running' and chat_id:
+            stage_name, pct = updates[-1]
+            await context.bot.send_message(chat_id=chat_id, text=f"⏳ Обучение {job['id']}: {stage_name} ({pct}%)")
+        if job['status'] in ('running', 'cancelling'):
+            return
 
-            # 🏁 Лог в консоль
-            logging.info(
-                f"[ML] ✅ Модель переобучена ({model_type}): Test={test_acc:.2f}% | CV={cv_accuracy:.2f}% | Overfit={overfit:.2f}"
-            )
+        context.job.schedule_removal()
+        if job['status'] == 'done':
+            # Версия уже опубликована процессом — атомарно подменяем активную модель
+            await asyncio.to_thread(refresh_active_model)
+        if not chat_id:
+            logging.info(f"🏭 Плановое обучение {job['id']}: {job['status']} {job['error'] or ''}")
+        elif job['status'] == 'done':
+            await send_retrain_result(context.bot, chat_id, job['result'])
+        elif job['status'] == 'cancelled':
+            await context.bot.send_message(chat_id=chat_id, text=f"🛑 Обучение {job['id']} отменено, активная модель не изменилась")
+        else:
+            await send_retrain_result(context.bot, chat_id, {"error": job['error']})
+    except Exception as e:
+        logging.error(f"❌ Ошибка отслеживания обучения {job['id']}: {e}", exc_info=True)
+
+async def send_retrain_result(bot, chat_id: int, result: Optional[dict]):
+    """Итог переобучения в чат администратора"""
+    # ✅ Успех
+    if result and not result.get("error"):
+        test_acc = result.get("test_accuracy", 0)
+        cv_accuracy = result.get("cv_accuracy", 0)
+        trades_used = result.get("trades_used", 0)
+        overfit = result.get("overfitting_ratio", 0)
+        f1 = result.get("f1_score", 0)
+        model_type = result.get("model_type", "N/A")
+        win_rate = result.get("win_rate", 0)
+        n_features = result.get("n_features", 0)
+        train_acc = result.get("train_accuracy", 0)
+        test_samples = result.get("test_samples", 0)
+        train_samples = result.get("train_samples", 0)
+
+        # Корректировка процентов
+        if test_acc <= 1:
+            test_acc *= 100
+        if cv_accuracy <= 1:
+            cv_accuracy *= 100
+
+        # 🏆 Финальное сообщение
+        msg = (
+            f"✅ ML модель успешно переобучена!\n"
+            f"📊 Точность (тест): {test_acc:.2f}%\n"
+            f"🎯 Кросс-валидация: {cv_accuracy:.2f}%\n"
+            f"📈 Сделок использовано: {trades_used}\n"
+            f"🧠 Тип модели: {model_type}\n"
+            f"📋 Признаков: {n_features} | Train={train_samples} | Test={test_samples}\n"
+            f"📊 Win rate: {win_rate:.2f}%\n"
+            f"📊 F1 Score: {f1:.2f}% | Overfit: {overfit:.2f}\n"
+        )
+        duel = result.get("champion_challenger")
+        if duel:
+            msg += (f"🥊 Против {duel['champion'] or '—'}: "
+                    f"{'✅ модель активна' if duel['promoted'] else '⏸ не активирована'} ({duel['reason']})\n")
+
+        # Отправляем основное сообщение
+        await bot.send_message(
+            chat_id=chat_id,
+            text=msg,
+            reply_markup=ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
+        )
 
-            # 💡 Дополнительное уведомление о сравнении моделей
-            if model_type == "MLPClassifier":
-                await update.message.reply_text(
-                    "🤖 Нейросеть (MLPClassifier) показала лучшие результаты и выбрана как основная модель 🏆",
-                    reply_markup=ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
-                )
-            elif model_type == "RandomForestClassifier":
-                await update.message.reply_text(
-                    "🌲 RandomForestClassifier сохранил лидерство — стабильная точность и надёжность ✅",
-                    reply_markup=ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
-                )
+        # 🏁 Лог в консоль
+        logging.info(
+            f"[ML] ✅ Модель переобучена ({model_type}): Test={test_acc:.2f}% | CV={cv_accuracy:.2f}% | Overfit={overfit:.2f}"
+        )
 
-        # ⚠️ Ошибка в обучении
-        else:
-            error_msg = result.get("error", "Неизвестная ошибка") if result else "Неизвестная ошибка"
-            await update.message.reply_text(
-                f"❌ Ошибка переобучения: {error_msg}",
+        # 💡 Дополнительное уведомление о сравнении моделей
+        if model_type == "MLPClassifier":
+            await bot.send_message(
+                chat_id=chat_id,
+                text="🤖 Нейросеть (MLPClassifier) показала лучшие результаты и выбрана как основная модель 🏆",
+                reply_markup=ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
+            )
+        elif model_type == "RandomForestClassifier":
+            await bot.send_message(
+                chat_id=chat_id,
+                text="🌲 RandomForestClassifier сохранил лидерство — стабильная точность и надёжность ✅",
                 reply_markup=ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
             )
-            logging.error(f"[ML] ❌ Ошибка переобучения: {error_msg}")
 
-    except Exception as e:
-        # 🧨 Критическая ошибка
-        logging.exception(f"[ML] Ошибка при переобучении модели: {e}")
-        await update.message.reply_text(
-            f"❌ Критическая ошибка при переобучении: {e}",
+    # ⚠️ Ошибка в обучении
+    else:
+        error_msg = result.get("error", "Неизвестная ошибка") if result else "Неизвестная ошибка"
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"❌ Ошибка переобучения: {error_msg}",
             reply_markup=ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
         )
+        logging.error(f"[ML] ❌ Ошибка переобучения: {error_msg}")
+
+
+async def cancel_training_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отменяет идущее переобучение (/canceltrain [id])"""
+    markup = ReplyKeyboardMarkup([["❓ Помощь", "🕒 Расписание"]], resize_keyboard=True)
+    if MULTI_USER_MODE and not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Эта команда доступна только администратору.", reply_markup=markup)
+        return
+
+    job = cancel_training_job(context.args[0] if context.args else None)
+    if job is None:
+        await update.message.reply_text("ℹ️ Нет активного переобучения", reply_markup=markup)
+        return
+    await update.message.reply_text(
+        f"🛑 Отмена обучения {job['id']} запрошена (этап: {job['stage'] or 'старт'}). "
+        f"Процесс остановится на границе этапа или будет завершён через {TRAINING_CANCEL_GRACE_SEC} сек.",
+        reply_markup=markup
+    )
+
 # -------- TOGGLE FUNCTIONS (ML / GPT / SMC) --------
 async def toggle_ml(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -4873,7 +8222,7 @@ async def restore_from_backup_command(update: Update, context: ContextTypes.DEFA
 
 # ===================== ⚙️ RECALCULATE REAL ML FEATURES (ASYNC-SAFE) =====================
 async def recalculate_real_ml_features_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Асинхронно пересчитывает ML-фичи на реальных данных для всех сделок"""
+    """Пересчитывает ML-фичи всех сделок по истории MT5 на момент входа (векторный бэкфилл)"""
     user_id = update.effective_user.id
 
     # 🔐 Только админ
@@ -4881,92 +8230,39 @@ async def recalculate_real_ml_features_command(update: Update, context: ContextT
         await update.message.reply_text("❌ Эта команда доступна только администратору")
         return
 
-    await update.message.reply_text("🔄 Пересчёт РЕАЛЬНЫХ ML-фичей для всех сделок...")
+    if get_running_training_job() is not None:
+        await update.message.reply_text("⏳ Идёт обучение модели — датасет сейчас не пересобрать, повторите после его завершения (/canceltrain — отменить)")
+        return
+
+    await update.message.reply_text("🔄 Пересчёт РЕАЛЬНЫХ ML-фичей по истории на момент входа...")
 
     try:
-        recalculated_count = 0
-        failed_count = 0
-        total_trades = 0
-
-        # 📊 Подсчёт общего количества сделок
         if MULTI_USER_MODE:
-            total_trades = sum(len(u.get("trade_history", [])) for u in users.values())
+            trades = [t for u in users.values() for t in u.get("trade_history", []) if t.get("pair")]
         else:
-            total_trades = len(all_trades)
-
-        processed = 0
-
-        # 🧠 Основной цикл
-        if MULTI_USER_MODE:
-            for uid, udata in users.items():
-                for trade in udata.get("trade_history", []):
-                    if not trade.get("pair"):
-                        continue
-
-                    pair = trade["pair"]
-
-                    # Получаем данные с MT5 — без блокировки event loop
-                    df_m1 = await asyncio.to_thread(get_mt5_data, pair, 400, mt5.TIMEFRAME_M1)
-                    if df_m1 is not None and len(df_m1) > 100:
-                        # Подготовка фичей — CPU-нагрузка
-                        feats = await asyncio.to_thread(prepare_ml_features, df_m1)
-                        if feats:
-                            trade["ml_features"] = feats
-                            recalculated_count += 1
-                            logging.info(f"✅ Пересчитаны фичи для {pair} ({len(feats)})")
-                        else:
-                            failed_count += 1
-                    else:
-                        failed_count += 1
-
-                    processed += 1
-                    if processed % 20 == 0:
-                        await update.message.reply_text(f"📊 Обработано {processed}/{total_trades} сделок...")
+            trades = [t for t in all_trades if t.get("pair")]
 
-        else:
-            # Режим одного пользователя
-            for trade in all_trades:
-                if not trade.get("pair"):
-                    continue
+        if not trades:
+            await update.message.reply_text("❌ Нет сделок для пересчёта")
+            return
 
-                pair = trade["pair"]
-                df_m1 = await asyncio.to_thread(get_mt5_data, pair, 400, mt5.TIMEFRAME_M1)
-                if df_m1 is not None and len(df_m1) > 100:
-                    feats = await asyncio.to_thread(prepare_ml_features, df_m1)
-                    if feats:
-                        trade["ml_features"] = feats
-                        recalculated_count += 1
-                        logging.info(f"✅ Пересчитаны фичи для {pair} ({len(feats)})")
-                    else:
-                        failed_count += 1
-                else:
-                    failed_count += 1
+        # 🏗 Вся история по парам + матрица признаков — CPU-нагрузка, вне event loop
+        result = await asyncio.to_thread(build_backfill_training_matrix, trades)
+        stats = result['stats']
 
-                processed += 1
-                if processed % 20 == 0:
-                    await update.message.reply_text(f"📊 Обработано {processed}/{total_trades} сделок...")
+        for trade, row in zip(result['trades'], result['X'].to_dict('records')):
+            trade["ml_features"] = row
 
-        # 💾 Асинхронное сохранение результатов
-        if recalculated_count > 0:
+        if stats['trades_matched'] > 0:
             await async_save_users_data()
-
-            # Проверяем пример фичей
-            sample_features_count = 0
-            trades_iter = (
-                (trade for u in users.values() for trade in u.get("trade_history", []))
-                if MULTI_USER_MODE
-                else all_trades
-            )
-            for trade in trades_iter:
-                if trade.get("ml_features"):
-                    sample_features_count = len(trade["ml_features"])
-                    break
-
+            # 🗄 Признаки сделок изменились — датасет обучения пересобираем целиком
+            await asyncio.to_thread(rebuild_dataset_store)
             await update.message.reply_text(
-                f"✅ Пересчёт завершён!\n"
-                f"• Успешно: {recalculated_count}\n"
-                f"• Ошибок: {failed_count}\n"
-                f"• Кол-во фич: {sample_features_count}\n"
+                f"✅ Пересчёт завершён за {stats['seconds']} сек!\n"
+                f"• Успешно: {stats['trades_matched']}\n"
+                f"• Пропущено: {stats['trades_skipped']}\n"
+                f"• Пар: {stats['pairs']}, баров: {stats['bars']}\n"
+                f"• Кол-во фич: {result['X'].shape[1]}\n"
                 f"💡 Можно запустить /retrain"
             )
         else:
@@ -5054,6 +8350,10 @@ async def reset_ml_features_command(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("❌ Эта команда доступна только администратору")
         return
 
+    if get_running_training_job() is not None:
+        await update.message.reply_text("⏳ Идёт обучение модели — датасет сейчас не пересобрать, повторите после его завершения (/canceltrain — отменить)")
+        return
+
     await update.message.reply_text("🔄 Сброс ML-фичей для пересчёта на реальных данных...")
 
     try:
@@ -5078,6 +8378,7 @@ async def reset_ml_features_command(update: Update, context: ContextTypes.DEFAUL
             await async_save_users_data()
 
         if reset_count > 0:
+            await asyncio.to_thread(rebuild_dataset_store)
             await update.message.reply_text(
                 f"✅ Сброшено ML-фичей: {reset_count} сделок\n"
                 f"🧠 Теперь используйте /recalculateml для пересчёта на реальных данных"
@@ -5402,6 +8703,19 @@ def main():
     logging.info("✅ MT5 подключен успешно")
     print("✅ MT5 подключен успешно")
 
+    # ----- Колоночный датасет обучения (разовая миграция из trade_history) -----
+    try:
+        ensure_dataset_store()
+    except Exception as e:
+        logging.error(f"❌ Ошибка подготовки датасета обучения: {e}", exc_info=True)
+
+    # ----- ML модель из реестра версий -----
+    try:
+        limit_native_threads()
+        refresh_active_model()
+    except Exception as e:
+        logging.error(f"❌ Ошибка загрузки ML модели из реестра: {e}", exc_info=True)
+
     # ===================== 5. ИНИЦИАЛИЗАЦИЯ TELEGRAM APP =====================
     from telegram.request import HTTPXRequest
     request = HTTPXRequest(
@@ -5432,6 +8746,7 @@ def main():
     app.add_handler(CommandHandler("stats", statistics_command))
     app.add_handler(CommandHandler("modelstats", model_stats_command))
     app.add_handler(CommandHandler("retrain", retrain_model_command))
+    app.add_handler(CommandHandler("canceltrain", cancel_training_command))
     app.add_handler(CommandHandler("settings", settings_command))
     app.add_handler(CommandHandler("stop", stop_command))
     app.add_handler(CommandHandler("help", help_command))
@@ -5490,6 +8805,42 @@ def main():
             job_kwargs={"misfire_grace_time": 60},
         )
 
+        # ----- Реестр моделей: новая версия из MANIFEST грузится в фоне -----
+        async def model_registry_job(context):
+            try:
+                await asyncio.to_thread(refresh_active_model)
+            except Exception as e:
+                logging.error(f"⚠ Ошибка обновления ML модели из реестра: {e}")
+
+        job_queue.run_repeating(
+            model_registry_job,
+            interval=ML_REGISTRY_POLL_SEC,
+            first=ML_REGISTRY_POLL_SEC,
+            name="model_registry_job",
+            job_kwargs={"misfire_grace_time": 30},
+        )
+
+        # ----- Плановое дообучение ML на новых сделках (+ периодическое полное обучение) -----
+        job_queue.run_repeating(
+            incremental_training_job,
+            interval=ML_INCREMENTAL_INTERVAL_SEC,
+            first=ML_INCREMENTAL_INTERVAL_SEC,
+            name="incremental_training_job",
+            job_kwargs={"misfire_grace_time": 120},
+        )
+
+        # ----- Ночное обучение претендента (сравнение с чемпионом) -----
+        try:
+            nightly_hour, nightly_minute = (int(x) for x in ML_NIGHTLY_RETRAIN_AT.split(":"))
+            job_queue.run_daily(
+                nightly_retrain_job,
+                time=time(nightly_hour, nightly_minute),
+                name="nightly_retrain_job",
+                job_kwargs={"misfire_grace_time": 600},
+            )
+        except ValueError:
+            logging.error(f"⚠ Неверный ML_NIGHTLY_RETRAIN_AT={ML_NIGHTLY_RETRAIN_AT!r}, ожидается ЧЧ:ММ")
+
         # ----- Listener для отслеживания задач -----
         from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED
 
@@ -0,0 +1,80 @@
+"""
+Общие фикстуры тестов бота.
+Модуль botaspireFINNAL импортируется целиком, поэтому без MetaTrader5/telegram и т.п.
+тесты пропускаются (на Windows-машине с терминалом MT5 они идут как обычно).
+"""
+import os
+import sys
+import importlib
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_DEPS = ("MetaTrader5", "talib", "telegram", "mplfinance", "matplotlib",
+              "dotenv", "aiofiles", "apscheduler", "openai", "sklearn", "scipy")
+
+
+@pytest.fixture(scope="session")
+def bot(tmp_path_factory):
+    """Импортированный модуль бота с фиктивными ключами и рабочей папкой во временном каталоге"""
+    for dep in HEAVY_DEPS:
+        pytest.importorskip(dep)
+    os.environ.setdefault("TELEGRAM_TOKEN", "test-token")
+    os.environ.setdefault("OPENAI_API_KEY", "test-key")
+    workdir = tmp_path_factory.mktemp("bot")
+    old_cwd = os.getcwd()
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    try:
+        module = importlib.import_module("botaspireFINNAL")
+        yield module
+    finally:
+        os.chdir(old_cwd)
+
+
+def make_bars(n: int = 400, seed: int = 0, base: float = 1.1):
+    """Синтетические минутные свечи OHLCV со случайным блужданием"""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    close = base + np.cumsum(rng.normal(0, 0.0004, n))
+    open_ = np.r_[close[0], close[:-1]]
+    spread = np.abs(rng.normal(0, 0.0003, n))
+    high = np.maximum(open_, close) + spread
+    low = np.minimum(open_, close) - spread
+    volume = rng.integers(20, 400, n).astype(float)
+    index = pd.date_range("2024-01-02 09:00", periods=n, freq="1min")
+    return pd.DataFrame({"open": open_, "high": high, "low": low, "close": close,
+                         "tick_volume": volume}, index=index)
+
+
+def make_trades(n: int = 900, n_features: int = 12, seed: int = 0):
+    """Синтетические закрытые сделки с ml_features (WIN зависит от первых двух признаков)"""
+    from datetime import datetime, timedelta
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    names = [f"feat_{i}" for i in range(n_features)]
+    start = datetime(2026, 1, 1)
+    trades = []
+    for i in range(n):
+        x = rng.normal(size=n_features)
+        win = (x[0] + 0.5 * x[1] + rng.normal(scale=0.8)) > 0
+        trades.append({'id': i, 'pair': 'EURUSD', 'direction': 'BUY', 'result': 'WIN' if win else 'LOSS',
+                       'timestamp': (start + timedelta(minutes=5 * i)).isoformat(),
+                       'ml_features': dict(zip(names, map(float, x)))})
+    return trades
+
+
+@pytest.fixture
+def ml_workdir(bot, tmp_path, monkeypatch):
+    """Пустые датасет, реестр моделей и ml_info.json во временном каталоге"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "ML_ACTIVE", None)
+    monkeypatch.setattr(bot, "DATASET_STORE", bot.ColumnarDatasetStore(str(tmp_path / "ml_dataset")))
+    monkeypatch.setattr(bot, "MULTI_USER_MODE", True)
+    monkeypatch.setattr(bot, "users", {1: {'trade_history': []}})
+    return tmp_path
@@ -0,0 +1,53 @@
+"""Чемпион / претендент: без оценки чемпиона претендент не повышается"""
+import pytest
+
+from conftest import make_trades
+
+
+@pytest.fixture
+def registry(bot, ml_workdir):
+    """Чемпион, обученный на всём датасете"""
+    trades = make_trades()
+    bot.users[1]['trade_history'] = trades
+    bot.DATASET_STORE.rebuild(trades)
+    champion = bot.train_ml_model()
+    assert bot.read_model_manifest()["active"] == champion["version"]
+    return trades, champion
+
+
+def test_decide_promotion_requires_scored_champion(bot):
+    challenger = {"accuracy": 90.0, "latency_p95_ms": 0.1}
+    assert bot.decide_promotion(None, challenger)[0] is False
+    assert bot.decide_promotion(None, challenger, has_champion=False)[0] is True
+    assert bot.decide_promotion({"accuracy": 89.9}, challenger)[0] is False
+    assert bot.decide_promotion({"accuracy": 50.0}, challenger)[0] is True
+
+
+def test_rebuilt_dataset_scores_champion_on_fresh_window(bot, registry, monkeypatch):
+    trades, champion = registry
+    bot.DATASET_STORE.rebuild(trades)  # водяной знак чемпиона больше не действует
+    monkeypatch.setattr(bot, "ML_PROMOTE_MIN_GAIN", 100.0)  # претендент заведомо не лучше
+
+    result = bot.run_champion_challenger()
+    report = result["champion_challenger"]
+
+    assert report["champion_metrics"] is not None
+    assert report["champion_advisory"] is True
+    assert report["promoted"] is False
+    assert bot.read_model_manifest()["active"] == champion["version"]
+
+
+def test_unscored_champion_blocks_promotion(bot, registry, monkeypatch):
+    trades, champion = registry
+    bot.DATASET_STORE.rebuild(trades)
+    evaluate = bot.evaluate_bundle
+    monkeypatch.setattr(bot, "evaluate_bundle", lambda bundle, dataset, rows:
+                        None if bundle['version'] == champion["version"] else evaluate(bundle, dataset, rows))
+
+    result = bot.run_champion_challenger()
+    report = result["champion_challenger"]
+
+    assert report["champion_metrics"] is None
+    assert report["promoted"] is False
+    assert "нельзя оценить" in report["reason"]
+    assert bot.read_model_manifest()["active"] == champion["version"]
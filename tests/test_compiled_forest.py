@@ -0,0 +1,87 @@
+"""Компилированный лес против RandomForestClassifier.predict_proba"""
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.preprocessing import StandardScaler
+
+
+def _fit_forest(n_rows=600, n_features=12, nan_in_training=False, seed=0, **params):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, n_features))
+    y = ((X[:, 0] + 0.5 * X[:, 1] - X[:, 2] + rng.normal(0, 0.5, n_rows)) > 0).astype(int)
+    if nan_in_training:
+        X[rng.random(X.shape) < 0.05] = np.nan
+    scaler = StandardScaler().fit(X)
+    model = RandomForestClassifier(n_estimators=40, random_state=seed, **params).fit(scaler.transform(X), y)
+    return model, scaler, X
+
+
+def _edge_rows(X_scaled, model):
+    """Строки обучения, точные пороги узлов, экстремумы, константы и NaN (в шкале модели)"""
+    rows = [X_scaled[:50]]
+    n_features = X_scaled.shape[1]
+    tree = model.estimators_[0].tree_
+    internal = tree.children_left != -1
+    for feature, threshold in list(zip(tree.feature[internal], tree.threshold[internal]))[:20]:
+        if np.isfinite(threshold):
+            row = np.zeros(n_features)
+            row[feature] = threshold
+            rows.append(row[None, :])
+    rows.append(np.full((1, n_features), 1e30))
+    rows.append(np.full((1, n_features), -1e30))
+    rows.append(np.zeros((1, n_features)))
+    with_nan = X_scaled[50:80].copy()
+    with_nan[:, ::3] = np.nan
+    rows.append(with_nan)
+    rows.append(np.full((1, n_features), np.nan))
+    return np.vstack(rows)
+
+
+@pytest.mark.parametrize("nan_in_training", [False, True])
+@pytest.mark.parametrize("params", [{}, {"max_depth": 3}, {"min_samples_leaf": 20, "class_weight": "balanced"}])
+def test_forest_matches_predict_proba(bot, nan_in_training, params):
+    model, scaler, X = _fit_forest(nan_in_training=nan_in_training, **params)
+    forest = bot.compile_forest(model)
+    assert forest is not None
+
+    X_scaled = _edge_rows(scaler.transform(X), model)
+    expected = model.predict_proba(X_scaled)[:, 1]
+    np.testing.assert_allclose(bot.forest_predict_proba(forest, X_scaled), expected, rtol=0, atol=1e-12)
+    # одна строка — тот же путь, что у инференса в analyze_pair
+    for row in X_scaled[:5]:
+        assert abs(bot.forest_predict_proba(forest, row)[0] - model.predict_proba(row[None, :])[0, 1]) <= 1e-12
+
+
+def test_forest_rejects_wrong_width(bot):
+    model, scaler, X = _fit_forest()
+    forest = bot.compile_forest(model)
+    with pytest.raises(ValueError):
+        bot.forest_predict_proba(forest, X[:2, :-1])
+
+
+def test_compile_forest_skips_non_binary(bot):
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(200, 4))
+    model = RandomForestClassifier(n_estimators=5, random_state=0).fit(X, rng.integers(0, 3, 200))
+    assert bot.compile_forest(model) is None
+
+
+def test_benchmark_single_row(bot):
+    model, scaler, _ = _fit_forest()
+    report = bot.benchmark_fast_forest(model, scaler, repeats=20)
+    assert report['compiled'] and report['equivalent']
+    assert report['compiled_ms'] < report['sklearn_ms']
+
+
+def test_bundle_forest_belongs_to_its_model(bot):
+    """Лес живёт в связке: временная связка не подменяет лес другой модели"""
+    names = [f"f{i}" for i in range(12)]
+    first, first_scaler, X = _fit_forest(seed=1)
+    temporary = bot.make_model_bundle("first", first, first_scaler, {"feature_names": names})
+    del temporary, first
+    second, second_scaler, _ = _fit_forest(seed=2, max_depth=3)
+    bundle = bot.make_model_bundle("second", second, second_scaler, {"feature_names": names})
+
+    X_scaled = second_scaler.transform(X[:50])
+    np.testing.assert_allclose(bot.forest_predict_proba(bundle['forest'], X_scaled),
+                               second.predict_proba(X_scaled)[:, 1], rtol=0, atol=1e-12)
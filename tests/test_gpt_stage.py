@@ -0,0 +1,111 @@
+"""GPT-стадия против локальной заглушки OpenAI: лимит параллельности, дедлайн, склейка запросов"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import make_bars
+
+ANSWER = '```json\n{"decision":"BUY","expiry":3,"confidence":7,"reason":"test"}\n```'
+
+
+@pytest.fixture
+def gpt_server():
+    """Заглушка /v1/chat/completions: считает запросы и одновременные соединения"""
+    state = {'requests': 0, 'active': 0, 'max_active': 0, 'delay': 0.3}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            with lock:
+                state['requests'] += 1
+                state['active'] += 1
+                state['max_active'] = max(state['max_active'], state['active'])
+            time.sleep(state['delay'])
+            with lock:
+                state['active'] -= 1
+            data = json.dumps({
+                "id": "stub", "object": "chat.completion", "created": 0, "model": body['model'],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": ANSWER}}],
+            }).encode()
+            try:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            except OSError:
+                pass  # клиент ушёл по таймауту
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state['url'] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stage(bot, gpt_server, monkeypatch):
+    """Свежая GPT-стадия (клиент, кэш, счётчики) на заглушке"""
+    monkeypatch.setattr(bot, "OPENAI_BASE_URL", gpt_server['url'])
+    monkeypatch.setattr(bot, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(bot, "GPT_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(bot, "GPT_DEADLINE_SEC", 5.0)
+    monkeypatch.setattr(bot, "GPT_STAGE", bot.GPTStage())
+    monkeypatch.setattr(bot, "GPT_RESULTS", bot.BarResultCache(maxsize=64))
+    monkeypatch.setattr(bot, "GPT_STATS", dict.fromkeys(bot.GPT_STATS, 0))
+    return gpt_server
+
+
+def test_same_bar_requests_are_coalesced_and_cached(bot, stage):
+    df = make_bars(300, seed=1)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: bot.gpt_full_market_read("EURUSD", df, None), range(8)))
+
+    assert results == [("BUY", 3)] * 8
+    assert stage['requests'] == 1
+    assert bot.GPT_STATS['coalesced'] == 7
+
+    assert bot.gpt_full_market_read("EURUSD", df, None) == ("BUY", 3)
+    assert stage['requests'] == 1
+    assert bot.GPT_STATS['cache_hits'] == 1
+
+
+def test_concurrency_limit(bot, stage):
+    pairs = ["GBPUSD", "AUDUSD", "USDCAD", "NZDUSD", "EURJPY"]
+    frames = {pair: make_bars(300, seed=i) for i, pair in enumerate(pairs)}
+    with ThreadPoolExecutor(len(pairs)) as pool:
+        results = list(pool.map(lambda pair: bot.gpt_full_market_read(pair, frames[pair], None), pairs))
+
+    assert results == [("BUY", 3)] * len(pairs)
+    assert stage['requests'] == len(pairs)
+    assert stage['max_active'] <= 2
+    assert bot.GPT_STATS['requests'] == len(pairs)
+
+
+def test_deadline_returns_without_gpt_and_keeps_request(bot, stage, monkeypatch):
+    monkeypatch.setattr(bot, "GPT_DEADLINE_SEC", 0.2)
+    stage['delay'] = 1.0
+    df = make_bars(300, seed=7)
+
+    started = time.perf_counter()
+    assert bot.gpt_full_market_read("USDJPY", df, None) == (None, None)
+    assert time.perf_counter() - started < 0.9
+    assert bot.GPT_STATS['timeouts'] == 1
+
+    # Запрос не отменён дедлайном: ответ доходит и попадает в кэш бара
+    deadline = time.monotonic() + 5
+    while bot.GPT_STAGE.inflight and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not bot.GPT_STAGE.inflight
+    assert bot.gpt_full_market_read("USDJPY", df, None) == ("BUY", 3)
+    assert stage['requests'] == 1
@@ -0,0 +1,50 @@
+"""Дообучение: деревья полного обучения не вытесняются, ухудшение не публикуется"""
+import numpy as np
+import pytest
+
+from conftest import make_trades
+
+
+@pytest.fixture
+def trained(bot, ml_workdir):
+    """Активная модель на первых 800 сделках, дальше — ещё не виденные"""
+    trades = make_trades(n=2000)
+    bot.DATASET_STORE.rebuild(trades[:800])
+    info = bot.train_ml_model()
+    if info["model_type"] != "RandomForestClassifier":
+        pytest.skip("победил MLP — проверки рассчитаны на лес")
+    return trades
+
+
+def test_base_trees_survive_eviction(bot, trained, monkeypatch):
+    base = bot.get_active_model()['model']
+    monkeypatch.setattr(bot, "ML_INCREMENTAL_MAX_TREES", len(base.estimators_) + 40)
+    for start in range(800, 2000, 200):
+        bot.DATASET_STORE.append_trades(trained[start:start + 200])
+        bot.run_incremental_update()
+
+    active = bot.get_active_model()
+    assert active['info']["updates_since_full"] >= 2
+    model = active['model']
+    assert len(model.estimators_) <= len(base.estimators_) + 40
+    for grown_tree, base_tree in zip(model.estimators_, base.estimators_):
+        assert np.array_equal(grown_tree.tree_.threshold, base_tree.tree_.threshold)
+
+
+def test_worse_update_is_not_published(bot, trained, monkeypatch):
+    monkeypatch.setattr(bot, "ML_INCREMENTAL_TREES", 600)  # новые деревья перевешивают старые
+    monkeypatch.setattr(bot, "ML_INCREMENTAL_MAX_TREES", 5000)
+    flipped = [dict(t, result='LOSS' if t['result'] == 'WIN' else 'WIN') for t in trained[800:1100]]
+    bot.DATASET_STORE.append_trades(flipped + trained[1100:1200])
+    version = bot.get_active_model()['version']
+
+    assert bot.run_incremental_update() is None
+    assert bot.get_active_model()['version'] == version
+
+
+def test_incremental_update_holds_training_slot(bot, trained):
+    bot.DATASET_STORE.append_trades(trained[800:1000])
+    with bot.TRAINING_SLOT_LOCK:
+        assert bot.run_incremental_update() is None
+        with pytest.raises(RuntimeError):
+            bot.start_training_job(None)
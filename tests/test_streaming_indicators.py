@@ -0,0 +1,74 @@
+"""Потоковые индикаторы против TA-Lib на том же окне свечей"""
+import numpy as np
+import talib as ta
+
+from conftest import make_bars
+
+WINDOW = 400
+# EMA(100) между пересевами несёт хвост затравки с начала прошлого окна
+TOLERANCE = 1e-4
+
+
+def _talib_reference(df):
+    c, h, l, v = df['close'], df['high'], df['low'], df['tick_volume']
+    atr = ta.ATR(h, l, c, 14)
+    obv = ta.OBV(c, v)
+    return {
+        'ema_20': ta.EMA(c, 20).iloc[-1],
+        'ema_50': ta.EMA(c, 50).iloc[-1],
+        'ema_100': ta.EMA(c, 100).iloc[-1],
+        'rsi_14': ta.RSI(c, 14).iloc[-1],
+        'rsi_21': ta.RSI(c, 21).iloc[-1],
+        'atr': atr.iloc[-1],
+        'atr_ma_50': atr.rolling(50).mean().iloc[-1],
+        'adx': ta.ADX(h, l, c, 14).iloc[-1],
+        'obv': obv.iloc[-1],
+        'obv_trend': obv.diff(5).iloc[-1],
+    }
+
+
+def _assert_close(snap, ref, tol):
+    for key, expected in ref.items():
+        got = snap[key]
+        assert got is not None, key
+        assert abs(got - expected) <= tol * max(1.0, abs(expected)), (key, got, expected)
+
+
+def test_sliding_window_tracks_talib(bot):
+    bot.INDICATOR_STREAMS.clear()
+    bars = make_bars(WINDOW + 3 * bot.STREAM_RESEED_BARS, seed=3)
+    for end in range(WINDOW, len(bars), 5):
+        df = bars.iloc[end - WINDOW:end]
+        snap = bot.get_streaming_indicators("EURUSD", df)
+        _assert_close(snap, _talib_reference(df), TOLERANCE)
+    assert bot.INDICATOR_STREAMS[("EURUSD", "M1")].reseeds >= 2
+
+
+def test_first_window_matches_talib_exactly(bot):
+    bot.INDICATOR_STREAMS.clear()
+    df = make_bars(WINDOW, seed=5)
+    _assert_close(bot.get_streaming_indicators("GBPUSD", df), _talib_reference(df), 1e-9)
+
+
+def test_rewritten_closed_bar_reseeds(bot):
+    bot.INDICATOR_STREAMS.clear()
+    bars = make_bars(WINDOW + 10, seed=7)
+    bot.get_streaming_indicators("USDJPY", bars.iloc[:WINDOW])
+    df = bars.iloc[1:WINDOW + 1].copy()
+    # последний закоммиченный бар переписан брокером
+    df.iloc[-3, df.columns.get_loc('close')] += 0.002
+    stream = bot.INDICATOR_STREAMS[("USDJPY", "M1")]
+    reseeds = stream.reseeds
+    snap = bot.get_streaming_indicators("USDJPY", df)
+    assert stream.reseeds == reseeds + 1
+    _assert_close(snap, _talib_reference(df), 1e-9)
+
+
+def test_history_gap_reseeds(bot):
+    bot.INDICATOR_STREAMS.clear()
+    bars = make_bars(2 * WINDOW, seed=9)
+    bot.get_streaming_indicators("AUDUSD", bars.iloc[:WINDOW])
+    df = bars.iloc[WINDOW:]
+    snap = bot.get_streaming_indicators("AUDUSD", df)
+    _assert_close(snap, _talib_reference(df), 1e-9)
+    assert not np.isnan(snap['adx'])
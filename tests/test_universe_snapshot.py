@@ -0,0 +1,29 @@
+"""Батч-снимок вселенной: пара с короткой историей не обрезает окна остальных"""
+import numpy as np
+import talib as ta
+
+from conftest import make_bars
+
+
+def test_short_pair_gets_its_own_group(bot):
+    frames = {
+        "EURUSD": make_bars(400, seed=1),
+        "GBPUSD": make_bars(400, seed=2),
+        "NEWPAIR": make_bars(120, seed=3),
+    }
+    stacks = bot.stack_pair_frames(frames, 400)
+
+    assert sorted(len(stack['pairs']) for stack in stacks) == [1, 2]
+    stamps = {pair: stamp for stack in stacks for pair, stamp in stack['stamps'].items()}
+    for pair, df in frames.items():
+        assert stamps[pair] == bot._bar_stamp(df)
+
+    for stack in stacks:
+        snapshot = bot.batch_indicator_snapshot(stack)
+        for pair in stack['pairs']:
+            expected = ta.RSI(frames[pair]['close'], 14).iloc[-1]
+            assert abs(snapshot[pair]['rsi_14'] - expected) < 1e-9
+
+
+def test_empty_frames_give_no_stacks(bot):
+    assert bot.stack_pair_frames({"EURUSD": None}, 400) == []